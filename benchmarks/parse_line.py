@@ -0,0 +1,187 @@
+import os, random, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")) # This needs to work from any directory
+from txircd.ircbase import IRCBase
+from typing import Dict, List, Optional, Tuple, Union
+
+# Checks IRCBase._parseLine against a corpus of lines with known results, compares it with the line parser it
+# replaced on a large set of random lines, and times both parsers on some typical lines.
+# Usage: python parse_line.py [random line count]
+
+noResult = (None, None, None, None)
+
+# Each entry is a line and the result of parsing it
+corpus = [
+	("PRIVMSG #chan :hello world", ("PRIVMSG", ["#chan", "hello world"], None, {})),
+	("privmsg #chan hello", ("PRIVMSG", ["#chan", "hello"], None, {})),
+	(":nick!user@host PRIVMSG #chan :hi there", ("PRIVMSG", ["#chan", "hi there"], "nick!user@host", {})),
+	(":irc.example.com 001 nick :Welcome to the network", ("001", ["nick", "Welcome to the network"], "irc.example.com", {})),
+	("@time=2020-01-01T00:00:00.000Z;msgid=abc :nick!user@host PRIVMSG #chan :hi", ("PRIVMSG", ["#chan", "hi"], "nick!user@host", { "time": "2020-01-01T00:00:00.000Z", "msgid": "abc" })),
+	("@a;b=;c=d :nick PING", ("PING", [], "nick", { "a": None, "b": "", "c": "d" })),
+	("@a=b;;c=d PING", ("PING", [], None, { "a": "b", "c": "d" })),
+	("@a\\sb=c\\\\d\\:e\\sf\\rg\\nh PING", ("PING", [], None, { "a\\sb": "c\\d;e f\rg\nh" })),
+	("@a=b\\xc PING", ("PING", [], None, { "a": "bxc" })),
+	("@a=b\\ PING", ("PING", [], None, { "a": "b" })),
+	("@a=b=c PING", ("PING", [], None, { "a": "b=c" })),
+	("MODE #chan +bbb a b c", ("MODE", ["#chan", "+bbb", "a", "b", "c"], None, {})),
+	("MODE  #chan   +o    nick", ("MODE", ["#chan", "+o", "nick"], None, {})),
+	("NICK nick ", ("NICK", ["nick"], None, {})),
+	("PRIVMSG #chan :", ("PRIVMSG", ["#chan", ""], None, {})),
+	("PRIVMSG #chan ::)", ("PRIVMSG", ["#chan", ":)"], None, {})),
+	("PRIVMSG #chan :a :b", ("PRIVMSG", ["#chan", "a :b"], None, {})),
+	("PRIVMSG #chan :  spaced  ", ("PRIVMSG", ["#chan", "  spaced  "], None, {})),
+	("USER a 0 * :Real Name", ("USER", ["a", "0", "*", "Real Name"], None, {})),
+	("PING", ("PING", [], None, {})),
+	("PRI\0VMSG #chan :x\0y", ("PRIVMSG", ["#chan", "xy"], None, {})),
+	("PRIVMSG #chan :café �", ("PRIVMSG", ["#chan", "café �"], None, {})),
+	# Lines with an empty command parse, but lineReceived ignores them
+	("  PRIVMSG #chan :x", ("", ["PRIVMSG", "#chan", "x"], None, {})),
+	(":prefix  PING", ("", ["PING"], "prefix", {})),
+	("   ", ("", [], None, {})),
+	(" :x", noResult),
+	("@tag", noResult),
+	("@tag ", noResult), # The old parser raised IndexError for this one
+	(":prefix", noResult),
+	(":prefix ", noResult),
+	("\0", noResult),
+	("", noResult)
+]
+
+def oldParseLine(line: str) -> Union[Tuple[str, List[str], str, Dict[str, Optional[str]]], Tuple[None, None, None, None]]:
+	"""
+	The line parser IRCBase used before the single-pass parser.
+	"""
+	line = line.replace("\0", "")
+	if not line:
+		return None, None, None, None
+
+	if line[0] == "@":
+		if " " not in line:
+			return None, None, None, None
+		tagLine, line = line.split(" ", 1)
+		tags = oldParseTags(tagLine[1:])
+	else:
+		tags = {}
+
+	prefix = None
+	if line[0] == ":":
+		if " " not in line:
+			return None, None, None, None
+		prefix, line = line.split(" ", 1)
+		prefix = prefix[1:]
+
+	if " :" in line:
+		linePart, lastParam = line.split(" :", 1)
+	else:
+		linePart = line
+		lastParam = None
+	if not linePart:
+		return None, None, None, None
+
+	if " " in linePart:
+		command, paramLine = linePart.split(" ", 1)
+		params = paramLine.split(" ")
+	else:
+		command = linePart
+		params = []
+	while "" in params:
+		params.remove("")
+	if lastParam is not None:
+		params.append(lastParam)
+	return command.upper(), params, prefix, tags
+
+def oldParseTags(tagLine: str) -> Dict[str, Optional[str]]:
+	tags = {}
+	for tagval in tagLine.split(";"):
+		if not tagval:
+			continue
+		if "=" in tagval:
+			tag, escapedValue = tagval.split("=", 1)
+			escaped = False
+			valueChars = []
+			for char in escapedValue:
+				if escaped:
+					if char == "\\":
+						valueChars.append("\\")
+					elif char == ":":
+						valueChars.append(";")
+					elif char == "r":
+						valueChars.append("\r")
+					elif char == "n":
+						valueChars.append("\n")
+					elif char == "s":
+						valueChars.append(" ")
+					else:
+						valueChars.append(char)
+					escaped = False
+					continue
+				if char == "\\":
+					escaped = True
+					continue
+				valueChars.append(char)
+			value = "".join(valueChars)
+		else:
+			tag = tagval
+			value = None
+		tags[tag] = value
+	return tags
+
+def checkCorpus(parser: IRCBase) -> int:
+	failures = 0
+	for line, expectedResult in corpus:
+		result = parser._parseLine(line)
+		if result != expectedResult:
+			failures += 1
+			print("Corpus line {!r} parsed as {!r} instead of {!r}".format(line, result, expectedResult))
+	return failures
+
+def compareRandomLines(parser: IRCBase, lineCount: int) -> int:
+	# The pieces are weighted toward the characters the parsers treat specially
+	linePieces = ["@", ":", " ", " ", "  ", ";", "=", "\\", "\\:", "\\n", "\\s", "\0", "a", "B", "s", "x", "é"]
+	randomSource = random.Random(5)
+	failures = 0
+	for lineNum in range(lineCount):
+		line = "".join(randomSource.choice(linePieces) for pieceNum in range(randomSource.randint(0, 20)))
+		try:
+			expectedResult = oldParseLine(line)
+		except IndexError:
+			expectedResult = noResult
+		result = parser._parseLine(line)
+		if result != expectedResult:
+			failures += 1
+			if failures <= 10:
+				print("Random line {!r} parsed as {!r} instead of {!r}".format(line, result, expectedResult))
+	return failures
+
+def timeParsers(parser: IRCBase) -> None:
+	benchmarkLines = [
+		("tagged PRIVMSG", "@time=2020-01-01T00:00:00.000Z;msgid=abc\\sdef :nick!user@host PRIVMSG #channel :" + "hello world " * 20),
+		("short PRIVMSG", "PRIVMSG #chan :hi"),
+		("PONG", "PONG :irc.example.com"),
+		("JOIN", "JOIN #chan"),
+		("MODE with runs of spaces", "MODE #chan +bbb a b c" + " " * 50 + "x")
+	]
+	# The parsers take turns, and the best round for each is used, so that noise affects both parsers alike
+	roundCount = 20
+	repeatCount = 10000
+	for description, line in benchmarkLines:
+		timings = [None, None]
+		for roundNum in range(roundCount):
+			for parserNum, parseFunc in enumerate((oldParseLine, parser._parseLine)):
+				startTime = time.perf_counter()
+				for repeatNum in range(repeatCount):
+					parseFunc(line)
+				roundTime = (time.perf_counter() - startTime) * 1000000 / repeatCount
+				if timings[parserNum] is None or roundTime < timings[parserNum]:
+					timings[parserNum] = roundTime
+		print("{}: {:.2f}us -> {:.2f}us per line".format(description, timings[0], timings[1]))
+
+if __name__ == "__main__":
+	randomLineCount = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+	parser = IRCBase()
+	corpusFailures = checkCorpus(parser)
+	print("{} of {} corpus lines parsed incorrectly".format(corpusFailures, len(corpus)))
+	randomFailures = compareRandomLines(parser, randomLineCount)
+	print("{} of {} random lines parsed differently from the old parser".format(randomFailures, randomLineCount))
+	timeParsers(parser)
+	if corpusFailures or randomFailures:
+		sys.exit(1)
@@ -0,0 +1,78 @@
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")) # This needs to work from any directory
+from txircd.ircd import IRCd
+from typing import Any, Dict, List, Optional
+
+# Times dispatching an action for the members of a large channel, comparing the IRCd's stop check (which checks
+# whether all of the action's users have disconnected after each handler) against the scan it replaced. Only the
+# last member is still connected, which is the worst case for the scan.
+# Usage: python stop_action.py [member count] [handler count]
+
+class ScanningStopCheckIRCd(IRCd):
+	"""
+	An IRCd that checks whether all users for an action have disconnected by
+	scanning the whole user list after every handler, as it did before the
+	user removal counter was added.
+	"""
+	def _actionStopState(self, keywords: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+		return keywords
+
+	def _shouldStopAction(self, keywords: Optional[Dict[str, Any]]) -> bool:
+		if "allowDisconnected" in keywords and keywords["allowDisconnected"]:
+			return False
+		if "users" in keywords and keywords["users"]:
+			# Stop an action if all users have disconnected
+			for user in keywords["users"]:
+				if user.uuid in self.users:
+					return False
+			return True
+		return False
+
+class BenchmarkUser(object):
+	def __init__(self, uuid: str):
+		self.uuid = uuid
+
+def makeIRCd(ircdClass: type, users: List[BenchmarkUser], handlerCount: int) -> IRCd:
+	ircd = ircdClass("benchmark.yaml") # The config file is never read
+	ircd.serverID = "001"
+	ircd.users = { user.uuid: user for user in users }
+	ircd.actions["benchmark"] = [(lambda: None, 10)] * handlerCount
+	return ircd
+
+def countCalledHandlers(ircdClass: type, users: List[BenchmarkUser]) -> int:
+	# The second handler disconnects every user, so only the first two handlers should be called
+	calledHandlers = []
+	def disconnectAll() -> None:
+		calledHandlers.append(2)
+		for user in users:
+			if user.uuid in ircd.users:
+				del ircd.users[user.uuid]
+				ircd.userRemovalCount += 1
+	ircd = makeIRCd(ircdClass, users, 0)
+	ircd.actions["benchmark"] = [(lambda: calledHandlers.append(1), 30), (disconnectAll, 20), (lambda: calledHandlers.append(3), 10)]
+	ircd.runActionStandard("benchmark", users=users)
+	return len(calledHandlers)
+
+def timeDispatch(ircdClass: type, users: List[BenchmarkUser], handlerCount: int, repeatCount: int) -> float:
+	ircd = makeIRCd(ircdClass, users, handlerCount)
+	for user in users[:-1]:
+		del ircd.users[user.uuid]
+		ircd.userRemovalCount += 1
+	ircd.runActionStandard("benchmark", users=users) # Builds the cached dispatch plan
+	startTime = time.perf_counter()
+	for repeatNum in range(repeatCount):
+		ircd.runActionStandard("benchmark", users=users)
+	return (time.perf_counter() - startTime) * 1000 / repeatCount
+
+if __name__ == "__main__":
+	memberCount = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+	handlerCount = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+	users = [BenchmarkUser("001{:06d}".format(userNum)) for userNum in range(memberCount)]
+	for ircdClass in (ScanningStopCheckIRCd, IRCd):
+		calledCount = countCalledHandlers(ircdClass, users)
+		if calledCount != 2:
+			print("{}: {} handlers were called after all users disconnected instead of 2".format(ircdClass.__name__, calledCount))
+			sys.exit(1)
+	scanTime = timeDispatch(ScanningStopCheckIRCd, users, handlerCount, 20)
+	counterTime = timeDispatch(IRCd, users, handlerCount, 20)
+	print("{} handlers for {} channel members, only the last one connected: {:.2f}ms -> {:.2f}ms per dispatch".format(handlerCount, memberCount, scanTime, counterTime))
@@ -45,15 +45,14 @@ class IRCChannel(object):
 		if "conditionalTags" in kw:
 			conditionalTags = kw["conditionalTags"]
 			del kw["conditionalTags"]
+		lineCache = {} # Users receiving identical lines share the same formatted and encoded line
 		for user in userList:
+			tags = baseTags.copy() # The outgoingmessagetags action may modify the tags for each user
 			if conditionalTags:
-				tags = baseTags.copy()
 				addTags = user.filterConditionalTags(conditionalTags)
 				tags.update(addTags)
-			else:
-				tags = baseTags
 			kw["tags"] = tags
-			user.sendMessage(command, *params, **kw)
+			user.sendMessageWithLineCache(lineCache, command, *params, **kw)
 	
 	def sendServerMessage(self, command: str, *params: str, **kw: Any) -> None:
 		"""
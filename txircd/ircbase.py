@@ -1,8 +1,136 @@
+from twisted.internet import reactor
 from twisted.protocols.basic import LineOnlyReceiver
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Dict, List, Match, Optional, Tuple, Union
+import re
+
+_tagEscapeSequence = re.compile(r"\\(.?)", re.DOTALL)
+_tagKeyUncommonCharacter = re.compile(r"[^0-9A-Za-z\-/.]")
+_tagValueEscapedCharacter = re.compile(r"[\\; \r\n]")
+_tagUnescapes = {
+	"\\": "\\",
+	":": ";",
+	"r": "\r",
+	"n": "\n",
+	"s": " "
+}
+def _unescapeTagSequence(match: Match) -> str:
+	char = match.group(1)
+	return _tagUnescapes.get(char, char) # Unknown escapes become the escaped character; a trailing backslash is dropped
 
 class IRCBase(LineOnlyReceiver):
 	delimiter = b"\n" # Default to splitting by \n, and then we'll also split \r in the handler
+	_outputBuffer = None
+	_outputBufferSize = 0
+	_outputBufferFlushSize = 0
+	_outputIRCd = None
+	_outputPaused = False
+	_inputHeld = False
+	_sendQueue = None
+	_sendQueueSize = 0
+	_sendQueueLimit = 0
+	_sendQueueOverflowed = False
+	
+	def connectionMade(self) -> None:
+		# Register as a streaming producer so the transport tells us when its write buffer fills up
+		self.transport.registerProducer(self, True)
+	
+	def _setUpQueueLimits(self, sendQueueLimit: int, recvQueueLimit: int) -> None:
+		"""
+		Sets the sendq and recvq limits for this connection. The sendq limit is
+		the number of bytes that may be held for the connection while its
+		transport's write buffer is full, or 0 for no limit. The recvq limit is
+		the number of bytes of incoming data that may be held without a line
+		ending.
+		"""
+		self._sendQueueLimit = sendQueueLimit
+		self.MAX_LENGTH = recvQueueLimit
+	
+	def _setUpOutputBuffer(self, ircd: "IRCd") -> None:
+		"""
+		Enables per-tick output coalescing for this connection if it's enabled
+		in the configuration. Lines sent while coalescing is enabled are held
+		until the end of the current reactor iteration and written together.
+		The IRCd writes out held lines for all connections at once.
+		"""
+		if not ircd.config.get("output_coalesce", False):
+			return
+		self._outputBuffer = []
+		self._outputBufferSize = 0
+		self._outputBufferFlushSize = ircd.config.get("output_coalesce_flush_size", 16384)
+		self._outputIRCd = ircd
+	
+	def pauseProducing(self) -> None:
+		"""
+		Called by the transport when its write buffer is full. Output is held
+		in the sendq until the buffer drains, and we stop reading from the
+		connection in the meantime.
+		"""
+		if self._outputPaused:
+			return
+		self._outputPaused = True
+		self.transport.pauseProducing()
+	
+	def resumeProducing(self) -> None:
+		"""
+		Called by the transport when its write buffer has drained.
+		"""
+		if not self._outputPaused:
+			return
+		self._outputPaused = False
+		if self._sendQueue:
+			sendQueue = self._sendQueue
+			self._sendQueue = None
+			self._sendQueueSize = 0
+			self.transport.writeSequence(sendQueue)
+		if not self._outputPaused and not self._inputHeld: # Writing out the sendq may have filled the write buffer again
+			self.transport.resumeProducing()
+	
+	def stopProducing(self) -> None:
+		pass
+	
+	def holdInput(self) -> None:
+		"""
+		Stops reading from the connection until releaseInput is called.
+		"""
+		if self._inputHeld:
+			return
+		self._inputHeld = True
+		if self.transport:
+			self.transport.pauseProducing()
+	
+	def releaseInput(self) -> None:
+		"""
+		Starts reading from the connection again after holdInput.
+		"""
+		if not self._inputHeld:
+			return
+		self._inputHeld = False
+		if self.transport and not self._outputPaused:
+			self.transport.resumeProducing()
+	
+	def sendQueueSize(self) -> int:
+		"""
+		Returns the number of bytes currently held for this connection that
+		haven't been handed to the transport.
+		"""
+		return self._sendQueueSize + self._outputBufferSize
+	
+	def recvQueueSize(self) -> int:
+		"""
+		Returns the number of bytes received from this connection that haven't
+		been processed yet.
+		"""
+		return len(self._buffer)
+	
+	def lineLengthExceeded(self, line: bytes) -> None:
+		self._buffer = b""
+		self.recvQueueExceeded()
+	
+	def recvQueueExceeded(self) -> None:
+		"""
+		Called when the connection's recvq limit is exceeded.
+		"""
+		self.closeConnection()
 	
 	def lineReceived(self, data: bytes) -> None:
 		for lineRaw in data.split(b"\r"):
@@ -12,41 +140,63 @@ class IRCBase(LineOnlyReceiver):
 				self.handleCommand(command, params, prefix, tags)
 	
 	def _parseLine(self, line: str) -> Union[Tuple[str, List[str], str, Dict[str, Optional[str]]], Tuple[None, None, None, None]]:
-		line = line.replace("\0", "")
+		if "\0" in line:
+			line = line.replace("\0", "")
 		if not line:
 			return None, None, None, None
 		
+		if line[0] != "@" and line[0] != ":":
+			# Most lines from clients have no tags or prefix, so they only need to be split into parameters
+			linePart, hasLastParam, lastParam = line.partition(" :")
+			command, hasParams, paramLine = linePart.partition(" ")
+			if hasParams:
+				params = paramLine.split(" ")
+				if "" in params:
+					params = [param for param in params if param]
+			elif command:
+				params = []
+			else:
+				return None, None, None, None
+			if hasLastParam:
+				params.append(lastParam)
+			return command.upper(), params, None, {}
+		
+		# Walk the line once, tracking the start of the unparsed portion, rather than repeatedly splitting off copies
+		pos = 0
 		if line[0] == "@":
-			if " " not in line:
+			pos = line.find(" ")
+			if pos == -1:
 				return None, None, None, None
-			tagLine, line = line.split(" ", 1)
-			tags = self._parseTags(tagLine[1:])
+			tags = self._parseTags(line[1:pos])
+			pos += 1
 		else:
 			tags = {}
 		
 		prefix = None
-		if line[0] == ":":
-			if " " not in line:
+		if line.startswith(":", pos):
+			prefixEnd = line.find(" ", pos)
+			if prefixEnd == -1:
 				return None, None, None, None
-			prefix, line = line.split(" ", 1)
-			prefix = prefix[1:]
+			prefix = line[pos + 1:prefixEnd]
+			pos = prefixEnd + 1
 		
-		if " :" in line:
-			linePart, lastParam = line.split(" :", 1)
-		else:
-			linePart = line
+		lastParamPos = line.find(" :", pos)
+		if lastParamPos == -1:
+			linePart = line[pos:]
 			lastParam = None
+		else:
+			linePart = line[pos:lastParamPos]
+			lastParam = line[lastParamPos + 2:]
 		if not linePart:
 			return None, None, None, None
 		
-		if " " in linePart:
-			command, paramLine = linePart.split(" ", 1)
+		command, _, paramLine = linePart.partition(" ")
+		if paramLine:
 			params = paramLine.split(" ")
+			if "" in params:
+				params = [param for param in params if param]
 		else:
-			command = linePart
 			params = []
-		while "" in params:
-			params.remove("")
 		if lastParam is not None:
 			params.append(lastParam)
 		return command.upper(), params, prefix, tags
@@ -56,41 +206,22 @@ class IRCBase(LineOnlyReceiver):
 		for tagval in tagLine.split(";"):
 			if not tagval:
 				continue
-			if "=" in tagval:
-				tag, escapedValue = tagval.split("=", 1)
-				escaped = False
-				valueChars = []
-				for char in escapedValue:
-					if escaped:
-						if char == "\\":
-							valueChars.append("\\")
-						elif char == ":":
-							valueChars.append(";")
-						elif char == "r":
-							valueChars.append("\r")
-						elif char == "n":
-							valueChars.append("\n")
-						elif char == "s":
-							valueChars.append(" ")
-						else:
-							valueChars.append(char)
-						escaped = False
-						continue
-					if char == "\\":
-						escaped = True
-						continue
-					valueChars.append(char)
-				value = "".join(valueChars)
+			tag, hasValue, value = tagval.partition("=")
+			if not hasValue:
+				tags[tag] = None
+			elif "\\" in value:
+				tags[tag] = _tagEscapeSequence.sub(_unescapeTagSequence, value)
 			else:
-				tag = tagval
-				value = None
-			tags[tag] = value
+				tags[tag] = value
 		return tags
 	
 	def handleCommand(self, command: str, params: List[str], prefix: str, tags: Dict[str, Optional[str]]) -> None:
 		pass
 	
 	def sendMessage(self, command: str, *params: str, **kw: Any) -> None:
+		self.sendLine(self._formatMessage(command, *params, **kw))
+	
+	def _formatMessage(self, command: str, *params: str, **kw: Any) -> str:
 		if "tags" in kw:
 			tags = self._buildTagString(kw["tags"])
 		else:
@@ -122,22 +253,104 @@ class IRCBase(LineOnlyReceiver):
 		if prefix:
 			lineToSend += ":{} ".format(prefix)
 		lineToSend += "{} {}".format(command, " ".join(params))
-		self.sendLine(lineToSend.replace("\0", ""))
+		return lineToSend.replace("\0", "")
 	
 	def _buildTagString(self, tags: Dict[str, Optional[str]]) -> str:
 		tagList = []
 		for tag, value in tags.items():
-			for char in tag:
-				if not char.isalnum() and char not in ("-", "/", "."):
-					raise ValueError("Illegal character {!r} found in key {!r}".format(char, tag))
+			for uncommonCharacter in _tagKeyUncommonCharacter.finditer(tag):
+				if not uncommonCharacter.group(0).isalnum():
+					raise ValueError("Illegal character {!r} found in key {!r}".format(uncommonCharacter.group(0), tag))
 			if value is None:
 				tagList.append(tag)
 			else:
 				if "\0" in value:
 					raise ValueError("Illegal character '\\0' found in value for key {!r}".format(tag))
-				escapedValue = value.replace("\\", "\\\\").replace(";", "\\:").replace(" ", "\\s").replace("\r", "\\r").replace("\n", "\\n")
-				tagList.append("{}={}".format(tag, escapedValue))
+				if _tagValueEscapedCharacter.search(value):
+					value = value.replace("\\", "\\\\").replace(";", "\\:").replace(" ", "\\s").replace("\r", "\\r").replace("\n", "\\n")
+				tagList.append("{}={}".format(tag, value))
 		return ";".join(tagList)
 	
 	def sendLine(self, line: str) -> None:
-		self.transport.write("{}\r\n".format(line).encode("utf-8"))
\ No newline at end of file
+		self._sendLineData(line, self._encodeLine(line))
+	
+	def _encodeLine(self, line: str) -> bytes:
+		return "{}\r\n".format(line).encode("utf-8")
+	
+	def _sendLineData(self, line: str, data: bytes) -> None:
+		"""
+		Writes a line that's already been encoded for the wire. The line is
+		also provided in its unencoded form.
+		"""
+		if self._outputBuffer is None:
+			if self._outputPaused:
+				self._queueOutput([data], len(data))
+			else:
+				self.transport.write(data)
+			return
+		if not self._outputBuffer:
+			self._outputIRCd.markOutputDirty(self)
+		self._outputBuffer.append(data)
+		self._outputBufferSize += len(data)
+		if self._outputBufferSize >= self._outputBufferFlushSize:
+			self._flushOutputBuffer()
+	
+	def _flushOutputBuffer(self) -> None:
+		if not self._outputBuffer:
+			return
+		self._outputIRCd.markOutputClean(self)
+		outputBuffer = self._outputBuffer
+		outputBufferSize = self._outputBufferSize
+		self._outputBuffer = []
+		self._outputBufferSize = 0
+		if self._outputPaused:
+			self._queueOutput(outputBuffer, outputBufferSize)
+		else:
+			self.transport.writeSequence(outputBuffer)
+	
+	def _queueOutput(self, dataList: List[bytes], dataSize: int) -> None:
+		if self._sendQueueOverflowed:
+			return
+		if self._sendQueueLimit and self._sendQueueSize + dataSize > self._sendQueueLimit:
+			# Drop everything held for the connection rather than letting it grow any further.
+			# The disconnect is done later so that we don't modify any state in the middle of
+			# whatever is sending to this connection (e.g. a channel message to all of its users).
+			self._sendQueueOverflowed = True
+			self._sendQueue = None
+			self._sendQueueSize = 0
+			reactor.callLater(0, self.sendQueueExceeded)
+			return
+		if self._sendQueue is None:
+			self._sendQueue = []
+		self._sendQueue.extend(dataList)
+		self._sendQueueSize += dataSize
+	
+	def sendQueueExceeded(self) -> None:
+		"""
+		Called when the connection's sendq limit is exceeded.
+		"""
+		self.closeConnection()
+	
+	def flushOutput(self) -> None:
+		"""
+		Writes out any lines held by output coalescing or in the sendq,
+		regardless of whether the transport's write buffer is full. This must
+		be done before closing the connection so that held lines aren't lost.
+		"""
+		self._flushOutputBuffer()
+		if self._sendQueue:
+			sendQueue = self._sendQueue
+			self._sendQueue = None
+			self._sendQueueSize = 0
+			self.transport.writeSequence(sendQueue)
+	
+	def closeConnection(self) -> None:
+		"""
+		Writes out all held output and closes the connection.
+		"""
+		self.flushOutput()
+		self.transport.unregisterProducer()
+		if self._sendQueueOverflowed:
+			self.transport.abortConnection() # Don't wait on a connection that isn't reading what we send
+		else:
+			self.transport.loseConnection()
\ No newline at end of file
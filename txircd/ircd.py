@@ -5,15 +5,21 @@ from twisted.internet.endpoints import clientFromString, serverFromString
 from twisted.internet.task import LoopingCall
 from twisted.logger import FilteringLogObserver, globalLogPublisher, InvalidLogLevelError, LogLevel, LogLevelFilterPredicate, Logger
 from twisted.plugin import getPlugins
+from twisted.python.failure import Failure
 from twisted.python.rebuild import rebuild
 from txircd.config import Config, ConfigError, ConfigValidationError
 from txircd.factory import ServerConnectFactory, ServerListenFactory, UserFactory
 from txircd.module_interface import ICommand, IMode, IModuleData
+from txircd.resolver import HostResolver
+from txircd.storage import DataStorage, importShelveData, storageBackends
+from txircd.timer import TimerWheel
+from txircd.userindex import UserIndex
 from txircd.utils import CaseInsensitiveDictionary, lenBytes, ModeType, now, unescapeEndpointDescription
 from datetime import timedelta
-from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from functools import partial
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 from weakref import WeakValueDictionary
-import importlib, random, re, shelve, string, txircd.modules
+import dbm, heapq, importlib, os, random, re, string, txircd.modules
 
 class IRCd(Service):
 	def __init__(self, configFileName):
@@ -34,6 +40,10 @@ class IRCd(Service):
 		self.userModes = ({}, {}, {}, {})
 		self.userModeTypes = {}
 		self.actions = {}
+		self._actionDispatchPlans = {}
+		self._comboDispatchPlans = {}
+		self._actionModeIndex = {}
+		self._actionModeChecks = {}
 		self.storage = None
 		self.storageSyncer = None
 		self.dataCache = {}
@@ -48,7 +58,9 @@ class IRCd(Service):
 		self._uid = self._genUID()
 		
 		self.users = {}
+		self.userRemovalCount = 0
 		self.userNicks = CaseInsensitiveDictionary(WeakValueDictionary)
+		self.userIndex = UserIndex()
 		self.channels = CaseInsensitiveDictionary(WeakValueDictionary)
 		self.servers = {}
 		self.serverNames = CaseInsensitiveDictionary(WeakValueDictionary)
@@ -57,10 +69,14 @@ class IRCd(Service):
 		self.recentlyDestroyedChannels = CaseInsensitiveDictionary()
 		self.pruneRecentlyQuit = None
 		self.pruneRecentChannels = None
+		self._dirtyOutputConnections = set()
+		self._outputFlushCall = None
 		
 		self._logFilter = LogLevelFilterPredicate()
 		filterObserver = FilteringLogObserver(globalLogPublisher, (self._logFilter,))
 		self.log = Logger("txircd", observer=filterObserver)
+		self.timers = TimerWheel(self.log)
+		self.hostResolver = HostResolver(self)
 		
 		self.startupTime = None
 	
@@ -70,7 +86,7 @@ class IRCd(Service):
 		self.name = self.config["server_name"]
 		self.serverID = self.config["server_id"]
 		self.log.info("Loading storage...")
-		self.storage = shelve.open(self.config["datastore_path"], writeback=True)
+		self.storage = self._openStorage()
 		self.storageSyncer = LoopingCall(self._syncStorage)
 		self.storageSyncer.start(self.config.get("storage_sync_interval", 15), now=False)
 		self.log.info("Starting processes...")
@@ -102,14 +118,16 @@ class IRCd(Service):
 				for user in allUsers:
 					if user[:3] == server.serverID:
 						del self.users[user]
-				server.transport.loseConnection()
+						self.userRemovalCount += 1
+				server.closeConnection()
 		self.log.info("Disconnecting users...")
 		userList = list(self.users.values()) # Basically do the same thing I just did with the servers
 		self.users = {}
+		self.userRemovalCount += 1
 		for user in userList:
 			if user.transport:
 				stopDeferreds.append(user.disconnectedDeferred)
-				user.transport.loseConnection()
+				user.closeConnection()
 			if user.localOnly: # Keep LocalUsers so they exist in users and can be cleaned up appropriately by modules
 				self.users[user.uuid] = user
 		self.log.info("Unloading modules...")
@@ -295,6 +313,7 @@ class IRCd(Service):
 						break
 				else:
 					self.serverCommands[command].append(data)
+		self._clearActionCaches()
 		
 		self.log.debug("Module {module.name} is now fully loaded.", module=module)
 	
@@ -379,6 +398,7 @@ class IRCd(Service):
 			self.serverCommands[commandData[0]].remove((commandData[2], commandData[1]))
 			if not self.serverCommands[commandData[0]]:
 				del self.serverCommands[commandData[0]]
+		self._clearActionCaches()
 		
 		del self.loadedModules[moduleName]
 		del self._loadedModuleData[moduleName]
@@ -414,7 +434,7 @@ class IRCd(Service):
 			deferList.addErrback(self._logReloadModuleError, moduleName)
 		return deferList
 	
-	def _logReloadModuleError(self, failure: "Failure", moduleName: str) -> None:
+	def _logReloadModuleError(self, failure: Failure, moduleName: str) -> None:
 		self.log.critical("Module {moduleName} couldn't be reloaded! The server may be left in an unstable state; consider restarting. Error details: {failureError()}", moduleName=moduleName, failureError=failure.getErrorMessage)
 
 	def verifyConfig(self, config: Dict[str, Any]) -> None:
@@ -499,6 +519,10 @@ class IRCd(Service):
 						config["links"][desc]["out_password"] = str(server["out_password"])
 		if "datastore_path" not in config:
 			config["datastore_path"] = "data"
+		if "datastore_backend" not in config:
+			config["datastore_backend"] = "sqlite"
+		elif config["datastore_backend"] not in storageBackends:
+			raise ConfigValidationError("datastore_backend", "must be one of: {}".format(", ".join(storageBackends)))
 		if "storage_sync_interval" in config and not isinstance(config["storage_sync_interval"], int):
 			raise ConfigValidationError(config["storage_sync_interval"], "invalid number")
 
@@ -540,6 +564,12 @@ class IRCd(Service):
 			elif config["hostname_length"] < 4:
 				config["hostname_length"] = 4
 				self.logConfigValidationWarning("hostname_length", "value is too small", 4)
+		if "dns_cache_size" in config and (not isinstance(config["dns_cache_size"], int) or config["dns_cache_size"] < 0):
+			raise ConfigValidationError("dns_cache_size", "invalid number")
+		if "dns_cache_max_time" in config and (not isinstance(config["dns_cache_max_time"], int) or config["dns_cache_max_time"] < 0):
+			raise ConfigValidationError("dns_cache_max_time", "invalid number")
+		if "dns_negative_cache_time" in config and (not isinstance(config["dns_negative_cache_time"], int) or config["dns_negative_cache_time"] < 0):
+			raise ConfigValidationError("dns_negative_cache_time", "invalid number")
 		if "ident_length" in config:
 			if not isinstance(config["ident_length"], int) or config["ident_length"] < 0:
 				raise ConfigValidationError("ident_length", "invalid number")
@@ -575,6 +605,32 @@ class IRCd(Service):
 		if "server_ping_frequency" in config and (not isinstance(config["server_ping_frequency"], int) or config["server_ping_frequency"] < 0):
 			raise ConfigValidationError("server_ping_frequency", "invalid number")
 
+		# Connections
+		if "output_coalesce" in config and not isinstance(config["output_coalesce"], bool):
+			raise ConfigValidationError("output_coalesce", "value must be a boolean")
+		if "output_coalesce_flush_size" in config:
+			if not isinstance(config["output_coalesce_flush_size"], int) or config["output_coalesce_flush_size"] < 0:
+				raise ConfigValidationError("output_coalesce_flush_size", "invalid number")
+			elif config["output_coalesce_flush_size"] < 512:
+				config["output_coalesce_flush_size"] = 512
+				self.logConfigValidationWarning("output_coalesce_flush_size", "value is too small", 512)
+		if "user_sendq" in config and (not isinstance(config["user_sendq"], int) or config["user_sendq"] < 0):
+			raise ConfigValidationError("user_sendq", "invalid number")
+		if "user_recvq" in config:
+			if not isinstance(config["user_recvq"], int) or config["user_recvq"] < 0:
+				raise ConfigValidationError("user_recvq", "invalid number")
+			elif config["user_recvq"] < 8704:
+				config["user_recvq"] = 8704
+				self.logConfigValidationWarning("user_recvq", "value is too small to hold a full line with tags", 8704)
+		if "server_sendq" in config and (not isinstance(config["server_sendq"], int) or config["server_sendq"] < 0):
+			raise ConfigValidationError("server_sendq", "invalid number")
+		if "server_recvq" in config:
+			if not isinstance(config["server_recvq"], int) or config["server_recvq"] < 0:
+				raise ConfigValidationError("server_recvq", "invalid number")
+			elif config["server_recvq"] < 8704:
+				config["server_recvq"] = 8704
+				self.logConfigValidationWarning("server_recvq", "value is too small to hold a full line with tags", 8704)
+
 		for module in self.loadedModules.values():
 			module.verifyConfig(config)
 
@@ -636,10 +692,60 @@ class IRCd(Service):
 	def _logNotBound(self, err: str, desc: str) -> None:
 		self.log.error("Could not bind '{endpointDescription}': {errorMsg}", endpointDescription=desc, errorMsg=err)
 	
+	def _openStorage(self) -> DataStorage:
+		storagePath = self.config["datastore_path"]
+		backendName = self.config["datastore_backend"]
+		if backendName == "dbm":
+			return DataStorage(storageBackends[backendName](storagePath))
+		backendPath = "{}.{}".format(storagePath, backendName)
+		importOldData = not os.path.exists(backendPath) and bool(dbm.whichdb(storagePath))
+		storage = DataStorage(storageBackends[backendName](backendPath))
+		if importOldData:
+			self.log.info("Importing data from the old data file...")
+			keyCount = importShelveData(storage, storagePath)
+			self.log.info("Imported {keyCount} keys from the old data file; it can be removed once you've checked the imported data", keyCount=keyCount)
+		return storage
+	
 	def _syncStorage(self) -> None:
-		self.storage.sync()
+		syncDeferred = self.storage.syncInThread()
+		if syncDeferred is None:
+			self.log.debug("Skipping data storage sync because the previous sync is still running")
+			return
+		syncDeferred.addCallbacks(self._storageSynced, self._storageSyncFailed)
+	
+	def _storageSynced(self, result: None) -> None:
 		self.runActionStandard("updatestoragereferences")
 	
+	def _storageSyncFailed(self, failure: Failure) -> None:
+		self.log.failure("Failed to sync data storage", failure)
+	
+	def markOutputDirty(self, connection: "IRCBase") -> None:
+		"""
+		Adds a connection to the set of connections with coalesced output to
+		write at the end of the current reactor iteration.
+		"""
+		if not self._dirtyOutputConnections:
+			self._outputFlushCall = reactor.callLater(0, self._flushDirtyOutput)
+		self._dirtyOutputConnections.add(connection)
+	
+	def markOutputClean(self, connection: "IRCBase") -> None:
+		"""
+		Removes a connection whose coalesced output has been written from the
+		set of connections with output to write.
+		"""
+		self._dirtyOutputConnections.discard(connection)
+		if not self._dirtyOutputConnections and self._outputFlushCall is not None:
+			if self._outputFlushCall.active():
+				self._outputFlushCall.cancel()
+			self._outputFlushCall = None
+	
+	def _flushDirtyOutput(self) -> None:
+		self._outputFlushCall = None
+		dirtyConnections = self._dirtyOutputConnections
+		self._dirtyOutputConnections = set()
+		for connection in dirtyConnections:
+			connection._flushOutputBuffer()
+	
 	def createUUID(self) -> str:
 		"""
 		Gets the next UUID for a new client.
@@ -740,7 +846,7 @@ class IRCd(Service):
 			if server.nextClosest == self.serverID and server != fromServer:
 				server.sendMessage(command, *params, **kw)
 	
-	def _getActionModes(self, actionName: str, *params: Any, **kw: Any) -> List[Callable[["Mode", str, "IRCUser", str], Callable[[str], Any]]]:
+	def _getActionModes(self, actionName: str, *params: Any, **kw: Any) -> List[Tuple[Callable[..., Any], int]]:
 		users = []
 		channels = []
 		if "users" in kw:
@@ -749,87 +855,188 @@ class IRCd(Service):
 			channels = kw["channels"]
 		
 		functionList = []
+		if not users and not channels:
+			return functionList
+		userModeChecks, channelModeChecks = self._getActionModeChecks(actionName)
 		
 		if users:
-			genericUserActionName = "modeactioncheck-user-{}".format(actionName)
-			genericUserActionNameWithChannel = "modeactioncheck-user-withchannel-{}".format(actionName)
-			for modeType in self.userModes:
-				for mode, modeObj in modeType.items():
-					if actionName not in modeObj.affectedActions:
-						continue
-					priority = modeObj.affectedActions[actionName]
-					actionList = []
-					# Because Python doesn't properly capture variables in lambdas, we have to force static capture
-					# by wrapping lambdas in more lambdas.
-					# I wish Python wasn't this gross.
-					for action in self.actions.get("modeactioncheck-user", []):
-						actionList.append(((lambda action, actionName, mode: lambda user, *params: action[0](actionName, mode, user, *params))(action, actionName, mode), action[1]))
-					for action in self.actions.get("modeactioncheck-user-withchannel", []):
-						for channel in channels:
-							actionList.append(((lambda action, actionName, mode, channel: lambda user, *params: action[0](actionName, mode, user, channel, *params))(action, actionName, mode, channel), action[1]))
-					for action in self.actions.get(genericUserActionName, []):
-						actionList.append(((lambda action, mode: lambda user, *params: action[0](mode, user, *params))(action, mode), action[1]))
-					for action in self.actions.get(genericUserActionNameWithChannel, []):
-						for channel in channels:
-							actionList.append(((lambda action, mode, channel: lambda user, *params: action[0](mode, user, channel, *params))(action, mode, channel), action[1]))
-					modeUserActionName = "modeactioncheck-user-{}-{}".format(mode, actionName)
-					modeUserActionNameWithChannel = "modeactioncheck-user-withchannel-{}-{}".format(mode, actionName)
-					for action in self.actions.get(modeUserActionNameWithChannel, []):
-						for channel in channels:
-							actionList.append(((lambda action, channel: lambda user, *params: action[0](user, channel, *params))(action, channel), action[1]))
-					actionList = sorted(self.actions.get(modeUserActionName, []) + actionList, key=lambda action: action[1], reverse=True)
-					applyUsers = []
-					for user in users:
-						for action in actionList:
-							param = action[0](user, *params)
-							if param is not None:
-								if param is not False:
-									applyUsers.append((user, param))
-								break
-					for user, param in applyUsers:
-						functionList.append(((lambda modeObj, actionName, user, param: lambda *params: modeObj.apply(actionName, user, param, *params))(modeObj, actionName, user, param), priority))
+			for modeObj, priority, checkChain in userModeChecks:
+				applyUsers = []
+				for user in users:
+					param = self._findModeActionParam(checkChain, user, channels, params)
+					if param is not None and param is not False:
+						applyUsers.append((user, param))
+				for user, param in applyUsers:
+					functionList.append((partial(modeObj.apply, actionName, user, param), priority))
 		
 		if channels:
-			genericChannelActionName = "modeactioncheck-channel-{}".format(actionName)
-			genericChannelActionNameWithUser = "modeactioncheck-channel-withuser-{}".format(actionName)
-			for modeType in self.channelModes:
-				for mode, modeObj in modeType.items():
-					if actionName not in modeObj.affectedActions:
-						continue
-					priority = modeObj.affectedActions[actionName]
-					actionList = []
-					for action in self.actions.get("modeactioncheck-channel", []):
-						actionList.append(((lambda action, actionName, mode: lambda channel, *params: action[0](actionName, mode, channel, *params))(action, actionName, mode), action[1]))
-					for action in self.actions.get("modeactioncheck-channel-withuser", []):
-						for user in users:
-							actionList.append(((lambda action, actionName, mode, user: lambda channel, *params: action[0](actionName, mode, channel, user, *params))(action, actionName, mode, user), action[1]))
-					for action in self.actions.get(genericChannelActionName, []):
-						actionList.append(((lambda action, mode: lambda channel, *params: action[0](mode, channel, *params))(action, mode), action[1]))
-					for action in self.actions.get(genericChannelActionNameWithUser, []):
-						for user in users:
-							actionList.append(((lambda action, mode, user: lambda channel, *params: action[0](mode, channel, user, *params))(action, mode, user), action[1]))
-					modeChannelActionName = "modeactioncheck-channel-{}-{}".format(mode, actionName)
-					modeChannelActionNameWithUser = "modeactioncheck-channel-withuser-{}-{}".format(mode, actionName)
-					for action in self.actions.get(modeChannelActionNameWithUser, []):
-						for user in users:
-							actionList.append(((lambda action, user: lambda channel, *params: action[0](channel, user, *params))(action, user), action[1]))
-					actionList = sorted(self.actions.get(modeChannelActionName, []) + actionList, key=lambda action: action[1], reverse=True)
-					applyChannels = []
-					for channel in channels:
-						for action in actionList:
-							param = action[0](channel, *params)
-							if param is not None:
-								if param is not False:
-									applyChannels.append((channel, param))
-								break
-					for channel, param in applyChannels:
-						functionList.append(((lambda modeObj, actionName, channel, param: lambda *params: modeObj.apply(actionName, channel, param, *params))(modeObj, actionName, channel, param), priority))
+			for modeObj, priority, checkChain in channelModeChecks:
+				applyChannels = []
+				for channel in channels:
+					param = self._findModeActionParam(checkChain, channel, users, params)
+					if param is not None and param is not False:
+						applyChannels.append((channel, param))
+				for channel, param in applyChannels:
+					functionList.append((partial(modeObj.apply, actionName, channel, param), priority))
 		return functionList
 	
+	def _findModeActionParam(self, checkChain: Tuple[Tuple[Callable[..., Any], Tuple[str, ...], bool], ...], target: Union["IRCUser", "IRCChannel"], otherTargets: List[Union["IRCUser", "IRCChannel"]], params: Tuple[Any, ...]) -> Any:
+		"""
+		Runs a mode action check chain for a target, returning the first
+		non-None value returned by a check handler. Handlers that also take a
+		channel (for user modes) or user (for channel modes) are run once for
+		each of the other targets in order.
+		"""
+		for checkFunc, leadingParams, withOther in checkChain:
+			if withOther:
+				for otherTarget in otherTargets:
+					param = checkFunc(*leadingParams, target, otherTarget, *params)
+					if param is not None:
+						return param
+			else:
+				param = checkFunc(*leadingParams, target, *params)
+				if param is not None:
+					return param
+		return None
+	
+	def _getActionModeChecks(self, actionName: str) -> Tuple[Tuple[Tuple["Mode", int, Tuple[Tuple[Callable[..., Any], Tuple[str, ...], bool], ...]], ...], Tuple[Tuple["Mode", int, Tuple[Tuple[Callable[..., Any], Tuple[str, ...], bool], ...]], ...]]:
+		"""
+		Gets the user and channel modes affecting the given action along with
+		the priority-sorted check chain for each, building them if necessary.
+		Each check chain entry is a tuple of (function, leadingParams,
+		withOther).
+		"""
+		try:
+			return self._actionModeChecks[actionName]
+		except KeyError:
+			pass
+		if actionName not in self._actionModeIndex:
+			modeChecks = ((), ())
+		else:
+			userModes, channelModes = self._actionModeIndex[actionName]
+			userModeChecks = []
+			for mode, modeObj in userModes:
+				userModeChecks.append((modeObj, modeObj.affectedActions[actionName], self._buildModeCheckChain("user", "withchannel", actionName, mode)))
+			channelModeChecks = []
+			for mode, modeObj in channelModes:
+				channelModeChecks.append((modeObj, modeObj.affectedActions[actionName], self._buildModeCheckChain("channel", "withuser", actionName, mode)))
+			modeChecks = (tuple(userModeChecks), tuple(channelModeChecks))
+		self._actionModeChecks[actionName] = modeChecks
+		return modeChecks
+	
+	def _buildModeCheckChain(self, targetType: str, withOtherType: str, actionName: str, mode: str) -> Tuple[Tuple[Callable[..., Any], Tuple[str, ...], bool], ...]:
+		checkPrefix = "modeactioncheck-{}".format(targetType)
+		checkPrefixWithOther = "modeactioncheck-{}-{}".format(targetType, withOtherType)
+		# Order matters here: it sets which handler wins between handlers of the same priority.
+		checkList = []
+		for action in self.actions.get("{}-{}-{}".format(checkPrefix, mode, actionName), []):
+			checkList.append(((action[0], (), False), action[1]))
+		for action in self.actions.get(checkPrefix, []):
+			checkList.append(((action[0], (actionName, mode), False), action[1]))
+		for action in self.actions.get(checkPrefixWithOther, []):
+			checkList.append(((action[0], (actionName, mode), True), action[1]))
+		for action in self.actions.get("{}-{}".format(checkPrefix, actionName), []):
+			checkList.append(((action[0], (mode,), False), action[1]))
+		for action in self.actions.get("{}-{}".format(checkPrefixWithOther, actionName), []):
+			checkList.append(((action[0], (mode,), True), action[1]))
+		for action in self.actions.get("{}-{}-{}".format(checkPrefixWithOther, mode, actionName), []):
+			checkList.append(((action[0], (), True), action[1]))
+		checkList.sort(key=lambda check: check[1], reverse=True)
+		return tuple(check[0] for check in checkList)
+	
+	def _buildActionModeIndex(self) -> Dict[str, Tuple[List[Tuple[str, "Mode"]], List[Tuple[str, "Mode"]]]]:
+		"""
+		Builds an index mapping action names to the user modes and channel
+		modes affecting that action.
+		"""
+		modeIndex = {}
+		for modeType in self.userModes:
+			for mode, modeObj in modeType.items():
+				for actionName in modeObj.affectedActions:
+					if actionName not in modeIndex:
+						modeIndex[actionName] = ([], [])
+					modeIndex[actionName][0].append((mode, modeObj))
+		for modeType in self.channelModes:
+			for mode, modeObj in modeType.items():
+				for actionName in modeObj.affectedActions:
+					if actionName not in modeIndex:
+						modeIndex[actionName] = ([], [])
+					modeIndex[actionName][1].append((mode, modeObj))
+		return modeIndex
+	
+	def _clearActionCaches(self) -> None:
+		"""
+		Drops all cached action dispatch data. Must be called whenever the
+		actions or modes known to the IRCd change.
+		"""
+		self._actionDispatchPlans = {}
+		self._comboDispatchPlans = {}
+		self._actionModeIndex = self._buildActionModeIndex()
+		self._actionModeChecks = {}
+	
+	def _getActionDispatchPlan(self, actionName: str) -> Tuple[Tuple[Callable[..., Any], int], ...]:
+		"""
+		Gets the cached dispatch plan for an action, building it if necessary.
+		The plan is the priority-sorted tuple of handlers registered for the
+		action; mode handlers are merged into it at dispatch time.
+		"""
+		try:
+			return self._actionDispatchPlans[actionName]
+		except KeyError:
+			pass
+		plan = tuple(self.actions.get(actionName, [])) # self.actions lists are kept in priority order as modules load
+		self._actionDispatchPlans[actionName] = plan
+		return plan
+	
 	def _getActionFunctionList(self, actionName: str, *params: Any, **kw: Any) -> List[Tuple[Callable[..., Any], int]]:
-		functionList = self.actions.get(actionName, [])
-		functionList = functionList + self._getActionModes(actionName, *params, **kw)
-		return sorted(functionList, key=lambda action: action[1], reverse=True)
+		handlers = self._getActionDispatchPlan(actionName)
+		modeFunctions = self._getActionModes(actionName, *params, **kw)
+		if not modeFunctions:
+			return handlers
+		return self._mergeActionModeFunctions(handlers, modeFunctions)
+	
+	def _mergeActionModeFunctions(self, handlers: Tuple[Tuple[Callable[..., Any], int], ...], modeFunctions: List[Tuple[Callable[..., Any], int]]) -> List[Tuple[Callable[..., Any], int]]:
+		modeFunctions.sort(key=lambda action: action[1], reverse=True)
+		# heapq.merge favors earlier iterables on ties, so registered handlers keep running before mode handlers of equal priority
+		return list(heapq.merge(handlers, modeFunctions, key=lambda action: action[1], reverse=True))
+	
+	def _getComboActionFunctionList(self, actionParameters: Dict[str, List[Any]], **kw: Any) -> List[Tuple[str, Callable[..., Any]]]:
+		"""
+		Gets the combined function list for a combo action given a dict
+		mapping action names to their parameters.
+		When no mode handlers apply, the cached combination of the registered
+		handlers is used.
+		"""
+		actionModeFunctions = {}
+		for actionName, parameters in actionParameters.items():
+			modeFunctions = self._getActionModes(actionName, *parameters, **kw)
+			if modeFunctions:
+				actionModeFunctions[actionName] = modeFunctions
+		if not actionModeFunctions:
+			return self._getComboDispatchPlan(tuple(actionParameters.keys()))
+		actionFuncLists = {}
+		for actionName in actionParameters.keys():
+			handlers = self._getActionDispatchPlan(actionName)
+			if actionName in actionModeFunctions:
+				handlers = self._mergeActionModeFunctions(handlers, actionModeFunctions[actionName])
+			actionFuncLists[actionName] = handlers
+		return self._combineActionFunctionLists(actionFuncLists)
+	
+	def _getComboDispatchPlan(self, actionNames: Tuple[str, ...]) -> Tuple[Tuple[str, Callable[..., Any]], ...]:
+		"""
+		Gets the cached combined list of registered handlers for the given
+		combination of actions, building it if necessary.
+		"""
+		try:
+			return self._comboDispatchPlans[actionNames]
+		except KeyError:
+			pass
+		actionFuncLists = {}
+		for actionName in actionNames:
+			actionFuncLists[actionName] = self._getActionDispatchPlan(actionName)
+		plan = tuple(self._combineActionFunctionLists(actionFuncLists))
+		self._comboDispatchPlans[actionNames] = plan
+		return plan
 	
 	def _combineActionFunctionLists(self, actionLists: Dict[str, List[Tuple[Callable[..., Any], int]]]) -> List[Tuple[str, Callable[..., Any]]]:
 		"""
@@ -837,21 +1044,15 @@ class IRCd(Service):
 		Assumes all lists are sorted.
 		Takes a dict mapping action names to their action function lists.
 		Returns a list in priority order (highest to lowest) of (actionName, function) tuples.
+		For functions of the same priority, functions from actions later in the
+		dict come first.
 		"""
-		fullActionList = []
+		namedActionLists = []
 		for actionName, actionList in actionLists.items():
-			insertPos = 0
-			for action in actionList:
-				try:
-					while fullActionList[insertPos][2] > action[1]:
-						insertPos += 1
-					fullActionList.insert(insertPos, (actionName, action[0], action[1]))
-				except IndexError:
-					fullActionList.append((actionName, action[0], action[1]))
-				insertPos += 1
-		for index, actionData in enumerate(fullActionList):
-			fullActionList[index] = (actionData[0], actionData[1]) # The priority isn't important for the return value
-		return fullActionList
+			namedActionLists.append([(actionName, action[0], action[1]) for action in actionList])
+		namedActionLists.reverse() # heapq.merge favors earlier iterables on ties
+		# The priority isn't important for the return value
+		return [(actionData[0], actionData[1]) for actionData in heapq.merge(*namedActionLists, key=lambda actionData: actionData[2], reverse=True)]
 	
 	def runActionStandard(self, actionName: str, *params: Any, **kw: Any) -> None:
 		"""
@@ -860,9 +1061,10 @@ class IRCd(Service):
 		determine which mode handlers should be included.
 		"""
 		actionList = self._getActionFunctionList(actionName, *params, **kw)
+		stopState = self._actionStopState(kw)
 		for action in actionList:
 			action[0](*params)
-			if self._shouldStopAction(actionName, params, kw):
+			if self._shouldStopAction(stopState):
 				break
 	
 	def runActionUntilTrue(self, actionName: str, *params: Any, **kw: Any) -> bool:
@@ -874,10 +1076,11 @@ class IRCd(Service):
 		included.
 		"""
 		actionList = self._getActionFunctionList(actionName, *params, **kw)
+		stopState = self._actionStopState(kw)
 		for action in actionList:
 			if action[0](*params):
 				return True
-			if self._shouldStopAction(actionName, params, kw):
+			if self._shouldStopAction(stopState):
 				break
 		return False
 	
@@ -890,10 +1093,11 @@ class IRCd(Service):
 		included.
 		"""
 		actionList = self._getActionFunctionList(actionName, *params, **kw)
+		stopState = self._actionStopState(kw)
 		for action in actionList:
 			if not action[0](*params):
 				return True
-			if self._shouldStopAction(actionName, params, kw):
+			if self._shouldStopAction(stopState):
 				break
 		return False
 	
@@ -906,11 +1110,12 @@ class IRCd(Service):
 		handlers should be included.
 		"""
 		actionList = self._getActionFunctionList(actionName, *params, **kw)
+		stopState = self._actionStopState(kw)
 		for action in actionList:
 			value = action[0](*params)
 			if value is not None:
 				return value
-			if self._shouldStopAction(actionName, params, kw):
+			if self._shouldStopAction(stopState):
 				break
 		return None
 	
@@ -923,10 +1128,11 @@ class IRCd(Service):
 		"""
 		oneIsTrue = False
 		actionList = self._getActionFunctionList(actionName, *params, **kw)
+		stopState = self._actionStopState(kw)
 		for action in actionList:
 			if action[0](*params):
 				oneIsTrue = True
-			if self._shouldStopAction(actionName, params, kw):
+			if self._shouldStopAction(stopState):
 				break
 		return oneIsTrue
 	
@@ -939,10 +1145,11 @@ class IRCd(Service):
 		"""
 		oneIsFalse = False
 		actionList = self._getActionFunctionList(actionName, *params, **kw)
+		stopState = self._actionStopState(kw)
 		for action in actionList:
 			if action[0](*params):
 				oneIsFalse = True
-			if self._shouldStopAction(actionName, params, kw):
+			if self._shouldStopAction(stopState):
 				break
 		return oneIsFalse
 	
@@ -954,11 +1161,12 @@ class IRCd(Service):
 		arguments to determine which mode handlers should be included.
 		"""
 		actionList = self._getActionFunctionList(actionName, data, *params, **kw)
+		stopState = self._actionStopState(kw)
 		for action in actionList:
 			action[0](data, *params)
 			if not data:
 				break
-			if self._shouldStopAction(actionName, [data] + list(params), kw):
+			if self._shouldStopAction(stopState):
 				break
 	
 	def runActionProcessingMultiple(self, actionName: str, dataList: List[Any], *params: Any, **kw: Any) -> None:
@@ -971,6 +1179,7 @@ class IRCd(Service):
 		"""
 		paramList = dataList + list(params)
 		actionList = self._getActionFunctionList(actionName, *paramList, **kw)
+		stopState = self._actionStopState(kw)
 		for action in actionList:
 			action[0](*paramList)
 			for data in dataList:
@@ -978,7 +1187,7 @@ class IRCd(Service):
 					break
 			else:
 				break
-			if self._shouldStopAction(actionName, paramList, kw):
+			if self._shouldStopAction(stopState):
 				break
 	
 	def runComboActionStandard(self, actionList: List[Tuple[str, Tuple[Any, ...]]], **kw: Any) -> None:
@@ -989,16 +1198,14 @@ class IRCd(Service):
 		Accepts 'users' and 'channels' keyword arguments to determine which
 		mode handlers should be included.
 		"""
-		actionFuncLists = {}
 		actionParameters = {}
 		for action in actionList:
-			parameters = action[1]
-			actionParameters[action[0]] = parameters
-			actionFuncLists[action[0]] = self._getActionFunctionList(action[0], *parameters, **kw)
-		funcList = self._combineActionFunctionLists(actionFuncLists)
+			actionParameters[action[0]] = action[1]
+		funcList = self._getComboActionFunctionList(actionParameters, **kw)
+		stopState = self._actionStopState(kw)
 		for actionName, actionFunc in funcList:
 			actionFunc(*actionParameters[actionName])
-			if self._shouldStopAction(actionName, actionParameters, kw):
+			if self._shouldStopAction(stopState):
 				break
 	
 	def runComboActionUntilTrue(self, actionList: List[Tuple[str, Tuple[Any, ...]]], **kw: Any) -> bool:
@@ -1011,17 +1218,15 @@ class IRCd(Service):
 		'users' and 'channels' keyword arguments to determine which mode
 		handlers should be included.
 		"""
-		actionFuncLists = {}
 		actionParameters = {}
 		for action in actionList:
-			parameters = action[1]
-			actionParameters[action[0]] = parameters
-			actionFuncLists[action[0]] = self._getActionFunctionList(action[0], *parameters, **kw)
-		funcList = self._combineActionFunctionLists(actionFuncLists)
+			actionParameters[action[0]] = action[1]
+		funcList = self._getComboActionFunctionList(actionParameters, **kw)
+		stopState = self._actionStopState(kw)
 		for actionName, actionFunc in funcList:
 			if actionFunc(*actionParameters[actionName]):
 				return True
-			if self._shouldStopAction(actionName, actionParameters, kw):
+			if self._shouldStopAction(stopState):
 				break
 		return False
 	
@@ -1035,17 +1240,15 @@ class IRCd(Service):
 		'users' and 'channels' keyword arguments to determine which mode
 		handlers should be included.
 		"""
-		actionFuncLists = {}
 		actionParameters = {}
 		for action in actionList:
-			parameters = action[1]
-			actionParameters[action[0]] = parameters
-			actionFuncLists[action[0]] = self._getActionFunctionList(action[0], *parameters, **kw)
-		funcList = self._combineActionFunctionLists(actionFuncLists)
+			actionParameters[action[0]] = action[1]
+		funcList = self._getComboActionFunctionList(actionParameters, **kw)
+		stopState = self._actionStopState(kw)
 		for actionName, actionFunc in funcList:
 			if not actionFunc(*actionParameters[actionName]):
 				return True
-			if self._shouldStopAction(actionName, actionParameters, kw):
+			if self._shouldStopAction(stopState):
 				break
 		return False
 	
@@ -1059,18 +1262,16 @@ class IRCd(Service):
 		value. Accepts 'users' and 'channels' keyword arguments to determine
 		which mode handlers should be included.
 		"""
-		actionFuncLists = {}
 		actionParameters = {}
 		for action in actionList:
-			parameters = action[1]
-			actionParameters[action[0]] = parameters
-			actionFuncLists[action[0]] = self._getActionFunctionList(action[0], *parameters, **kw)
-		funcList = self._combineActionFunctionLists(actionFuncLists)
+			actionParameters[action[0]] = action[1]
+		funcList = self._getComboActionFunctionList(actionParameters, **kw)
+		stopState = self._actionStopState(kw)
 		for actionName, actionFunc in funcList:
 			value = actionFunc(*actionParameters[actionName])
 			if value is not None:
 				return value
-			if self._shouldStopAction(actionName, actionParameters, kw):
+			if self._shouldStopAction(stopState):
 				break
 		return None
 	
@@ -1083,18 +1284,16 @@ class IRCd(Service):
 		Accepts 'users' and 'channels' keyword arguments to determine which
 		mode handlers should be included.
 		"""
-		actionFuncLists = {}
 		actionParameters = {}
 		for action in actionList:
-			parameters = action[1]
-			actionParameters[action[0]] = parameters
-			actionFuncLists[action[0]] = self._getActionFunctionList(action[0], *parameters, **kw)
-		funcList = self._combineActionFunctionLists(actionFuncLists)
+			actionParameters[action[0]] = action[1]
+		funcList = self._getComboActionFunctionList(actionParameters, **kw)
+		stopState = self._actionStopState(kw)
 		oneIsTrue = False
 		for actionName, actionFunc in funcList:
 			if actionFunc(*actionParameters[actionName]):
 				oneIsTrue = True
-			if self._shouldStopAction(self, actionName, actionParameters, kw):
+			if self._shouldStopAction(stopState):
 				break
 		return oneIsTrue
 	
@@ -1107,18 +1306,16 @@ class IRCd(Service):
 		Accepts 'users' and 'channels' keyword arguments to determine which
 		mode handlers should be included.
 		"""
-		actionFuncLists = {}
 		actionParameters = {}
 		for action in actionList:
-			parameters = action[1]
-			actionParameters[action[0]] = parameters
-			actionFuncLists[action[0]] = self._getActionFunctionList(action[0], *parameters, **kw)
-		funcList = self._combineActionFunctionLists(actionFuncLists)
+			actionParameters[action[0]] = action[1]
+		funcList = self._getComboActionFunctionList(actionParameters, **kw)
+		stopState = self._actionStopState(kw)
 		oneIsFalse = False
 		for actionName, actionFunc in funcList:
 			if not actionFunc(*actionParameters[actionName]):
 				oneIsFalse = True
-			if self._shouldStopAction(self, actionName, actionParameters, kw):
+			if self._shouldStopAction(stopState):
 				break
 		return oneIsFalse
 	
@@ -1131,18 +1328,16 @@ class IRCd(Service):
 		Accepts 'users' and 'channels' keyword arguments to determine which
 		mode handlers should be included.
 		"""
-		actionFuncLists = {}
 		actionParameters = {}
 		for action in actionList:
-			parameters = [data] + list(action[1])
-			actionParameters[action[0]] = parameters
-			actionFuncLists[action[0]] = self._getActionFunctionList(action[0], *parameters, **kw)
-		funcList = self._combineActionFunctionLists(actionFuncLists)
+			actionParameters[action[0]] = [data] + list(action[1])
+		funcList = self._getComboActionFunctionList(actionParameters, **kw)
+		stopState = self._actionStopState(kw)
 		for actionName, actionFunc in funcList:
 			actionFunc(*actionParameters[actionName])
 			if not data:
 				break
-			if self._shouldStopAction(actionName, actionParameters, kw):
+			if self._shouldStopAction(stopState):
 				break
 	
 	def runComboActionProcessingMultiple(self, dataList: List[Any], actionList: List[Tuple[str, Tuple[Any, ...]]], **kw: Any) -> None:
@@ -1155,13 +1350,11 @@ class IRCd(Service):
 		Accepts 'users' and 'channels' keyword arguments to determine which
 		mode handlers should be included.
 		"""
-		actionFuncLists = {}
 		actionParameters = {}
 		for action in actionList:
-			parameters = dataList + list(action[1])
-			actionParameters[action[0]] = parameters
-			actionFuncLists[action[0]] = self._getActionFunctionList(action[0], *parameters, **kw)
-		funcList = self._combineActionFunctionLists(actionFuncLists)
+			actionParameters[action[0]] = dataList + list(action[1])
+		funcList = self._getComboActionFunctionList(actionParameters, **kw)
+		stopState = self._actionStopState(kw)
 		for actionName, actionFunc in funcList:
 			actionFunc(*actionParameters[actionName])
 			for data in dataList:
@@ -1169,19 +1362,38 @@ class IRCd(Service):
 					break
 			else:
 				break
-			if self._shouldStopAction(actionName, actionParameters, kw):
+			if self._shouldStopAction(stopState):
 				break
 	
-	def _shouldStopAction(self, actionName: str, parameters: List[Any], keywords: Dict[str, Any]) -> bool:
+	def _actionStopState(self, keywords: Dict[str, Any]) -> Optional[List[Any]]:
+		"""
+		Gets the state used by _shouldStopAction to track whether all users
+		for an action have disconnected, or None if the action should never be
+		stopped early.
+		The state is a list of [userRemovalCount, users, liveUser], where
+		liveUser is the last user known to still be connected.
+		"""
 		if "allowDisconnected" in keywords and keywords["allowDisconnected"]:
-			return False
+			return None
 		if "users" in keywords and keywords["users"]:
-			# Stop an action if all users have disconnected
-			for user in keywords["users"]:
-				if user.uuid in self.users:
-					return False
-			return True
-		return False
+			return [None, keywords["users"], None]
+		return None
+	
+	def _shouldStopAction(self, stopState: Optional[List[Any]]) -> bool:
+		if stopState is None:
+			return False
+		if stopState[0] == self.userRemovalCount:
+			return False # Nobody has disconnected since the last check found a connected user
+		stopState[0] = self.userRemovalCount
+		liveUser = stopState[2]
+		if liveUser is not None and liveUser.uuid in self.users:
+			return False
+		# Stop an action if all users have disconnected
+		for user in stopState[1]:
+			if user.uuid in self.users:
+				stopState[2] = user
+				return False
+		return True
 
 class ModuleLoadError(Exception):
 	def __init__(self, name, desc):
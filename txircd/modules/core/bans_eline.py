@@ -4,7 +4,6 @@ from txircd.module_interface import Command, ICommand, IModuleData, ModuleData
 from txircd.modules.xlinebase import XLineBase
 from txircd.utils import durationToSeconds, ipAddressToShow, ircLower, now
 from zope.interface import implementer
-from fnmatch import fnmatchcase
 from typing import Any, Callable, Dict, List, Optional, Tuple
 
 @implementer(IPlugin, IModuleData)
@@ -29,18 +28,13 @@ class ELine(ModuleData, XLineBase):
 	def load(self) -> None:
 		self.initializeLineStorage()
 	
-	def checkUserMatch(self, user: "IRCUser", mask: str, data: Optional[Dict[Any, Any]]) -> bool:
-		exceptMask = ircLower(mask)
-		userMask = ircLower("{}@{}".format(user.ident, user.host()))
-		if fnmatchcase(userMask, exceptMask):
-			return True
-		userMask = ircLower("{}@{}".format(user.ident, user.realHost))
-		if fnmatchcase(userMask, exceptMask):
-			return True
-		userMask = ircLower("{}@{}".format(user.ident, ipAddressToShow(user.ip)))
-		if fnmatchcase(userMask, exceptMask):
-			return True
-		return False
+	def unload(self) -> Optional["Deferred"]:
+		self.stopUserSweep()
+	
+	def userMatchStrings(self, user: "IRCUser", data: Optional[Dict[Any, Any]]) -> Optional[List[str]]:
+		return [ ircLower("{}@{}".format(user.ident, user.host())),
+		         ircLower("{}@{}".format(user.ident, user.realHost)),
+		         ircLower("{}@{}".format(user.ident, ipAddressToShow(user.ip))) ]
 	
 	def checkException(self, lineType: str, user: "IRCUser", mask: str, data: Optional[Dict[Any, Any]]) -> Optional[bool]:
 		if lineType == "E":
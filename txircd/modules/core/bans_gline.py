@@ -5,7 +5,6 @@ from txircd.module_interface import Command, ICommand, IModuleData, ModuleData
 from txircd.modules.xlinebase import XLineBase
 from txircd.utils import durationToSeconds, ipAddressToShow, ircLower, now
 from zope.interface import implementer
-from fnmatch import fnmatchcase
 from typing import Any, Dict, Callable, List, Optional, Tuple
 
 @implementer(IPlugin, IModuleData)
@@ -32,22 +31,23 @@ class GLine(ModuleData, XLineBase):
 	def load(self) -> None:
 		self.initializeLineStorage()
 
+	def unload(self) -> Optional["Deferred"]:
+		self.stopUserSweep()
+
 	def verifyConfig(self, config: Dict[str, Any]) -> None:
 		if "client_ban_msg" in config and not isinstance(config["client_ban_msg"], str):
 			raise ConfigValidationError("client_ban_msg", "value must be a string")
 	
-	def checkUserMatch(self, user: "IRCUser", mask: str, data: Optional[Dict[Any, Any]]) -> bool:
-		banMask = self.normalizeMask(mask)
-		userMask = ircLower("{}@{}".format(user.ident, user.host()))
-		if fnmatchcase(userMask, banMask):
-			return True
-		userMask = ircLower("{}@{}".format(user.ident, user.realHost))
-		if fnmatchcase(userMask, banMask):
-			return True
-		userMask = ircLower("{}@{}".format(user.ident, ipAddressToShow(user.ip)))
-		if fnmatchcase(userMask, banMask):
-			return True
-		return False
+	def userMatchStrings(self, user: "IRCUser", data: Optional[Dict[Any, Any]]) -> Optional[List[str]]:
+		return [ ircLower("{}@{}".format(user.ident, user.host())),
+		         ircLower("{}@{}".format(user.ident, user.realHost)),
+		         ircLower("{}@{}".format(user.ident, ipAddressToShow(user.ip))) ]
+	
+	def candidateUsers(self, normalMask: str) -> Optional[List["IRCUser"]]:
+		return self.hostmaskCandidateUsers(normalMask)
+	
+	def handleMatchedUser(self, user: "IRCUser", reason: str) -> None:
+		self.killUser(user, reason)
 	
 	def killUser(self, user: "IRCUser", reason: str) -> None:
 		self.ircd.log.info("Matched user {user.uuid} ({user.ident}@{userHost()}) against a g:line: {reason}", user=user, userHost=user.host, reason=reason)
@@ -107,13 +107,7 @@ class UserGLine(Command):
 			if not self.module.addLine(banmask, now(), data["duration"], user.hostmask(), data["reason"]):
 				user.sendMessage("NOTICE", "*** G:Line for {} is already set.".format(banmask))
 				return True
-			badUsers = []
-			for checkUser in self.module.ircd.users.values():
-				reason = self.module.matchUser(checkUser)
-				if reason is not None:
-					badUsers.append((checkUser, reason))
-			for badUser in badUsers:
-				self.module.killUser(*badUser)
+			self.module.enforceLine(banmask)
 			if data["duration"] > 0:
 				user.sendMessage("NOTICE", "*** Timed g:line for {} has been set, to expire in {} seconds.".format(banmask, data["duration"]))
 			else:
@@ -136,13 +130,7 @@ class ServerAddGLine(Command):
 	
 	def execute(self, server: "IRCServer", data: Dict[Any, Any]) -> bool:
 		if self.module.executeServerAddCommand(server, data):
-			badUsers = []
-			for user in self.module.ircd.users.values():
-				reason = self.module.matchUser(user)
-				if reason is not None:
-					badUsers.append((user, reason))
-			for user in badUsers:
-				self.module.killUser(*user)
+			self.module.enforceLine(data["mask"])
 			return True
 		return False
 
@@ -5,7 +5,6 @@ from txircd.module_interface import Command, ICommand, IModuleData, ModuleData
 from txircd.modules.xlinebase import XLineBase
 from txircd.utils import durationToSeconds, ipAddressToShow, ircLower, now
 from zope.interface import implementer
-from fnmatch import fnmatchcase
 from typing import Any, Callable, Dict, List, Optional, Tuple
 
 @implementer(IPlugin, IModuleData, ICommand)
@@ -29,22 +28,23 @@ class KLine(ModuleData, Command, XLineBase):
 	def load(self) -> None:
 		self.initializeLineStorage()
 
+	def unload(self) -> Optional["Deferred"]:
+		self.stopUserSweep()
+
 	def verifyConfig(self, config: Dict[str, Any]) -> None:
 		if "client_ban_msg" in config and not isinstance(config["client_ban_msg"], str):
 			raise ConfigValidationError("client_ban_msg", "value must be a string")
 	
-	def checkUserMatch(self, user: "IRCUser", mask: str, data: Optional[Dict[Any, Any]]) -> bool:
-		banMask = self.normalizeMask(mask)
-		userMask = ircLower("{}@{}".format(user.ident, user.host()))
-		if fnmatchcase(userMask, banMask):
-			return True
-		userMask = ircLower("{}@{}".format(user.ident, user.realHost))
-		if fnmatchcase(userMask, banMask):
-			return True
-		userMask = ircLower("{}@{}".format(user.ident, ipAddressToShow(user.ip)))
-		if fnmatchcase(userMask, banMask):
-			return True
-		return False
+	def userMatchStrings(self, user: "IRCUser", data: Optional[Dict[Any, Any]]) -> Optional[List[str]]:
+		return [ ircLower("{}@{}".format(user.ident, user.host())),
+		         ircLower("{}@{}".format(user.ident, user.realHost)),
+		         ircLower("{}@{}".format(user.ident, ipAddressToShow(user.ip))) ]
+	
+	def candidateUsers(self, normalMask: str) -> Optional[List["IRCUser"]]:
+		return self.hostmaskCandidateUsers(normalMask)
+	
+	def handleMatchedUser(self, user: "IRCUser", reason: str) -> None:
+		self.killUser(user, reason)
 	
 	def killUser(self, user: "IRCUser", reason: str) -> None:
 		self.ircd.log.info("Matched user {user.uuid} ({user.ident}@{userHost()}) against a k:line: {reason}", user=user, userHost=user.host, reason=reason)
@@ -99,13 +99,7 @@ class KLine(ModuleData, Command, XLineBase):
 			if not self.addLine(banmask, now(), data["duration"], user.hostmask(), data["reason"]):
 				user.sendMessage("NOTICE", "*** K:Line for {} is already set.".format(banmask))
 				return True
-			badUsers = []
-			for checkUser in self.ircd.users.values():
-				reason = self.matchUser(checkUser)
-				if reason is not None:
-					badUsers.append((checkUser, reason))
-			for badUser in badUsers:
-				self.killUser(*badUser)
+			self.enforceLine(banmask)
 			if data["duration"] > 0:
 				user.sendMessage("NOTICE", "*** Timed k:line for {} has been set, to expire in {} seconds.".format(banmask, data["duration"]))
 			else:
@@ -5,7 +5,6 @@ from txircd.module_interface import Command, ICommand, IModuleData, ModuleData
 from txircd.modules.xlinebase import XLineBase
 from txircd.utils import durationToSeconds, ircLower, now
 from zope.interface import implementer
-from fnmatch import fnmatchcase
 from typing import Any, Callable, Dict, List, Optional, Tuple
 
 @implementer(IPlugin, IModuleData)
@@ -32,14 +31,30 @@ class QLine(ModuleData, XLineBase):
 	def load(self) -> None:
 		self.initializeLineStorage()
 
+	def unload(self) -> Optional["Deferred"]:
+		self.stopUserSweep()
+
 	def verifyConfig(self, config: Dict[str, Any]) -> None:
 		if "client_ban_msg" in config and not isinstance(config["client_ban_msg"], str):
 			raise ConfigValidationError("client_ban_msg", "value must be a string")
 	
-	def checkUserMatch(self, user: "IRCUser", mask: str, data: Optional[Dict[Any, Any]]) -> bool:
+	def userMatchStrings(self, user: "IRCUser", data: Optional[Dict[Any, Any]]) -> Optional[List[str]]:
 		if data and "newnick" in data:
-			return fnmatchcase(ircLower(data["newnick"]), ircLower(mask))
-		return fnmatchcase(ircLower(user.nick), ircLower(mask))
+			return [ircLower(data["newnick"])]
+		if user.nick is None:
+			return []
+		return [ircLower(user.nick)]
+	
+	def candidateUsers(self, normalMask: str) -> Optional[List["IRCUser"]]:
+		if "*" in normalMask or "?" in normalMask or "[" in normalMask:
+			return None
+		if normalMask in self.ircd.userNicks:
+			return [self.ircd.userNicks[normalMask]]
+		return []
+	
+	def handleMatchedUser(self, user: "IRCUser", reason: str) -> None:
+		if user.isRegistered():
+			self.changeNick(user, reason, True)
 	
 	def changeNick(self, user: "IRCUser", reason: str, hasBeenConnected: bool) -> None:
 		self.ircd.log.info("Matched user {user.uuid} ({user.nick}) against a q:line: {reason}", user=user, reason=reason)
@@ -100,10 +115,7 @@ class UserQLine(Command):
 			if not self.module.addLine(banmask, now(), data["duration"], user.hostmask(), data["reason"]):
 				user.sendMessage("NOTICE", "*** Q:Line for {} is already set.".format(banmask))
 				return True
-			for checkUser in self.module.ircd.users.values():
-				reason = self.module.matchUser(checkUser)
-				if reason is not None:
-					self.module.changeNick(checkUser, reason, True)
+			self.module.enforceLine(banmask)
 			if data["duration"] > 0:
 				user.sendMessage("NOTICE", "*** Timed q:line for {} has been set, to expire in {} seconds.".format(banmask, data["duration"]))
 			else:
@@ -126,12 +138,7 @@ class ServerAddQLine(Command):
 	
 	def execute(self, server: "IRCServer", data: Dict[Any, Any]) -> bool:
 		if self.module.executeServerAddCommand(server, data):
-			for user in self.module.ircd.users.values():
-				if not user.isRegistered():
-					continue
-				reason = self.module.matchUser(user)
-				if reason is not None:
-					self.module.changeNick(user, reason, True)
+			self.module.enforceLine(data["mask"])
 			return True
 		return False
 
@@ -2,11 +2,13 @@ from twisted.plugin import IPlugin
 from twisted.words.protocols import irc
 from txircd.config import ConfigValidationError
 from txircd.module_interface import Command, ICommand, IModuleData, ModuleData
+from txircd.modules.networkmatch import NetworkMatcher
 from txircd.modules.xlinebase import XLineBase
 from txircd.utils import durationToSeconds, ipAddressToShow, now
 from zope.interface import implementer
 from fnmatch import fnmatchcase
-from typing import Any, Callable, Dict, List, Optional, Tuple
+from ipaddress import ip_address, ip_network
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 import socket
 
 @implementer(IPlugin, IModuleData)
@@ -31,14 +33,60 @@ class ZLine(ModuleData, XLineBase):
 	def load(self) -> None:
 		self.initializeLineStorage()
 
+	def unload(self) -> Optional["Deferred"]:
+		self.stopUserSweep()
+
 	def verifyConfig(self, config: Dict[str, Any]) -> None:
 		if "client_ban_msg" in config and not isinstance(config["client_ban_msg"], str):
 			raise ConfigValidationError("client_ban_msg", "value must be a string")
 	
+	def createMaskIndex(self) -> None:
+		XLineBase.createMaskIndex(self)
+		self._lineNetworks = NetworkMatcher()
+	
+	def addMaskToIndex(self, normalMask: str) -> None:
+		network = self.maskNetwork(normalMask)
+		if network is None:
+			XLineBase.addMaskToIndex(self, normalMask)
+		else:
+			self._lineNetworks.add(normalMask, network)
+	
+	def removeMaskFromIndex(self, normalMask: str) -> None:
+		if normalMask in self._lineNetworks:
+			self._lineNetworks.remove(normalMask)
+		else:
+			XLineBase.removeMaskFromIndex(self, normalMask)
+	
+	def indexedMatches(self, user: "IRCUser", data: Optional[Dict[Any, Any]]) -> Optional[List[str]]:
+		matchingMasks = self._lineNetworks.matchingKeys(user.ip)
+		normalMask = self._lineMasks.firstMatch([ipAddressToShow(user.ip)])
+		if normalMask is not None:
+			matchingMasks.append(normalMask)
+		return matchingMasks
+	
 	def checkUserMatch(self, user: "IRCUser", mask: str, data: Optional[Dict[Any, Any]]) -> bool:
-		return fnmatchcase(ipAddressToShow(user.ip), mask)
+		normalMask = self.normalizeMask(mask)
+		network = self.maskNetwork(normalMask)
+		if network is None:
+			return fnmatchcase(ipAddressToShow(user.ip), normalMask)
+		return user.ip.version == network.version and user.ip in network
+	
+	def maskNetwork(self, mask: str) -> Union["IPv4Network", "IPv6Network", None]:
+		"""
+		Returns the network for a mask in CIDR notation, or None if the mask
+		isn't in CIDR notation.
+		"""
+		if "/" not in mask:
+			return None
+		try:
+			return ip_network(mask, strict=False)
+		except ValueError:
+			return None
 	
 	def normalizeMask(self, mask: str) -> str:
+		network = self.maskNetwork(mask)
+		if network is not None:
+			return network.with_prefixlen
 		if ":" in mask and "*" not in mask and "?" not in mask: # Normalize non-wildcard IPv6 addresses
 			try:
 				return socket.inet_ntop(socket.AF_INET6, socket.inet_pton(socket.AF_INET6, mask)).lower()
@@ -46,6 +94,22 @@ class ZLine(ModuleData, XLineBase):
 				return mask.lower()
 		return mask.lower()
 	
+	def candidateUsers(self, normalMask: str) -> Optional[List["IRCUser"]]:
+		network = self.maskNetwork(normalMask)
+		if network is not None:
+			if network.num_addresses == 1:
+				return self.ircd.userIndex.usersWithIP(network.network_address)
+			return None
+		if "*" in normalMask or "?" in normalMask or "[" in normalMask:
+			return None
+		try:
+			return self.ircd.userIndex.usersWithIP(ip_address(normalMask))
+		except ValueError:
+			return None
+	
+	def handleMatchedUser(self, user: "IRCUser", reason: str) -> None:
+		self.killUser(user, reason)
+	
 	def killUser(self, user: "IRCUser", reason: str) -> None:
 		self.ircd.log.info("Matched user {user.uuid} ({ip}) against a z:line: {reason}", user=user, ip=ipAddressToShow(user.ip), reason=reason)
 		user.sendMessage(irc.ERR_YOUREBANNEDCREEP, self.ircd.config.get("client_ban_msg", "You're banned! Email abuse@example.com for assistance."))
@@ -92,13 +156,7 @@ class UserZLine(Command):
 			if not self.module.addLine(banmask, now(), data["duration"], user.hostmask(), data["reason"]):
 				user.sendMessage("NOTICE", "*** Z:Line for {} is already set.".format(banmask))
 				return True
-			badUsers = []
-			for checkUser in self.module.ircd.users.values():
-				reason = self.module.matchUser(checkUser)
-				if reason is not None:
-					badUsers.append((checkUser, reason))
-			for badUser in badUsers:
-				self.module.killUser(*badUser)
+			self.module.enforceLine(banmask)
 			if data["duration"] > 0:
 				user.sendMessage("NOTICE", "*** Timed z:line for {} has been set, to expire in {} seconds.".format(banmask, data["duration"]))
 			else:
@@ -121,13 +179,7 @@ class ServerAddZLine(Command):
 	
 	def execute(self, server: "IRCServer", data: Dict[Any, Any]) -> bool:
 		if self.module.executeServerAddCommand(server, data):
-			badUsers = []
-			for user in self.module.ircd.users.values():
-				reason = self.module.matchUser(user)
-				if reason is not None:
-					badUsers.append((user, reason))
-			for user in badUsers:
-				self.module.killUser(*user)
+			self.module.enforceLine(data["mask"])
 			return True
 		return False
 
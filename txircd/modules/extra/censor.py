@@ -10,10 +10,15 @@ irc.RPL_BADWORDADDED = "927"
 irc.RPL_BADWORDREMOVED = "928"
 irc.ERR_NOSUCHBADWORD = "929"
 
+numberedGroupReference = re.compile(r"\\[1-9]|\(\?\(")
+specialCharacters = re.compile(r"[.^$*+?{}\[\]\\|()]")
+
 @implementer(IPlugin, IModuleData)
 class Censor(ModuleData):
 	name = "Censor"
 	badwords = None
+	_censorPattern = None
+	_badwordPatterns = None
 
 	def userCommands(self) -> List[Tuple[str, int, Command]]:
 		return [ ("CENSOR", 1, UserCensorCommand(self)) ]
@@ -68,7 +73,84 @@ class Censor(ModuleData):
 	def load(self) -> None:
 		if "badwords" not in self.ircd.storage:
 			self.ircd.storage["badwords"] = {}
+		self.ircd.storage.trackChanges("badwords") # Changes to the badword list are always saved back to storage
 		self.badwords = self.ircd.storage["badwords"]
+		self.badwordsChanged()
+
+	def badwordsChanged(self) -> None:
+		"""
+		Clears the compiled badword list so that it's rebuilt for the next
+		message. This must be called whenever the badword list changes.
+		"""
+		self._censorPattern = None
+		self._badwordPatterns = None
+
+	def compileBadwords(self) -> None:
+		# All the badwords are combined into a single expression so that a message is only scanned once to check
+		# whether it contains any of them. Badwords without any special characters are combined into a tree of their
+		# characters, since a long list of alternatives is slow to match. Most messages don't contain a badword, so
+		# that's all we need to do for them. Messages that do still have each badword applied in turn, since a badword
+		# can match part of another badword or part of an earlier replacement, and the result depends on the order
+		# in which they're applied. This doesn't work if any badword uses numbered backreferences, since combining
+		# the expressions renumbers their groups, so in that case (or if the combined expression can't be compiled)
+		# we always apply each badword in turn.
+		self._badwordPatterns = []
+		literalTree = {}
+		patternParts = []
+		for badword, replacement in self.badwords.items():
+			if numberedGroupReference.search(badword):
+				self._censorPattern = False
+				return
+			try:
+				badwordPattern = re.compile(badword, re.IGNORECASE)
+			except re.error:
+				self._censorPattern = False
+				return
+			self._badwordPatterns.append((badwordPattern, replacement))
+			if badword and not specialCharacters.search(badword):
+				treeNode = literalTree
+				for char in badword.lower():
+					if char not in treeNode:
+						treeNode[char] = {}
+					treeNode = treeNode[char]
+				treeNode[""] = {}
+			else:
+				patternParts.append("(?:{})".format(badword))
+		if literalTree:
+			patternParts.insert(0, self._treeExpression(literalTree))
+		try:
+			self._censorPattern = re.compile("|".join(patternParts), re.IGNORECASE)
+		except re.error:
+			self._censorPattern = False
+
+	def _treeExpression(self, treeNode: Dict[str, Dict]) -> str:
+		# The ends of shorter badwords are optional so that every badword in the tree can match
+		branches = [re.escape(char) + self._treeExpression(childNode) for char, childNode in treeNode.items() if char]
+		if not branches:
+			return ""
+		if "" not in treeNode:
+			if len(branches) == 1:
+				return branches[0]
+			return "(?:{})".format("|".join(branches))
+		return "(?:{})?".format("|".join(branches))
+
+	def censorMessage(self, message: str) -> str:
+		"""
+		Replaces all badwords in the message.
+		"""
+		if not self.badwords:
+			return message
+		if self._censorPattern is None:
+			self.compileBadwords()
+		if self._censorPattern is False:
+			for mask, replacement in self.badwords.items():
+				message = re.sub(mask, replacement, message, flags=re.IGNORECASE)
+			return message
+		if not self._censorPattern.search(message):
+			return message
+		for badwordPattern, replacement in self._badwordPatterns:
+			message = badwordPattern.sub(replacement, message)
+		return message
 
 @implementer(IMode)
 class ChannelCensor(Mode):
@@ -85,10 +167,7 @@ class ChannelCensor(Mode):
 		if "targetchans" not in data:
 			return
 		if channel in data["targetchans"] and not self.ircd.runActionUntilValue("checkexemptchanops", "censor", channel, user):
-			message = data["targetchans"][channel]
-			for mask, replacement in self.censor.badwords.items():
-				message = re.sub(mask, replacement, message, flags=re.IGNORECASE)
-			data["targetchans"][channel] = message
+			data["targetchans"][channel] = self.censor.censorMessage(data["targetchans"][channel])
 
 @implementer(IMode)
 class UserCensor(Mode):
@@ -104,10 +183,7 @@ class UserCensor(Mode):
 		if "targetusers" not in data:
 			return
 		if targetUser in data["targetusers"]: 
-			message = data["targetusers"][targetUser]
-			for mask, replacement in self.censor.badwords.items():
-				message = re.sub(mask, replacement, message, flags=re.IGNORECASE)
-			data["targetusers"][targetUser] = message
+			data["targetusers"][targetUser] = self.censor.censorMessage(data["targetusers"][targetUser])
 
 @implementer(ICommand)
 class UserCensorCommand(Command):
@@ -136,6 +212,7 @@ class UserCensorCommand(Command):
 			replacement = data["replacement"]
 			self.censor.badwords[badword] = replacement
 			self.censor.ircd.storage["badwords"] = self.censor.badwords
+			self.censor.badwordsChanged()
 			self.censor.propagateBadword(badword, replacement)
 			user.sendMessage(irc.RPL_BADWORDADDED, badword, replacement)
 		else:
@@ -144,6 +221,7 @@ class UserCensorCommand(Command):
 				return True
 			del self.censor.badwords[badword]
 			self.censor.ircd.storage["badwords"] = self.censor.badwords
+			self.censor.badwordsChanged()
 			self.censor.propagateBadword(badword, None)
 			user.sendMessage(irc.RPL_BADWORDREMOVED, badword, "Badword removed")
 		return True
@@ -178,12 +256,14 @@ class ServerCensorCommand(Command):
 			replacement = data["replacement"]
 			self.censor.badwords[badword] = replacement
 			self.censor.ircd.storage["badwords"] = self.censor.badwords
+			self.censor.badwordsChanged()
 			for remoteServer in self.censor.ircd.servers.values():
 				if remoteServer.nextClosest == self.censor.ircd.serverID and remoteServer != server:
 					remoteServer.sendMessage("CENSOR", badword, replacement, prefix=self.censor.ircd.serverID)
 		else:
 			del self.censor.badwords[badword]
 			self.censor.ircd.storage["badwords"] = self.censor.badwords
+			self.censor.badwordsChanged()
 			for remoteServer in self.censor.ircd.servers.values():
 				if remoteServer.nextClosest == self.censor.ircd.serverID and remoteServer != server:
 					remoteServer.sendMessage("CENSOR", badword, prefix=self.censor.ircd.serverID)
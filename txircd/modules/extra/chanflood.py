@@ -1,8 +1,8 @@
 from twisted.plugin import IPlugin
 from txircd.module_interface import IMode, IModuleData, Mode, ModuleData
-from txircd.utils import ModeType, now
+from txircd.modules.tokenbucket import TokenBucket
+from txircd.utils import ModeType
 from zope.interface import implementer
-from datetime import timedelta
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 @implementer(IPlugin, IModuleData, IMode)
@@ -43,25 +43,22 @@ class ChannelFlood(ModuleData, Mode):
 			return
 		if self.ircd.runActionUntilValue("checkexemptchanops", "chanflood", channel, user):
 			return 
-		if "floodhistory" not in channel.users[user]:
-			channel.users[user]["floodhistory"] = []
+		# The parameter is only parsed when it's changed, and its parsed values are kept with the channel
+		floodLimit = channel.cache.get("floodlimit", None)
+		if floodLimit is None or floodLimit[0] != param:
+			maxLines, seconds = param.split(":")
+			maxLines = int(maxLines)
+			floodLimit = (param, maxLines, maxLines / int(seconds))
+			channel.cache["floodlimit"] = floodLimit
+		_, maxLines, rate = floodLimit
 		
-		currentTime = now()
-		channel.users[user]["floodhistory"].append((data["targetchans"][channel], currentTime))
-		maxLines, seconds = param.split(":")
-		maxLines = int(maxLines)
-		seconds = int(seconds)
-		duration = timedelta(seconds=seconds)
-		floodTime = currentTime - duration
-		floodHistory = channel.users[user]["floodhistory"]
-		
-		while floodHistory:
-			if floodHistory[0][1] <= floodTime:
-				del floodHistory[0]
-			else:
-				break
-		channel.users[user]["floodhistory"] = floodHistory
-		if len(floodHistory) > maxLines:
+		memberData = channel.users[user]
+		if "floodbucket" not in memberData:
+			memberData["floodbucket"] = TokenBucket(maxLines, rate)
+		floodBucket = memberData["floodbucket"]
+		if floodBucket.capacity != maxLines or floodBucket.rate != rate:
+			floodBucket.setLimits(maxLines, rate)
+		if not floodBucket.consume():
 			user.leaveChannel(channel, "KICK", { "byuser": False, "server": self.ircd, "reason": "Channel flood limit reached" })
 
 chanFlood = ChannelFlood()
\ No newline at end of file
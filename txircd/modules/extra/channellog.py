@@ -1,12 +1,14 @@
+from twisted.internet import reactor
 from twisted.internet.task import LoopingCall
 from twisted.plugin import IPlugin
 from twisted.python.logfile import DailyLogFile
+from twisted.python.threadpool import ThreadPool
 from txircd.config import ConfigValidationError
 from txircd.module_interface import IModuleData, ModuleData
 from txircd.utils import CaseInsensitiveDictionary, now
 from zope.interface import implementer
 from fnmatch import fnmatchcase
-from typing import Any, Callable, Dict, List, Tuple
+from typing import Any, Callable, Dict, List, Set, Tuple
 
 @implementer(IPlugin, IModuleData)
 class ChannelLog(ModuleData):
@@ -24,17 +26,31 @@ class ChannelLog(ModuleData):
 			("topic", 1, self.logTopic),
 			("modechanges-channel", 1, self.logModeChanges) ]
 	
+	flushSize = 65536
+	
 	def load(self) -> None:
+		# The log files are only ever used from the writer thread, so disk writes and rotation never block the reactor.
+		# The writer pool has a single thread so that lines are written in the order they're queued.
 		self.logFiles = CaseInsensitiveDictionary()
+		self.pendingLines = {}
+		self.pendingSize = 0
+		self.logChannelCache = {}
+		self.writerPool = ThreadPool(1, 1, "ChannelLog")
+		self.writerPool.start()
+		self.flushTimer = self.ircd.timers.callEvery(1, self.flushLines)
 		self.cleanupProcess = LoopingCall(self.cleanLogFiles)
 		self.cleanupProcess.start(600, now=False)
 	
+	def rehash(self) -> None:
+		self.logChannelCache.clear()
+	
 	def unload(self) -> None:
-		for logFile in self.logFiles.values():
-			logFile.close()
-		self.logFiles.clear()
+		self.flushTimer.cancel()
 		if self.cleanupProcess.running:
 			self.cleanupProcess.stop()
+		self.flushLines()
+		self.writerPool.callInThread(self.closeLogFiles, None)
+		self.writerPool.stop() # Waits for the queued lines to be written
 	
 	def verifyConfig(self, config: Dict[str, Any]) -> None:
 		if "channel_log_directory" in config:
@@ -48,40 +64,83 @@ class ChannelLog(ModuleData):
 					raise ConfigValidationError("channel_log_channels", "must be a list of channel masks")
 	
 	def cleanLogFiles(self) -> None:
-		deadChannelNames = {}
-		for channelName, logFile in self.logFiles.items():
+		liveChannelNames = set(self.ircd.channels.keys())
+		for channelName in list(self.logChannelCache.keys()):
 			if channelName not in self.ircd.channels:
-				deadChannelNames[channelName] = logFile
-		for channelName, logFile in deadChannelNames.items():
-			logFile.close()
-			del self.logFiles[channelName]
+				del self.logChannelCache[channelName]
+		self.writerPool.callInThread(self.closeLogFiles, liveChannelNames)
+	
+	def closeLogFiles(self, liveChannelNames: Set[str] = None) -> None:
+		"""
+		Closes the log files of channels not in the given set of channel names,
+		or all log files if no set is given. Runs in the writer thread.
+		"""
+		for channelName, logFile in list(self.logFiles.items()):
+			if liveChannelNames is None or channelName not in liveChannelNames:
+				logFile.close()
+				del self.logFiles[channelName]
 	
 	def timestampPrefix(self) -> str:
 		nowTime = now()
 		return "[{}:{:02d}:{:02d}]".format(nowTime.hour, nowTime.minute, nowTime.second)
 	
 	def logLine(self, channel: "IRCChannel", line: str) -> None:
+		if not self.shouldLogChannel(channel):
+			return
 		line = "{} {}\n".format(self.timestampPrefix(), line)
-		if channel.name in self.logFiles:
-			logFile = self.logFiles[channel.name]
+		if channel.name in self.pendingLines:
+			self.pendingLines[channel.name].append(line)
 		else:
-			if not self.shouldLogChannel(channel):
-				return
-			logFile = DailyLogFile(channel.name, self.ircd.config.get("channel_log_directory", ""))
-			self.logFiles[channel.name] = logFile
-		if logFile.shouldRotate():
-			logFile.rotate()
-		logFile.write(line)
-	
-	def shouldLogChannel(self, channel: "IRCChannel"):
-		channelNameMaskList = self.ircd.config.get("channel_list_channels", [])
-		if not channelNameMaskList:
-			return True
+			self.pendingLines[channel.name] = [line]
+		self.pendingSize += len(line)
+		if self.pendingSize >= self.flushSize:
+			self.flushLines()
+	
+	def flushLines(self) -> None:
+		"""
+		Hands the lines logged since the last flush to the writer thread.
+		"""
+		if not self.pendingLines:
+			return
+		pendingLines = self.pendingLines
+		self.pendingLines = {}
+		self.pendingSize = 0
+		self.writerPool.callInThread(self.writeLines, self.ircd.config.get("channel_log_directory", ""), pendingLines)
+	
+	def writeLines(self, logDirectory: str, pendingLines: Dict[str, List[str]]) -> None:
+		"""
+		Writes a batch of lines to the channel log files. Runs in the writer
+		thread.
+		"""
+		for channelName, lines in pendingLines.items():
+			try:
+				if channelName in self.logFiles:
+					logFile = self.logFiles[channelName]
+				else:
+					logFile = DailyLogFile(channelName, logDirectory)
+					self.logFiles[channelName] = logFile
+				if logFile.shouldRotate():
+					logFile.rotate()
+				logFile.write("".join(lines))
+				logFile.flush()
+			except Exception as err:
+				reactor.callFromThread(self.ircd.log.error, "Couldn't write to the log for channel {channel}: {err}", channel=channelName, err=err)
+	
+	def shouldLogChannel(self, channel: "IRCChannel") -> bool:
 		channelName = channel.name
-		for channelNameMask in channelNameMaskList:
-			if fnmatchcase(channelName, channelNameMask):
-				return True
-		return False
+		if channelName in self.logChannelCache:
+			return self.logChannelCache[channelName]
+		shouldLog = False
+		channelNameMaskList = self.ircd.config.get("channel_log_channels", [])
+		if not channelNameMaskList:
+			shouldLog = True
+		else:
+			for channelNameMask in channelNameMaskList:
+				if fnmatchcase(channelName, channelNameMask):
+					shouldLog = True
+					break
+		self.logChannelCache[channelName] = shouldLog
+		return shouldLog
 	
 	def logMsg(self, user: "IRCUser", data: Dict[Any, Any]) -> None:
 		if "targetchans" not in data:
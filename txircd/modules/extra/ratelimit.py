@@ -1,8 +1,10 @@
 from twisted.plugin import IPlugin
 from txircd.config import ConfigValidationError
 from txircd.module_interface import IModuleData, ModuleData
-from txircd.utils import now, timestamp
+from txircd.modules.tokenbucket import TokenBucket
+from txircd.utils import ipAddressToShow, ircLower
 from zope.interface import implementer
+from fnmatch import fnmatchcase
 from typing import Any, Callable, Dict, List, Optional, Tuple
 
 @implementer(IPlugin, IModuleData)
@@ -10,7 +12,11 @@ class RateLimit(ModuleData):
 	name = "RateLimit"
 	
 	def actions(self) -> List[Tuple[str, int, Callable]]:
-		return [ ("commandpermission", 100, self.recvCommand) ]
+		return [ ("commanddefer", 100, self.deferExpensiveCommand),
+		         ("commandpermission", 100, self.recvCommand),
+		         ("welcome", 100, self.clearRateClass),
+		         ("changehost", 100, self.clearRateClass),
+		         ("changeipaddress", 100, self.clearRateClass) ]
 	
 	def verifyConfig(self, config: Dict[str, Any]) -> None:
 		if "rate_soft_limit" in config:
@@ -32,44 +38,122 @@ class RateLimit(ModuleData):
 			config["rate_kill_limit"] = 500
 		
 		if "rate_interval" in config:
-			if not isinstance(config["rate_interval"], int) or config["rate_interval"] < 0:
+			if not isinstance(config["rate_interval"], int) or config["rate_interval"] < 1:
 				raise ConfigValidationError("rate_interval", "invalid number")
 		else:
 			config["rate_interval"] = 60
+		
+		if "rate_command_costs" in config:
+			if not isinstance(config["rate_command_costs"], dict):
+				raise ConfigValidationError("rate_command_costs", "value must be a dictionary")
+			commandCosts = {}
+			for command, cost in config["rate_command_costs"].items():
+				if not isinstance(command, str):
+					raise ConfigValidationError("rate_command_costs", "commands must be strings")
+				if not isinstance(cost, int) or cost < 0:
+					raise ConfigValidationError("rate_command_costs", "invalid cost for command \"{}\"".format(command))
+				commandCosts[command.upper()] = cost
+			config["rate_command_costs"] = commandCosts
+		else:
+			config["rate_command_costs"] = {}
+		
+		if "rate_classes" in config:
+			if not isinstance(config["rate_classes"], list):
+				raise ConfigValidationError("rate_classes", "value must be a list")
+			for rateClass in config["rate_classes"]:
+				if not isinstance(rateClass, dict):
+					raise ConfigValidationError("rate_classes", "every class must be a dictionary")
+				if "hosts" not in rateClass or not isinstance(rateClass["hosts"], list) or not all(isinstance(host, str) for host in rateClass["hosts"]):
+					raise ConfigValidationError("rate_classes", "every class must have a list of hosts")
+				rateClass["hosts"] = [ircLower(host) for host in rateClass["hosts"]]
+				for limitKey in ("soft_limit", "kill_limit", "interval"):
+					if limitKey in rateClass and (not isinstance(rateClass[limitKey], int) or rateClass[limitKey] < 1):
+						raise ConfigValidationError("rate_classes", "invalid number for {}".format(limitKey))
+				if "exempt" in rateClass and not isinstance(rateClass["exempt"], bool):
+					raise ConfigValidationError("rate_classes", "exempt must be true or false")
+		else:
+			config["rate_classes"] = []
+	
+	def rehash(self) -> None:
+		for user in self.ircd.users.values():
+			self.clearRateClass(user)
+	
+	def clearRateClass(self, user: "IRCUser", *params: Any) -> None:
+		if "ratelimit-class" in user.cache:
+			del user.cache["ratelimit-class"]
 	
-	def getPeriodData(self) -> Tuple[int, float]:
-		"""Returns (period as integer, time to end of period)"""
-		nowTS = timestamp(now())
-		interval = self.ircd.config["rate_interval"]
-		period = int(nowTS / interval)
-		timeToEnd = (period + 1) * interval - nowTS
-		return period, timeToEnd
+	def rateClass(self, user: "IRCUser") -> Dict[str, Any]:
+		"""
+		Returns the first configured rate class with a host matching the user,
+		or an empty class if none match.
+		"""
+		if "ratelimit-class" not in user.cache:
+			userHosts = (ircLower(user.host()), ircLower(user.realHost), ipAddressToShow(user.ip))
+			user.cache["ratelimit-class"] = {}
+			for rateClass in self.ircd.config["rate_classes"]:
+				if any(fnmatchcase(userHost, hostMask) for hostMask in rateClass["hosts"] for userHost in userHosts):
+					user.cache["ratelimit-class"] = rateClass
+					break
+		return user.cache["ratelimit-class"]
+	
+	def isExempt(self, user: "IRCUser") -> bool:
+		if self.rateClass(user).get("exempt", False):
+			return True
+		return self.ircd.runActionUntilValue("userhasoperpermission", user, "exempt-ratelimit", users=[user]) is True
+	
+	def commandCost(self, command: str) -> int:
+		return self.ircd.config["rate_command_costs"].get(command, 1)
+	
+	def rateBuckets(self, user: "IRCUser") -> Tuple[TokenBucket, TokenBucket]:
+		"""
+		Returns the user's (soft limit, kill limit) token buckets. Each bucket
+		refills its whole limit over the interval for the user's rate class.
+		"""
+		rateClass = self.rateClass(user)
+		interval = rateClass.get("interval", self.ircd.config["rate_interval"])
+		softLimit = rateClass.get("soft_limit", self.ircd.config["rate_soft_limit"])
+		killLimit = rateClass.get("kill_limit", self.ircd.config["rate_kill_limit"])
+		if "ratelimit-buckets" not in user.cache:
+			user.cache["ratelimit-buckets"] = (TokenBucket(softLimit, softLimit / interval), TokenBucket(killLimit, killLimit / interval))
+		softBucket, killBucket = user.cache["ratelimit-buckets"]
+		if softBucket.capacity != softLimit or softBucket.rate != softLimit / interval:
+			softBucket.setLimits(softLimit, softLimit / interval)
+		if killBucket.capacity != killLimit or killBucket.rate != killLimit / interval:
+			killBucket.setLimits(killLimit, killLimit / interval)
+		return softBucket, killBucket
+	
+	def deferExpensiveCommand(self, user: "IRCUser", command: str, data: Dict[Any, Any]) -> Optional[float]:
+		# Commands that cost more than one token are held until the user can afford them instead of being refused
+		cost = self.commandCost(command)
+		if cost <= 1:
+			return None
+		softBucket, killBucket = self.rateBuckets(user)
+		waitTime = softBucket.timeUntilAvailable(min(cost, softBucket.capacity))
+		if not waitTime or self.isExempt(user):
+			return None
+		return waitTime
 	
 	def recvCommand(self, user: "IRCUser", command: str, data: Dict[Any, Any]) -> Optional[bool]:
-		rateData = user.cache.setdefault("ratelimit-stats", {})
-		thisPeriod, timeToEnd = self.getPeriodData()
-		if rateData.get("period", None) != thisPeriod:
-			# reset stats after each period
-			rateData["messages"] = 0
-			rateData["period"] = thisPeriod
-			rateData["noticeSent"] = False
-		killLimit = self.ircd.config["rate_kill_limit"]
-		rateData["messages"] += 1
-		if rateData["messages"] > killLimit:
+		cost = self.commandCost(command)
+		softBucket, killBucket = self.rateBuckets(user)
+		if not killBucket.consume(min(cost, killBucket.capacity)) and not self.isExempt(user):
 			user.disconnect("Killed: Flooding")
 			return False
-		softLimit = self.ircd.config["rate_soft_limit"]
-		if rateData["messages"] > softLimit:
-			# only send notice once per period
-			if not rateData["noticeSent"]:
-				user.sendMessage("NOTICE", ("You are sending too many messages (limit is {limit}/{interval:.2f}s). "
-					"You cannot send any more messages for {timeToEnd:.2f} seconds."
-					).format(limit=softLimit, interval=self.ircd.config["rate_interval"], timeToEnd=timeToEnd))
-				self.ircd.log.info("User {user.uuid} ({user.nick}) exceeded the message limit", user=user)
-				rateData["noticeSent"] = True
-			# we whitelist ping/pong to prevent ping timeouts
-			if command not in ("PING", "PONG"):
-				return False
+		if softBucket.consume(min(cost, softBucket.capacity)):
+			user.cache.pop("ratelimit-noticesent", None)
+			return None
+		if self.isExempt(user):
+			return None
+		# only send notice once until the user is allowed to send messages again
+		if "ratelimit-noticesent" not in user.cache:
+			user.sendMessage("NOTICE", ("You are sending too many messages (limit is {limit}/{interval:.2f}s). "
+				"You cannot send any more messages for {timeToEnd:.2f} seconds."
+				).format(limit=softBucket.capacity, interval=softBucket.capacity / softBucket.rate, timeToEnd=softBucket.timeUntilAvailable()))
+			self.ircd.log.info("User {user.uuid} ({user.nick}) exceeded the message limit", user=user)
+			user.cache["ratelimit-noticesent"] = True
+		# we whitelist ping/pong to prevent ping timeouts
+		if command not in ("PING", "PONG"):
+			return False
 		return None
 
 rateLimit = RateLimit()
\ No newline at end of file
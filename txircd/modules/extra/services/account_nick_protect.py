@@ -1,4 +1,3 @@
-from twisted.internet import reactor
 from twisted.plugin import IPlugin
 from txircd.config import ConfigValidationError
 from txircd.module_interface import IModuleData, ModuleData
@@ -118,7 +117,7 @@ class AccountNickProtect(ModuleData):
 			return
 		protectDelay = self.ircd.config.get("account_nick_protect_seconds", 30)
 		user.sendMessage("NOTICE", "The nickname you're using is owned by an account to which you are not identified. Please identify to that account or change your nick in the next \x02{}\x02 seconds.".format(protectDelay))
-		user.cache["accountNickProtectTimer"] = reactor.callLater(protectDelay, self.resolveNickProtection, user, user.nick)
+		user.cache["accountNickProtectTimer"] = self.ircd.timers.callLater(protectDelay, self.resolveNickProtection, user, user.nick)
 	
 	def resolveNickProtection(self, user: "IRCUser", nick: str) -> None:
 		if user.nick != nick:
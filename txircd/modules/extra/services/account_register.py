@@ -2,7 +2,7 @@ from twisted.plugin import IPlugin
 from twisted.words.protocols import irc
 from txircd.module_interface import Command, ICommand, IModuleData, ModuleData
 from zope.interface import implementer
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple, Union
 from validate_email import validate_email as validateEmail
 
 irc.ERR_SERVICES = "955" # Custom numeric; 955 <TYPE> <SUBTYPE> <ERROR>
@@ -42,10 +42,19 @@ class AccountRegister(ModuleData, Command):
 			user.sendMessage(irc.ERR_SERVICES, "ACCOUNT", "CREATE", "NOACCOUNT")
 			user.sendMessage("NOTICE", "This server doesn't have accounts set up.")
 			return True
-		if createResult[0]:
+		if createResult[0] is None:
+			createResult[1].addCallback(self.checkRegisterSuccess, user)
 			return True
-		user.sendMessage(irc.ERR_SERVICES, "ACCOUNT", "CREATE", createResult[1])
-		user.sendMessage("NOTICE", "Your account couldn't be registered: {}".format(createResult[2]))
+		self.checkRegisterSuccess(createResult, user)
 		return True
+	
+	def checkRegisterSuccess(self, result: Union[Tuple[bool, Optional[str], Optional[str]], Tuple[None, "Deferred", None]], user: "IRCUser") -> None:
+		if user.uuid not in self.ircd.users:
+			return
+		registerSuccess, errorCode, errorMessage = result
+		if registerSuccess:
+			return
+		user.sendMessage(irc.ERR_SERVICES, "ACCOUNT", "CREATE", errorCode)
+		user.sendMessage("NOTICE", "Your account couldn't be registered: {}".format(errorMessage))
 
 registerCommand = AccountRegister()
\ No newline at end of file
@@ -8,18 +8,29 @@ class AccountSASL(ModuleData):
 	name = "AccountSASL"
 	
 	def actions(self) -> List[Tuple[str, int, Callable]]:
-		return [ ("authenticatesasl-PLAIN", 1, self.checkPlain) ]
+		return [ ("authenticatesasl-PLAIN", 1, self.checkPlain),
+		         ("accountloginextracheck", 1, self.checkSASLAborted) ]
 	
 	def checkPlain(self, user: "IRCUser", username: str, password: str) -> Union[str, bool]:
 		resultValue = self.ircd.runActionUntilValue("accountauthenticate", user, username, password)
 		if not resultValue:
 			return False
 		if resultValue[0] is None:
+			user.cache["account-sasl-pending"] = True
 			resultValue[1].addCallback(self.completeSASL, user)
 			return "defer"
 		return resultValue[0]
 	
+	def checkSASLAborted(self, user: "IRCUser", accountName: str) -> Optional[Tuple[bool, Optional[str], Optional[str]]]:
+		# The SASL module stops processing an authentication when it's aborted, but the password check keeps running.
+		# Don't log the user in when it finishes.
+		if "account-sasl-pending" in user.cache and "sasl-processing" not in user.cache:
+			return False, "ABORTED", "The login attempt was aborted."
+		return None
+	
 	def completeSASL(self, result: Union[Tuple[bool, Optional[str], Optional[str]], Tuple[None, "Deferred", None]], user: "IRCUser") -> None:
+		if "account-sasl-pending" in user.cache:
+			del user.cache["account-sasl-pending"]
 		self.ircd.runActionStandard("saslcomplete", user, result[0])
 
-accountSASL = AccountSASL()
\ No newline at end of file
+accountSASL = AccountSASL()
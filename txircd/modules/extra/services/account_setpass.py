@@ -2,7 +2,7 @@ from twisted.plugin import IPlugin
 from twisted.words.protocols import irc
 from txircd.module_interface import Command, ICommand, IModuleData, ModuleData
 from zope.interface import implementer
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 irc.ERR_SERVICES = "955" # Custom numeric; 955 <TYPE> <SUBTYPE> <ERROR>
 
@@ -33,11 +33,20 @@ class AccountSetPass(ModuleData, Command):
 			user.sendMessage(irc.ERR_SERVICES, "ACCOUNT", "SETPASS", "NOACCOUNT")
 			user.sendMessage("NOTICE", "This server doesn't have accounts set up.")
 			return True
-		if passChangeResult[0]:
-			user.sendMessage("NOTICE", "Password changed.")
+		if passChangeResult[0] is None:
+			passChangeResult[1].addCallback(self.checkPassChangeSuccess, user)
 			return True
-		user.sendMessage(irc.ERR_SERVICES, "ACCOUNT", "SETPASS", passChangeResult[1])
-		user.sendMessage("NOTICE", "Failed to change password: {}".format(passChangeResult[2]))
+		self.checkPassChangeSuccess(passChangeResult, user)
 		return True
+	
+	def checkPassChangeSuccess(self, result: Union[Tuple[bool, Optional[str], Optional[str]], Tuple[None, "Deferred", None]], user: "IRCUser") -> None:
+		if user.uuid not in self.ircd.users:
+			return
+		passChangeSuccess, errorCode, errorMessage = result
+		if passChangeSuccess:
+			user.sendMessage("NOTICE", "Password changed.")
+			return
+		user.sendMessage(irc.ERR_SERVICES, "ACCOUNT", "SETPASS", errorCode)
+		user.sendMessage("NOTICE", "Failed to change password: {}".format(errorMessage))
 
 setPassCommand = AccountSetPass()
\ No newline at end of file
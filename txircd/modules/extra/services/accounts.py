@@ -55,13 +55,23 @@ class Accounts(ModuleData):
 			("ACCOUNTBURSTINIT", 1, AccountBurstInitCommand(self)) ]
 	
 	def load(self) -> None:
-		if "services" not in self.ircd.storage:
-			self.ircd.storage["services"] = {}
-		if "accounts" not in self.ircd.storage["services"]:
-			self.ircd.storage["services"]["accounts"] = {}
-			self.ircd.storage["services"]["accounts"]["data"] = {}
-			self.ircd.storage["services"]["accounts"]["index"] = {}
-			self.ircd.storage["services"]["accounts"]["deleted"] = {}
+		if "services_accounts" not in self.ircd.storage:
+			if "services" in self.ircd.storage and "accounts" in self.ircd.storage["services"]:
+				# Account data used to be stored together with the rest of the services data, so every change
+				# rewrote all of it. Move it to its own key.
+				servicesData = self.ircd.storage["services"]
+				self.ircd.storage["services_accounts"] = servicesData.pop("accounts")
+				if servicesData:
+					self.ircd.storage["services"] = servicesData
+				else:
+					del self.ircd.storage["services"]
+			else:
+				self.ircd.storage["services_accounts"] = {}
+				self.ircd.storage["services_accounts"]["data"] = {}
+				self.ircd.storage["services_accounts"]["index"] = {}
+				self.ircd.storage["services_accounts"]["deleted"] = {}
+		self.ircd.storage.trackChanges("services_accounts")
+		self.ircd.storage.markDirty("services_accounts")
 		self.loggedInUsers = CaseInsensitiveDictionary()
 		self.setStorageReferences()
 	
@@ -81,8 +91,7 @@ class Accounts(ModuleData):
 				raise ConfigValidationError("account_max_nicks", "invalid number")
 	
 	def setStorageReferences(self) -> None:
-		self.servicesData = self.ircd.storage["services"]
-		self.accountData = self.servicesData["accounts"]
+		self.accountData = self.ircd.storage["services_accounts"]
 	
 	def registerAccountFromInfo(self, accountInfo: Dict[str, Any], updateConflictingIfTied: bool, fromServer: "IRCServer") -> bool:
 		"""
@@ -157,6 +166,7 @@ class Accounts(ModuleData):
 			return False
 		if otherAccountData is None:
 			self.accountData["data"][lowerAccountName] = accountInfo
+			self.ircd.storage.markDirty("services_accounts")
 			self.ircd.runActionStandard("accountsetupindices", accountName)
 			return True
 		self.ircd.runActionStandard("accountremoveindices", accountName)
@@ -181,6 +191,7 @@ class Accounts(ModuleData):
 		if accountInfo["updated"] > otherAccountData["updated"] or updateConflictingIfTied:
 			accountInfo["nick"] = otherAccountData["nick"]
 			self.accountData["data"][lowerAccountName] = accountInfo
+		self.ircd.storage.markDirty("services_accounts")
 		self.ircd.runActionStandard("accountsetupindices", accountName)
 		return True
 	
@@ -192,6 +203,8 @@ class Accounts(ModuleData):
 		Otherwise, the password is already hashed with the entered hash method, and that hash method module must be loaded.
 		An email address is optional here, but one may be required by other modules.
 		Returns (True, None, None) if account creation succeeds. Returns (False, "ERRCODE", "error message") otherwise.
+		If the password is hashed in the background, returns (None, Deferred, None), and the Deferred fires with one of
+		the other results when the account creation finishes.
 		"""
 		if not username:
 			return False, "BADPARAM", "No username entered."
@@ -200,6 +213,31 @@ class Accounts(ModuleData):
 		if passwordHashedMethod is None and len(password) < self.ircd.config["account_password_minimum_length"]:
 			return False, "BADPASS", "Password is not at least {} characters long.".format(self.ircd.config["account_password_minimum_length"])
 		
+		checkResult = self.checkNewAccount(username, email)
+		if checkResult:
+			return checkResult
+		
+		if passwordHashedMethod is None:
+			passwordHashMethod = self.ircd.config["account_password_hash"]
+			if "hashdeferred-{}".format(passwordHashMethod) in self.ircd.functionCache:
+				resultDeferred = self.ircd.functionCache["hashdeferred-{}".format(passwordHashMethod)](password)
+				resultDeferred.addCallbacks(self.completeCreateAccount, self.hashFailed, (username, passwordHashMethod, email, user, fromServer, registrationTime), None, ("Can't hash password with configured hash method.",))
+				return None, resultDeferred, None
+			if "hash-{}".format(passwordHashMethod) not in self.ircd.functionCache:
+				return False, "BADHASH", "Can't hash password with configured hash method."
+			hashedPassword = self.ircd.functionCache["hash-{}".format(passwordHashMethod)](password)
+		else:
+			if "compare-{}".format(passwordHashedMethod) not in self.ircd.functionCache:
+				return False, "BADHASH", "Provided hash method isn't loaded."
+			passwordHashMethod = passwordHashedMethod
+			hashedPassword = password
+		return self.completeCreateAccount(hashedPassword, username, passwordHashMethod, email, user, fromServer, registrationTime)
+	
+	def checkNewAccount(self, username: str, email: Optional[str]) -> Optional[Tuple[bool, str, str]]:
+		"""
+		Used only by other account action implementing functions to check whether an account can be created with the
+		given username and email address. Returns None if it can, or False, "ERRCODE", "error message" otherwise.
+		"""
 		if email:
 			if not validateEmail(email):
 				return False, "INVALIDEMAIL", "The provided email address is in an invalid format."
@@ -220,17 +258,20 @@ class Accounts(ModuleData):
 			self.accountData["index"]["nick"] = {}
 		if lowerUsername in self.accountData["index"]["nick"]:
 			return False, "DUPNICK", "That nickname is already in use on a different account."
-		
-		if passwordHashedMethod is None:
-			passwordHashMethod = self.ircd.config["account_password_hash"]
-			if "hash-{}".format(passwordHashMethod) not in self.ircd.functionCache:
-				return False, "BADHASH", "Can't hash password with configured hash method."
-			hashedPassword = self.ircd.functionCache["hash-{}".format(passwordHashMethod)](password)
-		else:
-			if "compare-{}".format(passwordHashedMethod) not in self.ircd.functionCache:
-				return False, "BADHASH", "Provided hash method isn't loaded."
-			passwordHashMethod = passwordHashedMethod
-			hashedPassword = password
+		return None
+	
+	def hashFailed(self, failure: "Failure", errorMessage: str) -> Tuple[bool, str, str]:
+		self.ircd.log.warn("Password hashing failed: {error}", error=failure.getErrorMessage())
+		return False, "BADHASH", errorMessage
+	
+	def completeCreateAccount(self, hashedPassword: str, username: str, passwordHashMethod: str, email: Optional[str], user: Optional["IRCUser"], fromServer: Optional["IRCServer"], registrationTime: Optional[datetime]) -> Tuple[bool, Optional[str], Optional[str]]:
+		"""
+		Creates an account after its password has been hashed.
+		"""
+		checkResult = self.checkNewAccount(username, email) # Check again, since the account data may have changed while the password was being hashed
+		if checkResult:
+			return checkResult
+		lowerUsername = ircLower(username)
 		
 		if registrationTime is None:
 			registrationTime = now()
@@ -249,12 +290,13 @@ class Accounts(ModuleData):
 		self.accountData["data"][lowerUsername] = newAccountInfo
 		if lowerUsername in self.accountData["deleted"]:
 			del self.accountData["deleted"][lowerUsername]
+		self.ircd.storage.markDirty("services_accounts")
 		
 		self.ircd.runActionStandard("accountsetupindices", username)
 		
 		serializedAccountInfo = serializeAccount(newAccountInfo)
 		self.ircd.broadcastToServers(fromServer, "CREATEACCOUNT", timestampStringFromTime(registrationTime), serializedAccountInfo, prefix=self.ircd.serverID)
-		if user and user.uuid[:3] == self.ircd.serverID:
+		if user and user.uuid[:3] == self.ircd.serverID and user.uuid in self.ircd.users:
 			user.setMetadata("account", username)
 		
 		self.ircd.runActionStandard("accountcreated", username)
@@ -314,9 +356,27 @@ class Accounts(ModuleData):
 		hashedAccountPassword = self.accountData["data"][lowerUsername]["password"]
 		
 		passwordHashMethod = self.accountData["data"][lowerUsername]["password-hash"]
+		if "comparedeferred-{}".format(passwordHashMethod) in self.ircd.functionCache:
+			resultDeferred = self.ircd.functionCache["comparedeferred-{}".format(passwordHashMethod)](password, hashedAccountPassword)
+			resultDeferred.addCallbacks(self.completeAuthentication, self.hashFailed, (user, lowerUsername, hashedAccountPassword, completeLogin), None, ("Could not verify password",))
+			return None, resultDeferred, None
 		if "compare-{}".format(passwordHashMethod) not in self.ircd.functionCache:
 			return False, "BADHASH", "Could not verify password"
-		if not self.ircd.functionCache["compare-{}".format(passwordHashMethod)](password, hashedAccountPassword):
+		passwordMatches = self.ircd.functionCache["compare-{}".format(passwordHashMethod)](password, hashedAccountPassword)
+		return self.completeAuthentication(passwordMatches, user, lowerUsername, hashedAccountPassword, completeLogin)
+	
+	def completeAuthentication(self, passwordMatches: bool, user: "IRCUser", lowerUsername: str, hashedAccountPassword: str, completeLogin: bool) -> Union[Tuple[bool, Optional[str], Optional[str]], Tuple[None, "Deferred", None]]:
+		"""
+		Finishes authenticating a user after the password has been checked.
+		"""
+		if not passwordMatches:
+			return False, "WRONG", "Login credentials were incorrect."
+		if user.uuid not in self.ircd.users:
+			return False, "NOTCONNECTED", "The user disconnected before logging in."
+		# The account may have been changed while the password was being checked
+		if lowerUsername not in self.accountData["data"]:
+			return False, "NOTEXIST", "Account does not exist."
+		if self.accountData["data"][lowerUsername]["password"] != hashedAccountPassword:
 			return False, "WRONG", "Login credentials were incorrect."
 		
 		loginExtraCheckResult = self.ircd.runActionUntilValue("accountloginextracheck", user, lowerUsername, users=[user])
@@ -337,6 +397,7 @@ class Accounts(ModuleData):
 		if lowerAccountName not in self.accountData["data"]:
 			return
 		self.accountData["data"][lowerAccountName]["lastlogin"] = now()
+		self.ircd.storage.markDirty("services_accounts")
 	
 	def logUserOut(self, user: "IRCUser") -> bool:
 		"""
@@ -362,6 +423,7 @@ class Accounts(ModuleData):
 		deleteTime = now()
 		del self.accountData["data"][lowerUsername]
 		self.accountData["deleted"][lowerUsername] = { "deleted": deleteTime, "created": createTime }
+		self.ircd.storage.markDirty("services_accounts")
 		self.ircd.broadcastToServers(fromServer, "DELETEACCOUNT", timestampStringFromTime(deleteTime), username, timestampStringFromTime(createTime), prefix=self.ircd.serverID)
 		for user in self.ircd.users.values():
 			if user.metadataKeyExists("account") and ircLower(user.metadataValue("account")) == lowerUsername:
@@ -402,6 +464,7 @@ class Accounts(ModuleData):
 		accountInfo["username"] = newAccountName
 		accountInfo["updated"] = updateTime
 		self.accountData["data"][lowerNewAccountName] = accountInfo
+		self.ircd.storage.markDirty("services_accounts")
 		self.ircd.runActionStandard("accountsetupindices", newAccountName)
 		self.ircd.broadcastToServers(fromServer, "UPDATEACCOUNTNAME", timestampStringFromTime(updateTime), oldAccountName, timestampStringFromTimestamp(registerTime), newAccountName, prefix=self.ircd.serverID)
 		if not fromServer:
@@ -417,6 +480,8 @@ class Accounts(ModuleData):
 		For plain passwords, the hashMethod is None.
 		If it's not, the password must be hashed with that hash method, and the hash method module must be loaded.
 		Returns (True, None, None) if successful or (False, ERRCODE, error message) if not.
+		If the password is hashed in the background, returns (None, Deferred, None), and the Deferred fires with one of
+		the other results when the password change finishes.
 		"""
 		lowerAccountName = ircLower(accountName)
 		if lowerAccountName not in self.accountData["data"]:
@@ -426,6 +491,10 @@ class Accounts(ModuleData):
 		
 		if hashMethod is None:
 			hashMethod = self.ircd.config["account_password_hash"]
+			if "hashdeferred-{}".format(hashMethod) in self.ircd.functionCache:
+				resultDeferred = self.ircd.functionCache["hashdeferred-{}".format(hashMethod)](password)
+				resultDeferred.addCallbacks(self.completeSetPassword, self.hashFailed, (accountName, hashMethod, fromServer), None, ("Can't hash password with the configured hash method.",))
+				return None, resultDeferred, None
 			if "hash-{}".format(hashMethod) not in self.ircd.functionCache:
 				return False, "BADHASH", "Can't hash password with the configured hash method."
 			hashedPassword = self.ircd.functionCache["hash-{}".format(hashMethod)](password)
@@ -433,10 +502,20 @@ class Accounts(ModuleData):
 			if "compare-{}".format(hashMethod) not in self.ircd.functionCache:
 				return False, "BADHASH", "Provided hash method isn't loaded."
 			hashedPassword = password
+		return self.completeSetPassword(hashedPassword, accountName, hashMethod, fromServer)
+	
+	def completeSetPassword(self, hashedPassword: str, accountName: str, hashMethod: str, fromServer: Optional["IRCServer"]) -> Tuple[bool, Optional[str], Optional[str]]:
+		"""
+		Sets the password for an account after it has been hashed.
+		"""
+		lowerAccountName = ircLower(accountName)
+		if lowerAccountName not in self.accountData["data"]: # The account may have been deleted while the password was being hashed
+			return False, "BADACCOUNT", "The account does not exist."
 		self.accountData["data"][lowerAccountName]["password"] = hashedPassword
 		self.accountData["data"][lowerAccountName]["password-hash"] = hashMethod
 		updateTime = now()
 		self.accountData["data"][lowerAccountName]["updated"] = updateTime
+		self.ircd.storage.markDirty("services_accounts")
 		registerTime = self.accountData["data"][lowerAccountName]["registered"]
 		self.ircd.broadcastToServers(fromServer, "UPDATEACCOUNTPASS", timestampStringFromTime(updateTime), accountName, timestampStringFromTime(registerTime), hashedPassword, hashMethod, prefix=self.ircd.serverID)
 		return True, None, None
@@ -461,6 +540,7 @@ class Accounts(ModuleData):
 			del self.accountData["data"][lowerAccountName]["email"]
 		updateTime = now()
 		self.accountData["data"][lowerAccountName]["updated"] = updateTime
+		self.ircd.storage.markDirty("services_accounts")
 		registerTime = self.accountData["data"][lowerAccountName]["registered"]
 		self.ircd.broadcastToServers(fromServer, "UPDATEACCOUNTEMAIL", timestampStringFromTime(updateTime), accountName, timestampStringFromTime(registerTime), email, prefix=self.ircd.serverID)
 		self.ircd.runActionStandard("accountsetupindices", accountName)
@@ -493,6 +573,7 @@ class Accounts(ModuleData):
 		addTime = now()
 		self.accountData["data"][lowerAccountName]["nick"].append((newNick, addTime))
 		self.accountData["data"][lowerAccountName]["updated"] = addTime
+		self.ircd.storage.markDirty("services_accounts")
 		registerTime = self.accountData["data"][lowerAccountName]["registered"]
 		self.ircd.broadcastToServers(fromServer, "ADDACCOUNTNICK", timestampStringFromTime(addTime), accountName, timestampStringFromTime(registerTime), newNick, prefix=self.ircd.serverID)
 		self.ircd.runActionStandard("accountsetupindices", accountName)
@@ -521,6 +602,7 @@ class Accounts(ModuleData):
 				break
 		removeTime = now()
 		self.accountData["data"][lowerAccountName]["updated"] = removeTime
+		self.ircd.storage.markDirty("services_accounts")
 		registerTime = self.accountData["data"][lowerAccountName]["registered"]
 		self.ircd.broadcastToServers(fromServer, "REMOVEACCOUNTNICK", timestampStringFromTime(removeTime), accountName, timestampStringFromTime(registerTime), oldNick, prefix=self.ircd.serverID)
 		self.ircd.runActionStandard("accountsetupindices", accountName)
@@ -546,6 +628,7 @@ class Accounts(ModuleData):
 			self.accountData["data"][lowerAccountName]["metadata"][key] = value
 		setTime = now()
 		self.accountData["data"][lowerAccountName]["updated"] = setTime
+		self.ircd.storage.markDirty("services_accounts")
 		registerTime = self.accountData["data"][lowerAccountName]["registered"]
 		if value is None:
 			self.ircd.broadcastToServers(fromServer, "SETACCOUNTMETADATA", timestampStringFromTime(setTime), accountName, timestampStringFromTime(registerTime), key, prefix=self.ircd.serverID)
@@ -31,10 +31,18 @@ class ChannelRegister(ModuleData, Mode):
 	def load(self) -> None:
 		self.registeredChannels = CaseInsensitiveDictionary()
 		
-		if "services" not in self.ircd.storage:
-			self.ircd.storage["services"] = {}
-		if "channel" not in self.ircd.storage["services"]:
-			self.ircd.storage["services"]["channel"] = {}
+		if "services_channels" not in self.ircd.storage:
+			if "services" in self.ircd.storage and "channel" in self.ircd.storage["services"]:
+				# Channel data used to be stored together with the rest of the services data, so every change
+				# rewrote all of it. Move it to its own key.
+				servicesData = self.ircd.storage["services"]
+				self.ircd.storage["services_channels"] = servicesData.pop("channel")
+				if servicesData:
+					self.ircd.storage["services"] = servicesData
+				else:
+					del self.ircd.storage["services"]
+			else:
+				self.ircd.storage["services_channels"] = {}
 		self.setStorageReferences()
 		if "data" not in self.channelData:
 			self.channelData["data"] = {}
@@ -42,6 +50,8 @@ class ChannelRegister(ModuleData, Mode):
 			self.channelData["index"] = {}
 		if "regname" not in self.channelData["index"]:
 			self.channelData["index"]["regname"] = {}
+		self.ircd.storage.trackChanges("services_channels")
+		self.ircd.storage.markDirty("services_channels")
 		
 		if self.ircd.startupTime is not None:
 			self.setUpRegisteredChannels()
@@ -72,8 +82,7 @@ class ChannelRegister(ModuleData, Mode):
 			self.registeredChannels[channelName] = channel
 	
 	def setStorageReferences(self) -> None:
-		self.servicesData = self.ircd.storage["services"]
-		self.channelData = self.servicesData["channel"]
+		self.channelData = self.ircd.storage["services_channels"]
 	
 	def checkSettingUserAccount(self, channel: "IRCChannel", user: "IRCUser", adding: bool, parameter: str) -> Optional[bool]:
 		if adding:
@@ -138,6 +147,7 @@ class ChannelRegister(ModuleData, Mode):
 			del self.channelData["data"][channel.name]
 			self.channelData["index"]["regname"][parameter].remove(channel.name)
 			del self.registeredChannels[channel.name]
+		self.ircd.storage.markDirty("services_channels")
 	
 	def updateChannelModeData(self, channel: "IRCChannel", sourceID: str, sourceName: str, modeChanges: Tuple[bool, str, str, str, "datetime"]) -> None:
 		if channel.name not in self.channelData["data"]:
@@ -154,6 +164,7 @@ class ChannelRegister(ModuleData, Mode):
 			else:
 				modes.discard(modeChange[1:])
 		self.channelData["data"][channel.name]["modes"] = modes
+		self.ircd.storage.markDirty("services_channels")
 	
 	def updateChannelTopicData(self, channel: "IRCChannel", setter: str, setterName: str, oldTopic: str) -> None:
 		if channel.name not in self.channelData["data"]:
@@ -162,6 +173,7 @@ class ChannelRegister(ModuleData, Mode):
 		channelInfo["topic"] = channel.topic
 		channelInfo["topicsetter"] = setterName
 		channelInfo["topictime"] = channel.topicTime
+		self.ircd.storage.markDirty("services_channels")
 	
 	def unregisterForAccountDelete(self, accountName: str) -> None:
 		if accountName not in self.channelData["index"]["regname"]:
@@ -172,6 +184,7 @@ class ChannelRegister(ModuleData, Mode):
 			else:
 				del self.channelData["data"][channelName]
 		del self.channelData["index"]["regname"][accountName]
+		self.ircd.storage.markDirty("services_channels")
 	
 	def updateRegistrationForAccountRename(self, oldAccountName: str, newAccountName: str) -> None:
 		if oldAccountName not in self.channelData["index"]["regname"]:
@@ -186,6 +199,7 @@ class ChannelRegister(ModuleData, Mode):
 						modeData[1] = newAccountName
 		self.channelData["index"]["regname"][newAccountName] = self.channelData["index"]["regname"][oldAccountName]
 		del self.channelData["index"]["regname"][oldAccountName]
+		self.ircd.storage.markDirty("services_channels")
 	
 	def allowChannelOwnerToSetStatuses(self, channel: "IRCChannel", user: "IRCUser", mode: str, parameter: str) -> Optional[bool]:
 		if "r" not in channel.modes:
@@ -60,6 +60,7 @@ class BidService(ModuleData):
 			("AUCTIONREVERT", 1, ServerRevertCommand(self)) ]
 	
 	def load(self) -> None:
+		self.ircd.storage.trackChanges("auction")
 		if "unloading-bid-tags" in self.ircd.dataCache:
 			del self.ircd.dataCache["unloading-bid-tags"]
 		elif "cap-add" in self.ircd.functionCache:
@@ -344,6 +345,7 @@ class BidService(ModuleData):
 		self.ircd.storage["auction"]["state"] = "once"
 		self.ircd.storage["auction"]["state-time"] = stateTime
 		self.ircd.storage["auction"]["state-name"] = changeByName
+		self.ircd.storage.markDirty("auction")
 		if changingUser:
 			broadcastPrefix = changingUser.uuid
 		elif fromServer:
@@ -371,6 +373,7 @@ class BidService(ModuleData):
 		self.ircd.storage["auction"]["state"] = "twice"
 		self.ircd.storage["auction"]["state-time"] = stateTime
 		self.ircd.storage["auction"]["state-name"] = changeByName
+		self.ircd.storage.markDirty("auction")
 		if changingUser:
 			broadcastPrefix = changingUser.uuid
 		elif fromServer:
@@ -398,6 +401,7 @@ class BidService(ModuleData):
 		self.ircd.storage["auction"]["state"] = "bid"
 		self.ircd.storage["auction"]["state-time"] = stateTime
 		self.ircd.storage["auction"]["state-name"] = changeByName
+		self.ircd.storage.markDirty("auction")
 		if changingUser:
 			broadcastPrefix = changingUser.uuid
 		elif fromServer:
@@ -500,6 +504,7 @@ class BidService(ModuleData):
 					break
 			else:
 				auctionData["bids"].insert(0, bidData)
+		self.ircd.storage.markDirty("auction")
 		if announceBid:
 			announceTags["desertbus.org/bid"] = (self.bidTagValue(), self.conditionalTagsFilter)
 			self.announce("\x02\x0303{} has bid ${}! \x0304{}".format(biddingUser.nick, bidAmount, smackTalk), announceTags)
@@ -527,6 +532,7 @@ class BidService(ModuleData):
 			self.sendErrorToLocalOrRemoteUser(revertingUser, "BADAMOUNT", "That bid amount doesn't match any bids.")
 			return
 		del auctionData["bids"][bidIndex]
+		self.ircd.storage.markDirty("auction")
 		bidderName = bidData["bidder-name"]
 		announceTags = {
 			"desertbus.org/bid": (self.bidTagValue(), self.conditionalTagsFilter)
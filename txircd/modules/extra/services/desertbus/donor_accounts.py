@@ -28,6 +28,7 @@ class DBDonorAccount(ModuleData):
 		self.setStorageReferences()
 		if "donorid" not in self.accountData["index"]:
 			self.accountData["index"]["donorid"] = {}
+			self.ircd.storage.markDirty("services_accounts")
 	
 	def verifyConfig(self, config: Dict[str, Any]) -> None:
 		if "donor_linked_server" in config and config["donor_linked_server"] is not None:
@@ -37,8 +38,7 @@ class DBDonorAccount(ModuleData):
 			config["donor_linked_server"] = None
 	
 	def setStorageReferences(self) -> None:
-		self.servicesData = self.ircd.storage["services"]
-		self.accountData = self.servicesData["accounts"]
+		self.accountData = self.ircd.storage["services_accounts"]
 	
 	def indexDonorID(self, accountName: str) -> None:
 		lowerAccountName = ircLower(accountName)
@@ -134,6 +134,9 @@ class DBDonorAccount(ModuleData):
 					self.ircd.runActionUntilValue("deleteaccount", user.nick)
 					return metadataResult
 				lowerAccountName = ircLower(user.nick)
+			loginExtraCheckResult = self.ircd.runActionUntilValue("accountloginextracheck", user, lowerAccountName, users=[user])
+			if loginExtraCheckResult and not loginExtraCheckResult[0]:
+				return loginExtraCheckResult
 			accountName = self.accountData["data"][lowerAccountName]["username"]
 			user.setMetadata("account", accountName)
 			return True, None, None
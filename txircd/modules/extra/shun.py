@@ -5,7 +5,6 @@ from txircd.module_interface import Command, ICommand, IModuleData, ModuleData
 from txircd.modules.xlinebase import XLineBase
 from txircd.utils import durationToSeconds, ipAddressToShow, ircLower, now
 from zope.interface import implementer
-from fnmatch import fnmatchcase
 from typing import Any, Callable, Dict, List, Optional, Tuple
 
 @implementer(IPlugin, IModuleData)
@@ -32,6 +31,9 @@ class Shun(ModuleData, XLineBase):
 	def load(self) -> None:
 		self.initializeLineStorage()
 
+	def unload(self) -> Optional["Deferred"]:
+		self.stopUserSweep()
+
 	def verifyConfig(self, config: Dict[str, Any]) -> None:
 		if "shun_commands" in config:
 			if not isinstance(config["shun_commands"], list):
@@ -40,18 +42,10 @@ class Shun(ModuleData, XLineBase):
 				if not isinstance(command, str):
 					raise ConfigValidationError("shun_commands", "\"{}\" is not a valid command".format(command))
 	
-	def checkUserMatch(self, user: "IRCUser", mask: str, data: Optional[Dict[Any, Any]]) -> bool:
-		banMask = self.normalizeMask(mask)
-		userMask = ircLower("{}@{}".format(user.ident, user.host()))
-		if fnmatchcase(userMask, banMask):
-			return True
-		userMask = ircLower("{}@{}".format(user.ident, user.realHost))
-		if fnmatchcase(userMask, banMask):
-			return True
-		userMask = ircLower("{}@{}".format(user.ident, ipAddressToShow(user.ip)))
-		if fnmatchcase(userMask, banMask):
-			return True
-		return False
+	def userMatchStrings(self, user: "IRCUser", data: Optional[Dict[Any, Any]]) -> Optional[List[str]]:
+		return [ ircLower("{}@{}".format(user.ident, user.host())),
+		         ircLower("{}@{}".format(user.ident, user.realHost)),
+		         ircLower("{}@{}".format(user.ident, ipAddressToShow(user.ip))) ]
 	
 	def checkLines(self, user: "IRCUser") -> None:
 		if self.matchUser(user) is not None:
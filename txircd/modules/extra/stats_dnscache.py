@@ -0,0 +1,28 @@
+from twisted.plugin import IPlugin
+from txircd.module_interface import IModuleData, ModuleData
+from zope.interface import implementer
+from typing import Callable, Dict, List, Tuple
+
+@implementer(IPlugin, IModuleData)
+class StatsDNSCache(ModuleData):
+	name = "StatsDNSCache"
+
+	def actions(self) -> List[Tuple[str, int, Callable]]:
+		return [ ("statsruntype-dnscache", 10, self.listCacheStats) ]
+
+	def listCacheStats(self) -> Dict[str, str]:
+		resolver = self.ircd.hostResolver
+		lookups = resolver.cacheHits + resolver.cacheMisses + resolver.coalescedLookups
+		if lookups:
+			hitRate = "{:.1f}%".format((resolver.cacheHits + resolver.coalescedLookups) * 100 / lookups)
+		else:
+			hitRate = "n/a"
+		return {
+			"entries": "{}/{}".format(resolver.cacheSize(), self.ircd.config.get("dns_cache_size", 10000)),
+			"hits": str(resolver.cacheHits),
+			"coalesced": str(resolver.coalescedLookups),
+			"misses": str(resolver.cacheMisses),
+			"hitrate": hitRate
+		}
+
+statsDNSCache = StatsDNSCache()
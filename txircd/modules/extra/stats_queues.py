@@ -0,0 +1,30 @@
+from twisted.plugin import IPlugin
+from txircd.module_interface import IModuleData, ModuleData
+from zope.interface import implementer
+from typing import Callable, Dict, List, Tuple
+
+@implementer(IPlugin, IModuleData)
+class StatsQueues(ModuleData):
+	name = "StatsQueues"
+
+	def actions(self) -> List[Tuple[str, int, Callable]]:
+		return [ ("statsruntype-queues", 10, self.listQueues) ]
+
+	def listQueues(self) -> Dict[str, str]:
+		info = {}
+		for server in self.ircd.servers.values():
+			if server.nextClosest != self.ircd.serverID:
+				continue
+			info[server.name] = self.queueInfo(server, "server", self.ircd.config.get("server_sendq", 20971520))
+		for user in self.ircd.users.values():
+			if user.uuid[:3] != self.ircd.serverID or user.localOnly:
+				continue
+			if not user.sendQueueSize() and not user.recvQueueSize():
+				continue # Only list users that have something queued so that this doesn't list the whole server
+			info[user.nick if user.nick else user.uuid] = self.queueInfo(user, "user", self.ircd.config.get("user_sendq", 1048576))
+		return info
+
+	def queueInfo(self, connection: "IRCBase", connectionType: str, sendQueueLimit: int) -> str:
+		return "{} SendQ: {}/{} RecvQ: {}/{}".format(connectionType, connection.sendQueueSize(), sendQueueLimit if sendQueueLimit else "unlimited", connection.recvQueueSize(), connection.MAX_LENGTH)
+
+statsQueues = StatsQueues()
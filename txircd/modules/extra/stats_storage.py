@@ -0,0 +1,32 @@
+from twisted.plugin import IPlugin
+from txircd.module_interface import IModuleData, ModuleData
+from zope.interface import implementer
+from typing import Callable, Dict, List, Tuple
+import time
+
+@implementer(IPlugin, IModuleData)
+class StatsStorage(ModuleData):
+	name = "StatsStorage"
+
+	def actions(self) -> List[Tuple[str, int, Callable]]:
+		return [ ("statsruntype-storage", 10, self.listStorageStats) ]
+
+	def listStorageStats(self) -> Dict[str, str]:
+		storage = self.ircd.storage
+		stats = {
+			"backend": self.ircd.config.get("datastore_backend", "sqlite"),
+			"keys": str(len(storage)),
+			"syncing": "yes" if storage.syncInProgress else "no",
+			"skippedsyncs": str(storage.skippedSyncCount)
+		}
+		if storage.lastSyncTime is None:
+			stats["lastsync"] = "never"
+			return stats
+		stats["lastsync"] = "{} seconds ago".format(int(time.time() - storage.lastSyncTime))
+		stats["lastsyncduration"] = "{:.1f}ms".format(storage.lastSyncDuration * 1000)
+		stats["lastsyncsnapshot"] = "{:.1f}ms".format(storage.lastSyncSnapshotDuration * 1000)
+		stats["lastsynckeys"] = str(storage.lastSyncKeyCount)
+		stats["lastsyncbytes"] = str(storage.lastSyncSize)
+		return stats
+
+statsStorage = StatsStorage()
@@ -1,4 +1,3 @@
-from twisted.internet import reactor
 from twisted.plugin import IPlugin
 from twisted.words.protocols import irc
 from txircd.module_interface import Command, ICommand, IModuleData, ModuleData
@@ -167,7 +166,7 @@ class TimedModes(ModuleData, Command):
 					continue
 				mode = modeChange[1]
 				param = modeChange[2]
-				newTimer = reactor.callLater(durationSeconds, self.removeChannelMode, channel.name, channel.existedSince, mode, param)
+				newTimer = self.ircd.timers.callLater(durationSeconds, self.removeChannelMode, channel.name, channel.existedSince, mode, param)
 				if channel.name not in self.ircd.dataCache["channel-mode-timers"]:
 					self.ircd.dataCache["channel-mode-timers"][channel.name] = (channel.existedSince, {})
 				if mode not in self.ircd.dataCache["channel-mode-timers"][channel.name][1]:
@@ -186,7 +185,7 @@ class TimedModes(ModuleData, Command):
 					continue
 				mode = modeChange[1]
 				param = modeChange[2]
-				newTimer = reactor.callLater(durationSeconds, self.removeUserMode, user.uuid, mode, param)
+				newTimer = self.ircd.timers.callLater(durationSeconds, self.removeUserMode, user.uuid, mode, param)
 				if user.uuid not in self.ircd.dataCache["user-mode-timers"]:
 					self.ircd.dataCache["user-mode-timers"][user.uuid] = {}
 				if mode not in self.ircd.dataCache["user-mode-timers"][user.uuid]:
@@ -71,6 +71,7 @@ class WebIRC(ModuleData, Command):
 			self.ircd.log.info("WEBIRC detected for IP \"{userip}\"; changing {user.uuid}'s IP to \"{requestip}\" and their real host to \"{requesthost}\".", user=user, userip=ipAddressToShow(user.ip), requestip=requestIP, requesthost=host)
 			user.changeIP(ip_address(requestIP))
 			user.realHost = host
+			self.ircd.userIndex.updateUser(user)
 			user.register("WEBIRC")
 			return
 		self.useIPFallback(user, host, requestIP)
@@ -83,5 +84,6 @@ class WebIRC(ModuleData, Command):
 		self.ircd.log.warn("DNS resolution for WEBIRC command from IP \"{userip}\" with requested IP \"{requestip}\" and requested host \"{requesthost}\" has failed; using the requested IP address as the host instead.", user=user, userip=ipAddressToShow(user.ip), requestip=requestIP, requesthost=host)
 		user.changeIP(ip_address(requestIP))
 		user.realHost = requestIP
+		self.ircd.userIndex.updateUser(user)
 
 webirc = WebIRC()
\ No newline at end of file
@@ -3,8 +3,9 @@ from txircd.config import ConfigValidationError
 from txircd.module_interface import IMode, IModuleData, Mode, ModuleData
 from txircd.utils import ModeType, now, isoTime
 from zope.interface import implementer
-from datetime import timedelta
+from collections import deque
 from typing import Any, Dict, List, Optional, Union
+import time
 
 @implementer(IPlugin, IModuleData, IMode)
 class ChanHistory(ModuleData, Mode):
@@ -64,35 +65,51 @@ class ChanHistory(ModuleData, Mode):
 			user, data = params
 			if channel not in data["targetchans"]:
 				return
-			if "history" not in channel.cache:
-				channel.cache["history"] = []
-			channel.cache["history"].append((now(), "PRIVMSG" if actionName == "commandextra-PRIVMSG" else "NOTICE", user.hostmask(), data["targetchans"][channel]))
-			if len(channel.cache["history"]) > maxLines:
-				channel.cache["history"] = channel.cache["history"][-maxLines:]
+			self.addHistory(channel, maxLines, "PRIVMSG" if actionName == "commandextra-PRIVMSG" else "NOTICE", user.hostmask(), data["targetchans"][channel])
 		elif actionName == "servercommandextra-PRIVMSG" or actionName == "servercommandextra-NOTICE":
 			fromServer, data = params
 			if "tochan" not in data or channel != data["tochan"]:
 				return
-			if "history" not in channel.cache:
-				channel.cache["history"] = []
-			channel.cache["history"].append((now(), "PRIVMSG" if actionName == "servercommandextra-PRIVMSG" else "NOTICE", data["from"].hostmask(), data["message"]))
-			if len(channel.cache["history"]) > maxLines:
-				channel.cache["history"] = channel.cache["history"][-maxLines:]
+			self.addHistory(channel, maxLines, "PRIVMSG" if actionName == "servercommandextra-PRIVMSG" else "NOTICE", data["from"].hostmask(), data["message"])
 		elif actionName == "join" and "history" in channel.cache:
 			actionChannel, user, fromServer = params
+			history = channel.cache["history"]
+			replayStart = 0
+			if seconds > 0:
+				replayStart = self.firstHistoryIndexAfter(history, time.monotonic() - seconds)
 			user.sendMessage("NOTICE", "*** Replaying up to {} lines of history for {}{}...".format(maxLines, channel.name, " spanning up to {} seconds".format(seconds) if seconds > 0 else ""))
 			hasServerTime = "capabilities" in user.cache and "server-time" in user.cache["capabilities"]
 			user.createMessageBatch("ChannelHistory", "chathistory", [channel.name])
-			for messageData in channel.cache["history"]:
-				if seconds == 0 or now() - timedelta(seconds=seconds) < messageData[0]:
-					messageArgs = {
-						"prefix": messageData[2],
-						"to": channel.name
-					}
-					if hasServerTime:
-						messageArgs["tags"] = { "time": isoTime(messageData[0]) }
-					user.sendMessageInBatch("ChannelHistory", messageData[1], messageData[3], **messageArgs)
+			for index in range(max(replayStart, len(history) - maxLines), len(history)):
+				messageTime, command, hostmask, message, timeTag, messageCache = history[index]
+				messageArgs = {
+					"prefix": hostmask,
+					"to": channel.name
+				}
+				if hasServerTime:
+					messageArgs["tags"] = { "time": timeTag }
+				user.sendMessageInBatchWithMessageCache("ChannelHistory", messageCache, command, message, **messageArgs)
 			user.sendBatch("ChannelHistory")
 			user.sendMessage("NOTICE", "*** End of {} channel history.".format(channel.name))
 
+	def addHistory(self, channel: "IRCChannel", maxLines: int, command: str, hostmask: str, message: str) -> None:
+		# Each entry keeps its own message cache so that the formatted message is shared by everyone it's replayed to
+		if "history" not in channel.cache:
+			channel.cache["history"] = deque(maxlen=maxLines)
+		elif channel.cache["history"].maxlen != maxLines:
+			channel.cache["history"] = deque(channel.cache["history"], maxlen=maxLines)
+		channel.cache["history"].append((time.monotonic(), command, hostmask, message, isoTime(now()), {}))
+
+	def firstHistoryIndexAfter(self, history: "deque", cutoffTime: float) -> int:
+		# History entries are in time order, so we can binary search for the first entry newer than the cutoff
+		low = 0
+		high = len(history)
+		while low < high:
+			middle = (low + high) // 2
+			if history[middle][0] <= cutoffTime:
+				low = middle + 1
+			else:
+				high = middle
+		return low
+
 chanHistory = ChanHistory()
\ No newline at end of file
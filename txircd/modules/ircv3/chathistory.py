@@ -0,0 +1,267 @@
+from twisted.plugin import IPlugin
+from twisted.words.protocols import irc
+from txircd.config import ConfigValidationError
+from txircd.module_interface import Command, ICommand, IModuleData, ModuleData
+from txircd.modules.messagestore import MessageStore
+from txircd.utils import isoTime, now
+from zope.interface import implementer
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+unixEpoch = datetime.utcfromtimestamp(0)
+segmentDuration = 86400000 # Start a new segment at least daily so that retention can remove old messages promptly
+
+@implementer(IPlugin, IModuleData, ICommand)
+class ChatHistory(ModuleData, Command):
+	name = "ChatHistory"
+	
+	def actions(self) -> List[Tuple[str, int, Callable]]:
+		return [ ("commandextra-PRIVMSG", 1, self.storeMessage),
+		         ("commandextra-NOTICE", 1, self.storeNotice),
+		         ("servercommandextra-PRIVMSG", 1, self.storeMessageServer),
+		         ("servercommandextra-NOTICE", 1, self.storeNoticeServer),
+		         ("capabilitylist", 1, self.addCapability),
+		         ("buildisupport", 1, self.buildISupport) ]
+	
+	def userCommands(self) -> List[Tuple[str, int, Command]]:
+		return [ ("CHATHISTORY", 1, self) ]
+	
+	def load(self) -> None:
+		self.openStore()
+		self.flushTimer = self.ircd.timers.callEvery(1, self.flushStore)
+		self.expireTimer = self.ircd.timers.callEvery(3600, self.expireHistory)
+		if "unloading-chathistory" in self.ircd.dataCache:
+			del self.ircd.dataCache["unloading-chathistory"]
+			return
+		if "cap-add" in self.ircd.functionCache:
+			self.ircd.functionCache["cap-add"]("draft/chathistory")
+	
+	def rehash(self) -> None:
+		if self.store.directory != self.ircd.config["chathistory_directory"] or self.store.segmentSize != self.ircd.config["chathistory_segment_size"]:
+			self.store.close()
+			self.openStore()
+	
+	def unload(self) -> Optional["Deferred"]:
+		self.flushTimer.cancel()
+		self.expireTimer.cancel()
+		self.store.close()
+		self.ircd.dataCache["unloading-chathistory"] = True
+	
+	def fullUnload(self) -> Optional["Deferred"]:
+		del self.ircd.dataCache["unloading-chathistory"]
+		if "cap-del" in self.ircd.functionCache:
+			self.ircd.functionCache["cap-del"]("draft/chathistory")
+	
+	def verifyConfig(self, config: Dict[str, Any]) -> None:
+		if "chathistory_directory" in config:
+			if not isinstance(config["chathistory_directory"], str):
+				raise ConfigValidationError("chathistory_directory", "must be a string representing the directory")
+		else:
+			config["chathistory_directory"] = "chathistory"
+		if "chathistory_retention_days" in config:
+			if not isinstance(config["chathistory_retention_days"], int) or config["chathistory_retention_days"] < 0:
+				raise ConfigValidationError("chathistory_retention_days", "invalid number")
+		else:
+			config["chathistory_retention_days"] = 30
+		if "chathistory_segment_size" in config:
+			if not isinstance(config["chathistory_segment_size"], int) or config["chathistory_segment_size"] < 4096:
+				raise ConfigValidationError("chathistory_segment_size", "invalid number (must be at least 4096)")
+		else:
+			config["chathistory_segment_size"] = 4194304
+		if "chathistory_limit" in config:
+			if not isinstance(config["chathistory_limit"], int) or config["chathistory_limit"] < 1:
+				raise ConfigValidationError("chathistory_limit", "invalid number")
+		else:
+			config["chathistory_limit"] = 100
+	
+	def openStore(self) -> None:
+		self.store = MessageStore(self.ircd.config["chathistory_directory"], self.ircd.config["chathistory_segment_size"], segmentDuration)
+	
+	def flushStore(self) -> None:
+		self.store.flush()
+	
+	def expireHistory(self) -> None:
+		self.store.closeLogsExcept(self.ircd.channels) # Logs for channels that no longer exist would otherwise stay loaded forever
+		retentionDays = self.ircd.config["chathistory_retention_days"]
+		if retentionDays:
+			self.store.expire(self.timeToMilliseconds(now() - timedelta(days=retentionDays)))
+	
+	def addCapability(self, user: "IRCUser", capList: List[str]) -> None:
+		capList.append("draft/chathistory")
+	
+	def buildISupport(self, data: Dict[str, Union[str, int]]) -> None:
+		data["CHATHISTORY"] = self.ircd.config["chathistory_limit"]
+		data["MSGREFTYPES"] = "timestamp,msgid"
+	
+	def timeToMilliseconds(self, time: datetime) -> int:
+		return (time - unixEpoch) // timedelta(milliseconds=1)
+	
+	def storeMessage(self, user: "IRCUser", data: Dict[Any, Any]) -> None:
+		if "targetchans" not in data:
+			return
+		for channel, message in data["targetchans"].items():
+			self.store.log(channel.name).append(self.timeToMilliseconds(now()), "PRIVMSG", user.hostmask(), message)
+	
+	def storeNotice(self, user: "IRCUser", data: Dict[Any, Any]) -> None:
+		if "targetchans" not in data:
+			return
+		for channel, message in data["targetchans"].items():
+			self.store.log(channel.name).append(self.timeToMilliseconds(now()), "NOTICE", user.hostmask(), message)
+	
+	def storeMessageServer(self, server: "IRCServer", data: Dict[Any, Any]) -> None:
+		if "tochan" not in data:
+			return
+		self.store.log(data["tochan"].name).append(self.timeToMilliseconds(now()), "PRIVMSG", data["from"].hostmask(), data["message"])
+	
+	def storeNoticeServer(self, server: "IRCServer", data: Dict[Any, Any]) -> None:
+		if "tochan" not in data:
+			return
+		self.store.log(data["tochan"].name).append(self.timeToMilliseconds(now()), "NOTICE", data["from"].hostmask(), data["message"])
+	
+	def parseReference(self, reference: str) -> Optional[Tuple[str, Union[str, int]]]:
+		referenceType, hasValue, value = reference.partition("=")
+		if not hasValue or not value:
+			return None
+		if referenceType == "msgid":
+			return ("msgid", value)
+		if referenceType == "timestamp":
+			for timeFormat in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+				try:
+					return ("timestamp", self.timeToMilliseconds(datetime.strptime(value, timeFormat)))
+				except ValueError:
+					pass
+		return None
+	
+	def parseParams(self, user: "IRCUser", params: List[str], prefix: str, tags: Dict[str, Optional[str]]) -> Optional[Dict[Any, Any]]:
+		if len(params) < 4:
+			user.sendSingleError("ChatHistoryParams", irc.ERR_NEEDMOREPARAMS, "CHATHISTORY", "Not enough parameters")
+			return None
+		subcmd = params[0].upper()
+		if subcmd not in ("LATEST", "BEFORE", "AFTER", "AROUND", "BETWEEN"):
+			user.sendSingleError("ChatHistorySubcmd", "FAIL", "CHATHISTORY", "INVALID_PARAMS", params[0], "Unknown subcommand", to=None)
+			return None
+		referenceCount = 2 if subcmd == "BETWEEN" else 1
+		if len(params) < 3 + referenceCount:
+			user.sendSingleError("ChatHistoryParams", irc.ERR_NEEDMOREPARAMS, "CHATHISTORY", "Not enough parameters")
+			return None
+		references = []
+		for reference in params[2:2 + referenceCount]:
+			if subcmd == "LATEST" and reference == "*":
+				references.append(None)
+				continue
+			parsedReference = self.parseReference(reference)
+			if parsedReference is None:
+				user.sendSingleError("ChatHistoryReference", "FAIL", "CHATHISTORY", "INVALID_PARAMS", subcmd, reference, "Invalid message reference", to=None)
+				return None
+			references.append(parsedReference)
+		try:
+			limit = int(params[2 + referenceCount])
+		except ValueError:
+			limit = -1
+		if limit < 0:
+			user.sendSingleError("ChatHistoryLimit", "FAIL", "CHATHISTORY", "INVALID_PARAMS", subcmd, params[2 + referenceCount], "Invalid limit", to=None)
+			return None
+		if limit == 0 or limit > self.ircd.config["chathistory_limit"]:
+			limit = self.ircd.config["chathistory_limit"]
+		target = params[1]
+		if target not in self.ircd.channels or user not in self.ircd.channels[target].users:
+			user.sendSingleError("ChatHistoryTarget", "FAIL", "CHATHISTORY", "INVALID_TARGET", subcmd, target, "You can't view the history of that target", to=None)
+			return None
+		return {
+			"subcmd": subcmd,
+			"channel": self.ircd.channels[target],
+			"references": references,
+			"limit": limit
+		}
+	
+	def affectedChannels(self, user: "IRCUser", data: Dict[Any, Any]) -> List["IRCChannel"]:
+		return [ data["channel"] ]
+	
+	def execute(self, user: "IRCUser", data: Dict[Any, Any]) -> bool:
+		channel = data["channel"]
+		messageLog = self.store.log(channel.name)
+		try:
+			records = self.findRecords(messageLog, data["subcmd"], data["references"], data["limit"])
+		finally:
+			messageLog.endQuery()
+		hasServerTime = "capabilities" in user.cache and "server-time" in user.cache["capabilities"]
+		hasMessageIDs = "capabilities" in user.cache and "draft/chathistory" in user.cache["capabilities"]
+		user.createMessageBatch("ChatHistory", "chathistory", [channel.name])
+		for position, recordTime, msgid, command, prefix, message in records:
+			messageTags = {}
+			if hasServerTime:
+				messageTags["time"] = isoTime(unixEpoch + timedelta(milliseconds=recordTime))
+			if hasMessageIDs:
+				messageTags["msgid"] = msgid
+			user.sendMessageInBatch("ChatHistory", command, message, prefix=prefix, to=channel.name, tags=messageTags)
+		user.sendBatch("ChatHistory")
+		return True
+	
+	def referenceBounds(self, messageLog: "MessageLog", reference: Tuple[str, Union[str, int]]) -> Optional[Tuple[Tuple[int, int], Tuple[int, int]]]:
+		"""
+		Returns the positions that messages before and messages after the
+		referenced message or time start from.
+		"""
+		referenceType, value = reference
+		if referenceType == "timestamp":
+			return (messageLog.positionForTime(value, True), messageLog.positionForTime(value, False))
+		position = messageLog.positionForMsgid(value)
+		if position is None:
+			return None
+		return (position, messageLog.positionAfter(position))
+	
+	def findRecords(self, messageLog: "MessageLog", subcmd: str, references: List[Optional[Tuple[str, Union[str, int]]]], limit: int) -> List["MessageRecord"]:
+		if not messageLog:
+			return []
+		bounds = []
+		for reference in references:
+			if reference is None:
+				bounds.append(None)
+				continue
+			referenceBounds = self.referenceBounds(messageLog, reference)
+			if referenceBounds is None:
+				return [] # Messages that don't exist (or have expired) have nothing around them
+			bounds.append(referenceBounds)
+		if subcmd == "LATEST":
+			stopPosition = bounds[0][1] if bounds[0] else messageLog.startPosition()
+			return self.recordsBackward(messageLog, messageLog.endPosition(), stopPosition, limit)
+		if subcmd == "BEFORE":
+			return self.recordsBackward(messageLog, bounds[0][0], messageLog.startPosition(), limit)
+		if subcmd == "AFTER":
+			return self.recordsForward(messageLog, bounds[0][1], messageLog.endPosition(), limit)
+		if subcmd == "AROUND":
+			records = self.recordsBackward(messageLog, bounds[0][0], messageLog.startPosition(), limit // 2)
+			records.extend(self.recordsForward(messageLog, bounds[0][0], messageLog.endPosition(), limit - len(records)))
+			return records
+		# BETWEEN
+		firstBounds, secondBounds = bounds
+		if firstBounds[1] <= secondBounds[0]:
+			return self.recordsForward(messageLog, firstBounds[1], secondBounds[0], limit)
+		return self.recordsBackward(messageLog, firstBounds[0], secondBounds[1], limit)
+	
+	def recordsForward(self, messageLog: "MessageLog", startPosition: Tuple[int, int], stopPosition: Tuple[int, int], limit: int) -> List["MessageRecord"]:
+		records = []
+		if limit < 1:
+			return records
+		for record in messageLog.recordsFrom(startPosition):
+			if record[0] >= stopPosition:
+				break
+			records.append(record)
+			if len(records) >= limit:
+				break
+		return records
+	
+	def recordsBackward(self, messageLog: "MessageLog", endPosition: Tuple[int, int], stopPosition: Tuple[int, int], limit: int) -> List["MessageRecord"]:
+		records = []
+		if limit < 1:
+			return records
+		for record in messageLog.recordsBefore(endPosition):
+			if record[0] < stopPosition:
+				break
+			records.append(record)
+			if len(records) >= limit:
+				break
+		records.reverse()
+		return records
+
+chatHistory = ChatHistory()
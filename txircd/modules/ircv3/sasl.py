@@ -1,9 +1,12 @@
 from twisted.plugin import IPlugin
 from twisted.words.protocols import irc
+from txircd.config import ConfigValidationError
 from txircd.module_interface import Command, ICommand, IModuleData, ModuleData
+from txircd.modules.fairqueue import FairQueue
 from txircd.utils import lenBytes
 from zope.interface import implementer
 from typing import Any, Callable, Dict, List, Optional, Tuple
+import time
 
 irc.RPL_SASLSUCCESS = "903"
 irc.ERR_SASLFAIL = "904"
@@ -19,12 +22,27 @@ class SASL(ModuleData, Command):
 	def actions(self) -> List[Tuple[str, int, Callable]]:
 		return [ ("capabilitylist", 10, self.addCapability),
 		         ("saslcomplete", 1, self.completeSASL),
-		         ("register", 1, self.clearSASLonRegister) ]
+		         ("register", 1, self.clearSASLonRegister),
+		         ("quit", 10, self.removeQueuedUser),
+		         ("statsruntype-sasl", 10, self.listSASLStats) ]
 	
 	def userCommands(self) -> List[Tuple[str, int, Command]]:
 		return [ ("AUTHENTICATE", 1, self) ]
 	
 	def load(self) -> None:
+		# Authentication can be slow (hashing passwords, asking other servers), so completed SASL exchanges are
+		# queued and only a limited number are authenticated at a time. The queue takes each IP address in turn,
+		# so many connections from one address can't hold up everyone else.
+		self.authQueue = FairQueue(self.ircd.config.get("sasl_queue_size", 1000), self.ircd.config.get("sasl_queue_per_ip", 3))
+		self.queuedAuths = {}
+		self.activeAuths = {}
+		self.dispatching = False
+		self.completedCount = 0
+		self.rejectedCount = 0
+		self.totalWaitTime = 0
+		self.maxWaitTime = 0
+		self.totalLatency = 0
+		self.maxLatency = 0
 		self.ircd.functionCache["saslmech-add"] = self.addSASLMech
 		self.ircd.functionCache["saslmech-del"] = self.removeSASLMech
 		if "unloading-sasl" in self.ircd.dataCache:
@@ -34,7 +52,29 @@ class SASL(ModuleData, Command):
 		if saslMechanisms and "cap-add" in self.ircd.functionCache:
 			self.ircd.functionCache["cap-add"]("sasl={}".format(",".join(saslMechanisms)))
 	
+	def rehash(self) -> None:
+		self.authQueue.maxSize = self.ircd.config.get("sasl_queue_size", 1000)
+		self.authQueue.maxPerKey = self.ircd.config.get("sasl_queue_per_ip", 3)
+		self.dispatchQueued()
+	
 	def unload(self) -> Optional["Deferred"]:
+		while self.authQueue:
+			ip, user = self.authQueue.pop()
+			del self.queuedAuths[user]
+			user.sendMessage(irc.ERR_SASLABORTED, "SASL authentication aborted")
+			self.cleanup(user)
+			user.register("SASL")
+		for user, (queueTime, startTime, aborted) in list(self.activeAuths.items()):
+			if aborted:
+				continue
+			# The result of an authentication that's still running would come back to this module after it's gone, so
+			# the user is released now. The authentication is marked as aborted in case its result still arrives.
+			self.activeAuths[user] = (queueTime, startTime, True)
+			if user.uuid not in self.ircd.users:
+				continue
+			user.sendMessage(irc.ERR_SASLABORTED, "SASL authentication aborted")
+			self.cleanup(user)
+			user.register("SASL")
 		self.ircd.dataCache["unloading-sasl"] = True
 		del self.ircd.functionCache["saslmech-add"]
 		del self.ircd.functionCache["saslmech-del"]
@@ -54,13 +94,104 @@ class SASL(ModuleData, Command):
 		else:
 			capList.append("sasl")
 	
+	def verifyConfig(self, config: Dict[str, Any]) -> None:
+		for configKey in ("sasl_max_concurrent", "sasl_queue_size", "sasl_queue_per_ip"):
+			if configKey in config and (not isinstance(config[configKey], int) or config[configKey] < 1):
+				raise ConfigValidationError(configKey, "invalid number")
+	
 	def completeSASL(self, user: "IRCUser", success: bool) -> None:
-		if success:
-			user.sendMessage(irc.RPL_SASLSUCCESS, "SASL authentication successful")
-		else:
+		activeAuth = self.activeAuths.pop(user, None)
+		aborted = False
+		if activeAuth:
+			queueTime, startTime, aborted = activeAuth
+			self.recordCompletion(queueTime)
+		# Results for authentications this module doesn't know about (such as ones it released while it was
+		# being reloaded) are only used if the user is still waiting for one.
+		if user.uuid in self.ircd.users and not aborted and "sasl-processing" in user.cache:
+			if success:
+				user.sendMessage(irc.RPL_SASLSUCCESS, "SASL authentication successful")
+			else:
+				user.sendMessage(irc.ERR_SASLFAIL, "SASL authentication failed")
+			self.cleanup(user)
+			user.register("SASL")
+		self.dispatchQueued()
+	
+	def recordCompletion(self, queueTime: float) -> None:
+		latency = time.monotonic() - queueTime
+		self.completedCount += 1
+		self.totalLatency += latency
+		if latency > self.maxLatency:
+			self.maxLatency = latency
+	
+	def queueAuthentication(self, user: "IRCUser") -> None:
+		if user in self.activeAuths or not self.authQueue.push(user.ip, user):
+			# Users whose previous (aborted) authentication is still running can't start another one until it's done
+			self.rejectedCount += 1
+			self.cleanup(user)
 			user.sendMessage(irc.ERR_SASLFAIL, "SASL authentication failed")
+			return
+		self.queuedAuths[user] = (user.ip, time.monotonic())
+		user.cache["sasl-processing"] = True
+		user.addRegisterHold("SASL")
+		self.dispatchQueued()
+	
+	def dispatchQueued(self) -> None:
+		if self.dispatching:
+			return # Authentications that finish right away call back into this, so the loop that's already running will continue
+		self.dispatching = True
+		try:
+			while self.authQueue and len(self.activeAuths) < self.ircd.config.get("sasl_max_concurrent", 16):
+				ip, user = self.authQueue.pop()
+				queueIP, queueTime = self.queuedAuths.pop(user)
+				if user.uuid not in self.ircd.users:
+					continue
+				self.startAuthentication(user, queueTime)
+		finally:
+			self.dispatching = False
+	
+	def startAuthentication(self, user: "IRCUser", queueTime: float) -> None:
+		startTime = time.monotonic()
+		waitTime = startTime - queueTime
+		self.totalWaitTime += waitTime
+		if waitTime > self.maxWaitTime:
+			self.maxWaitTime = waitTime
+		self.activeAuths[user] = (queueTime, startTime, False)
+		# We run this action to authenticate users via SASL, passing the SASL data we received from the client.
+		# The action returns values of the following:
+		# - False (do not authenticate)
+		# - None (was not processed)
+		# - True (authenticated)
+		# - "defer" (we're still processing the result and will let you know later by calling completeSASL as to the result)
+		result = self.ircd.runActionUntilValue("authenticatesasl", user, user.cache["sasl-data"])
+		if result == "defer":
+			return
+		self.completeSASL(user, bool(result))
+	
+	def removeQueuedUser(self, user: "IRCUser", reason: str, fromServer: "IRCServer" = None) -> None:
+		if "sasl-processing" in user.cache:
+			self.abortAuthentication(user)
+	
+	def abortAuthentication(self, user: "IRCUser") -> None:
+		if user in self.queuedAuths:
+			queueIP, queueTime = self.queuedAuths.pop(user)
+			self.authQueue.remove(queueIP, user)
+		if user in self.activeAuths:
+			# We can't stop an authentication that has already started, but we can ignore its result.
+			queueTime, startTime, aborted = self.activeAuths[user]
+			self.activeAuths[user] = (queueTime, startTime, True)
 		self.cleanup(user)
 	
+	def listSASLStats(self) -> Dict[str, str]:
+		startedCount = self.completedCount + len(self.activeAuths)
+		return {
+			"queued": "{}/{}".format(len(self.authQueue), self.authQueue.maxSize),
+			"active": "{}/{}".format(len(self.activeAuths), self.ircd.config.get("sasl_max_concurrent", 16)),
+			"completed": str(self.completedCount),
+			"rejected": str(self.rejectedCount),
+			"queuewait": "avg {:.1f}ms, max {:.1f}ms".format(self.totalWaitTime * 1000 / startedCount if startedCount else 0, self.maxWaitTime * 1000),
+			"latency": "avg {:.1f}ms, max {:.1f}ms".format(self.totalLatency * 1000 / self.completedCount if self.completedCount else 0, self.maxLatency * 1000)
+		}
+	
 	def clearSASLonRegister(self, user: "IRCUser") -> bool:
 		if "sasl-mech" in user.cache and "sasl-processing" not in user.cache:
 			user.sendMessage(irc.ERR_SASLABORTED, "SASL authentication aborted")
@@ -115,9 +246,15 @@ class SASL(ModuleData, Command):
 			user.sendMessage(irc.ERR_SASLFAIL, "SASL authentication failed")
 			return True
 		if payload == "*":
-			self.cleanup(user)
 			user.sendMessage(irc.ERR_SASLABORTED, "SASL authentication aborted")
+			if "sasl-processing" in user.cache:
+				self.abortAuthentication(user)
+				user.register("SASL")
+			else:
+				self.cleanup(user)
 			return True
+		if "sasl-processing" in user.cache:
+			return True # The client already sent its data; everything but an abort is ignored until we have a result
 		if lenBytes(payload) == 400:
 			if "sasl-data" not in user.cache:
 				user.cache["sasl-data"] = payload
@@ -131,21 +268,7 @@ class SASL(ModuleData, Command):
 				user.cache["sasl-data"] += payload
 		elif "sasl-data" not in user.cache:
 			user.cache["sasl-data"] = ""
-		
-		# We run this action to authenticate users via SASL, passing the SASL data we received from the client.
-		# The action returns values of the following:
-		# - False (do not authenticate)
-		# - None (was not processed)
-		# - True (authenticated)
-		# - "defer" (we're still processing the result and will let you know later by calling completeSASL as to the result)
-		result = self.ircd.runActionUntilValue("authenticatesasl", user, user.cache["sasl-data"])
-		if result == "defer":
-			return True
-		self.cleanup(user)
-		if result:
-			user.sendMessage(irc.RPL_SASLSUCCESS, "SASL authentication successful")
-		else:
-			user.sendMessage(irc.ERR_SASLFAIL, "SASL authentication failed")
+		self.queueAuthentication(user)
 		return True
 
 sasl = SASL()
\ No newline at end of file
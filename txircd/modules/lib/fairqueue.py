@@ -0,0 +1,67 @@
+from collections import deque, OrderedDict
+from typing import Any, Hashable, Tuple
+
+class FairQueue(object):
+	"""
+	A bounded queue that serves its keys in turn. Items with the same key are
+	taken in the order they were added, but each key only gets one item taken
+	before every other key with items waiting has had one taken, so a key with
+	many items can't hold up the others.
+	"""
+	def __init__(self, maxSize: int, maxPerKey: int):
+		self.maxSize = maxSize
+		self.maxPerKey = maxPerKey
+		self._queues = OrderedDict()
+		self._size = 0
+	
+	def __len__(self) -> int:
+		return self._size
+	
+	def push(self, key: Hashable, item: Any) -> bool:
+		"""
+		Adds an item to the queue for the given key. Returns False without
+		adding the item if the queue or the key's part of it is full.
+		"""
+		if self._size >= self.maxSize:
+			return False
+		if key in self._queues:
+			keyQueue = self._queues[key]
+			if len(keyQueue) >= self.maxPerKey:
+				return False
+		else:
+			keyQueue = deque()
+			self._queues[key] = keyQueue
+		keyQueue.append(item)
+		self._size += 1
+		return True
+	
+	def pop(self) -> Tuple[Hashable, Any]:
+		"""
+		Removes and returns the next key and item. Raises IndexError if the
+		queue is empty.
+		"""
+		if not self._queues:
+			raise IndexError("pop from an empty FairQueue")
+		key, keyQueue = self._queues.popitem(False)
+		item = keyQueue.popleft()
+		if keyQueue:
+			self._queues[key] = keyQueue # Goes to the back of the line
+		self._size -= 1
+		return key, item
+	
+	def remove(self, key: Hashable, item: Any) -> bool:
+		"""
+		Removes the given item from the key's queue. Returns whether it was in
+		the queue.
+		"""
+		if key not in self._queues:
+			return False
+		keyQueue = self._queues[key]
+		try:
+			keyQueue.remove(item)
+		except ValueError:
+			return False
+		if not keyQueue:
+			del self._queues[key]
+		self._size -= 1
+		return True
@@ -0,0 +1,168 @@
+from fnmatch import translate
+from typing import Dict, Hashable, Iterable, Optional, Pattern, Tuple, Union
+import re
+
+class MaskMatcher(object):
+	"""
+	Matches strings against an ordered collection of glob masks (as matched by
+	fnmatchcase). Masks without wildcards are looked up directly. All other
+	masks are grouped by their literal prefix or suffix, and each group is
+	combined into a single regular expression, so checking a string only runs
+	the expressions for groups that could match it. Adding or removing a mask
+	only requires the expression for its own group to be rebuilt.
+	Masks are matched exactly as given, so anything that should match
+	case-insensitively should be lowered before being added or matched.
+	"""
+	indexLength = 8
+	
+	def __init__(self):
+		self._masks = {}
+		self._order = {}
+		self._nextOrder = 0
+		self._literals = {}
+		self._groups = {}
+		self._groupPatterns = {}
+		self._prefixLengths = {}
+		self._suffixLengths = {}
+		self._sortedPrefixLengths = []
+		self._sortedSuffixLengths = []
+	
+	def __len__(self) -> int:
+		return len(self._masks)
+	
+	def __contains__(self, key: Hashable) -> bool:
+		return key in self._masks
+	
+	def add(self, key: Hashable, mask: str) -> None:
+		"""
+		Adds a mask identified by the given key. Masks added earlier take
+		precedence over masks added later when finding the first match.
+		"""
+		if key in self._masks:
+			self.remove(key)
+		groupKey = self._groupKey(mask)
+		self._masks[key] = (mask, groupKey)
+		self._order[key] = self._nextOrder
+		self._nextOrder += 1
+		if groupKey is False:
+			if mask not in self._literals:
+				self._literals[mask] = {}
+			self._literals[mask][key] = None
+			return
+		if groupKey not in self._groups:
+			self._groups[groupKey] = {}
+			self._countGroupLength(groupKey, 1)
+		self._groups[groupKey][key] = mask
+		self._groupPatterns.pop(groupKey, None)
+	
+	def remove(self, key: Hashable) -> None:
+		"""
+		Removes the mask identified by the given key.
+		"""
+		mask, groupKey = self._masks.pop(key)
+		del self._order[key]
+		if groupKey is False:
+			literalKeys = self._literals[mask]
+			del literalKeys[key]
+			if not literalKeys:
+				del self._literals[mask]
+			return
+		groupMasks = self._groups[groupKey]
+		del groupMasks[key]
+		self._groupPatterns.pop(groupKey, None)
+		if not groupMasks:
+			del self._groups[groupKey]
+			self._countGroupLength(groupKey, -1)
+	
+	def _groupKey(self, mask: str) -> Union[None, bool, Tuple[bool, str]]:
+		# Literal masks get a group key of False. Each wildcard mask is indexed by the longer of its literal
+		# prefix and literal suffix so that only masks that could possibly match a string need to be checked
+		# against it; masks with neither are in the None group.
+		wildcardPositions = [mask.find(char) for char in "*?[" if char in mask]
+		if not wildcardPositions:
+			return False
+		prefixLength = min(min(wildcardPositions), self.indexLength)
+		suffixLength = min(len(mask) - 1 - max(mask.rfind(char) for char in "*?]"), self.indexLength)
+		if prefixLength >= suffixLength and prefixLength > 0:
+			return (True, mask[:prefixLength])
+		if suffixLength > 0:
+			return (False, mask[-suffixLength:])
+		return None
+	
+	def _countGroupLength(self, groupKey: Optional[Tuple[bool, str]], change: int) -> None:
+		if groupKey is None:
+			return
+		isPrefix, affix = groupKey
+		lengthCounts = self._prefixLengths if isPrefix else self._suffixLengths
+		length = len(affix)
+		lengthCount = lengthCounts.get(length, 0) + change
+		if lengthCount:
+			lengthCounts[length] = lengthCount
+		else:
+			del lengthCounts[length]
+		if lengthCount and lengthCount != change:
+			return # The set of lengths hasn't changed
+		if isPrefix:
+			self._sortedPrefixLengths = sorted(lengthCounts)
+		else:
+			self._sortedSuffixLengths = sorted(lengthCounts)
+	
+	def _groupPattern(self, groupKey: Optional[Tuple[bool, str]]) -> Tuple[Pattern, Dict[str, Hashable]]:
+		if groupKey in self._groupPatterns:
+			return self._groupPatterns[groupKey]
+		patternParts = []
+		patternKeys = {}
+		for key, mask in self._groups[groupKey].items():
+			groupName = "m{}".format(len(patternParts))
+			patternParts.append("(?P<{}>{})".format(groupName, translate(mask)))
+			patternKeys[groupName] = key
+		groupPattern = (re.compile("|".join(patternParts)), patternKeys)
+		self._groupPatterns[groupKey] = groupPattern
+		return groupPattern
+	
+	def _patternsFor(self, checkString: str) -> Iterable[Tuple[Pattern, Dict[str, Hashable]]]:
+		groups = self._groups
+		if None in groups:
+			yield self._groupPattern(None)
+		for length in self._sortedPrefixLengths:
+			groupKey = (True, checkString[:length])
+			if groupKey in groups:
+				yield self._groupPattern(groupKey)
+		for length in self._sortedSuffixLengths:
+			groupKey = (False, checkString[-length:])
+			if groupKey in groups:
+				yield self._groupPattern(groupKey)
+	
+	def firstMatch(self, checkStrings: Iterable[str]) -> Optional[Hashable]:
+		"""
+		Returns the key of the earliest-added mask that matches any of the
+		given strings, or None if no masks match.
+		"""
+		bestKey = None
+		bestOrder = None
+		for checkString in checkStrings:
+			if checkString in self._literals:
+				key = next(iter(self._literals[checkString]))
+				if bestOrder is None or self._order[key] < bestOrder:
+					bestKey = key
+					bestOrder = self._order[key]
+			for pattern, patternKeys in self._patternsFor(checkString):
+				match = pattern.match(checkString)
+				if match:
+					key = patternKeys[match.lastgroup]
+					if bestOrder is None or self._order[key] < bestOrder:
+						bestKey = key
+						bestOrder = self._order[key]
+		return bestKey
+	
+	def matches(self, checkStrings: Iterable[str]) -> bool:
+		"""
+		Returns whether any mask matches any of the given strings.
+		"""
+		for checkString in checkStrings:
+			if checkString in self._literals:
+				return True
+			for pattern, patternKeys in self._patternsFor(checkString):
+				if pattern.match(checkString):
+					return True
+		return False
@@ -0,0 +1,442 @@
+from txircd.utils import ircLower
+from bisect import bisect_left, bisect_right
+from typing import Container, Iterator, Optional, Tuple
+from urllib.parse import quote
+import mmap, os, struct
+
+_indexEntry = struct.Struct("<QQ")
+
+# A record is (position, time, msgid, command, prefix, message). A position is a (segment number, offset) pair and is
+# only meaningful until the log's segments next change.
+MessageRecord = Tuple[Tuple[int, int], int, str, str, str, str]
+
+class _Segment(object):
+	"""
+	One append-only file of a message log. Each record is a single line of the
+	form "<time> <msgid> <command> <prefix> <message>", with the time in
+	milliseconds. Every indexInterval-th record is also written to a sidecar
+	index file so that records can be found by time without reading the whole
+	segment.
+	"""
+	def __init__(self, directory: str, segmentID: int):
+		self.segmentID = segmentID
+		self.logPath = os.path.join(directory, "{:016x}.log".format(segmentID))
+		self.indexPath = os.path.join(directory, "{:016x}.idx".format(segmentID))
+		self.size = 0
+		self.indexTimes = []
+		self.indexOffsets = []
+		self.recordsSinceIndex = 0
+		self.lastTime = 0
+	
+	def firstTime(self) -> Optional[int]:
+		if not self.indexTimes:
+			return None
+		return self.indexTimes[0]
+	
+	def load(self, indexInterval: int) -> None:
+		"""
+		Reads the segment's index and catches up on any records written after
+		the last index entry, such as when the server stopped before the index
+		was written out. A partially written final record is discarded.
+		"""
+		self.size = os.path.getsize(self.logPath)
+		if self.size == 0:
+			return
+		with open(self.logPath, "rb") as logFile:
+			data = mmap.mmap(logFile.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			validSize = data.rfind(b"\n") + 1
+			if validSize < self.size:
+				with open(self.logPath, "r+b") as logFile:
+					logFile.truncate(validSize)
+				self.size = validSize
+			indexData = b""
+			if os.path.exists(self.indexPath):
+				with open(self.indexPath, "rb") as indexFile:
+					indexData = indexFile.read()
+				for entryOffset in range(0, len(indexData) - _indexEntry.size + 1, _indexEntry.size):
+					recordTime, recordOffset = _indexEntry.unpack_from(indexData, entryOffset)
+					if recordOffset >= self.size or (self.indexOffsets and recordOffset <= self.indexOffsets[-1]):
+						break
+					self.indexTimes.append(recordTime)
+					self.indexOffsets.append(recordOffset)
+			offset = self.indexOffsets[-1] if self.indexOffsets else 0
+			newEntries = []
+			while offset < self.size:
+				end = data.find(b"\n", offset)
+				recordTime = int(data[offset:data.find(b" ", offset, end)])
+				if self.indexOffsets and offset == self.indexOffsets[-1]:
+					self.recordsSinceIndex = 1
+				elif not self.indexOffsets or self.recordsSinceIndex >= indexInterval:
+					self.indexTimes.append(recordTime)
+					self.indexOffsets.append(offset)
+					newEntries.append(_indexEntry.pack(recordTime, offset))
+					self.recordsSinceIndex = 1
+				else:
+					self.recordsSinceIndex += 1
+				self.lastTime = recordTime
+				offset = end + 1
+		finally:
+			data.close()
+		validIndexSize = (len(self.indexOffsets) - len(newEntries)) * _indexEntry.size
+		if newEntries or len(indexData) != validIndexSize:
+			with open(self.indexPath, "r+b" if os.path.exists(self.indexPath) else "wb") as indexFile:
+				indexFile.truncate(validIndexSize)
+				indexFile.seek(0, os.SEEK_END)
+				indexFile.write(b"".join(newEntries))
+	
+	def indexedOffsetBefore(self, recordTime: int, inclusive: bool) -> int:
+		"""
+		Returns the offset of an indexed record from which scanning forward
+		reaches every record in the segment with a time after (or, if
+		inclusive, at or after) the given time.
+		"""
+		if inclusive:
+			indexPosition = bisect_left(self.indexTimes, recordTime)
+		else:
+			indexPosition = bisect_right(self.indexTimes, recordTime)
+		if indexPosition == 0:
+			return 0
+		return self.indexOffsets[indexPosition - 1]
+
+class MessageLog(object):
+	"""
+	The stored messages for a single target, kept as a series of segment files
+	in one directory. Records are only ever appended to the newest segment, and
+	old segments are removed whole once they pass the retention period.
+	"""
+	indexInterval = 32
+	
+	def __init__(self, directory: str, segmentSize: int, segmentDuration: int):
+		self.directory = directory
+		self.segmentSize = segmentSize
+		self.segmentDuration = segmentDuration
+		self.segments = []
+		self._segmentsByID = {}
+		self._segmentFirstTimes = []
+		self._logFile = None
+		self._indexFile = None
+		self._written = False
+		self._maps = {}
+		if os.path.isdir(directory):
+			for fileName in sorted(os.listdir(directory)):
+				if not fileName.endswith(".log"):
+					continue
+				try:
+					segmentID = int(fileName[:-4], 16)
+				except ValueError:
+					continue
+				segment = _Segment(directory, segmentID)
+				segment.load(self.indexInterval)
+				if segment.size == 0:
+					self._removeSegmentFiles(segment)
+					continue
+				self.segments.append(segment)
+				self._segmentsByID[segmentID] = segment
+			self._segmentFirstTimes = [segment.firstTime() for segment in self.segments]
+	
+	def __len__(self) -> int:
+		return len(self.segments)
+	
+	def lastTime(self) -> int:
+		if not self.segments:
+			return 0
+		return self.segments[-1].lastTime
+	
+	def append(self, recordTime: int, command: str, prefix: str, message: str) -> Tuple[int, str]:
+		"""
+		Adds a message to the log. The time is in milliseconds, and it's moved
+		forward if needed so that records stay in time order. Returns the
+		record's time and msgid.
+		"""
+		recordTime = max(recordTime, self.lastTime())
+		segment = self._writableSegment(recordTime)
+		offset = segment.size
+		msgid = "{:x}-{:x}".format(segment.segmentID, offset)
+		recordData = "{} {} {} {} {}\n".format(recordTime, msgid, command, prefix, message).encode("utf-8")
+		if not segment.indexOffsets or segment.recordsSinceIndex >= self.indexInterval:
+			segment.indexTimes.append(recordTime)
+			segment.indexOffsets.append(offset)
+			segment.recordsSinceIndex = 1
+			self._indexFile.write(_indexEntry.pack(recordTime, offset))
+			if len(segment.indexTimes) == 1:
+				self._segmentFirstTimes[-1] = recordTime
+		else:
+			segment.recordsSinceIndex += 1
+		self._logFile.write(recordData)
+		segment.size += len(recordData)
+		segment.lastTime = recordTime
+		self._written = True
+		return recordTime, msgid
+	
+	def _writableSegment(self, recordTime: int) -> _Segment:
+		if self.segments:
+			segment = self.segments[-1]
+			if segment.size < self.segmentSize and recordTime - segment.segmentID < self.segmentDuration:
+				if self._logFile is None:
+					self._logFile = open(segment.logPath, "ab")
+					self._indexFile = open(segment.indexPath, "ab")
+				return segment
+			self._closeFiles()
+			segmentID = max(recordTime, segment.segmentID + 1)
+		else:
+			os.makedirs(self.directory, exist_ok=True)
+			segmentID = recordTime
+		segment = _Segment(self.directory, segmentID)
+		self._logFile = open(segment.logPath, "ab")
+		self._indexFile = open(segment.indexPath, "ab")
+		self.segments.append(segment)
+		self._segmentsByID[segmentID] = segment
+		self._segmentFirstTimes.append(None)
+		return segment
+	
+	def flush(self) -> None:
+		"""
+		Writes out buffered records. The files are closed if nothing has been
+		written since the last flush, so idle logs don't hold files open.
+		"""
+		if self._logFile is None:
+			return
+		if self._written:
+			self._logFile.flush()
+			self._indexFile.flush()
+			self._written = False
+		else:
+			self._closeFiles()
+	
+	def close(self) -> None:
+		self._closeFiles()
+		self._closeMaps()
+	
+	def _closeFiles(self) -> None:
+		if self._logFile is None:
+			return
+		self._logFile.close()
+		self._indexFile.close()
+		self._logFile = None
+		self._indexFile = None
+		self._written = False
+	
+	def expire(self, cutoffTime: int) -> None:
+		"""
+		Removes segments whose newest record is older than the given time.
+		"""
+		while self.segments and self.segments[0].lastTime < cutoffTime:
+			segment = self.segments.pop(0)
+			del self._segmentsByID[segment.segmentID]
+			del self._segmentFirstTimes[0]
+			if not self.segments:
+				self._closeFiles()
+			self._removeSegmentFiles(segment)
+		if not self.segments and os.path.isdir(self.directory) and not os.listdir(self.directory):
+			os.rmdir(self.directory)
+	
+	def _removeSegmentFiles(self, segment: _Segment) -> None:
+		for path in (segment.logPath, segment.indexPath):
+			if os.path.exists(path):
+				os.remove(path)
+	
+	def _segmentData(self, segmentNumber: int) -> mmap.mmap:
+		if segmentNumber in self._maps:
+			return self._maps[segmentNumber]
+		if self._written and segmentNumber == len(self.segments) - 1:
+			self._logFile.flush()
+		with open(self.segments[segmentNumber].logPath, "rb") as logFile:
+			data = mmap.mmap(logFile.fileno(), 0, access=mmap.ACCESS_READ)
+		self._maps[segmentNumber] = data
+		return data
+	
+	def _closeMaps(self) -> None:
+		for data in self._maps.values():
+			data.close()
+		self._maps.clear()
+	
+	def _parseRecord(self, segmentNumber: int, offset: int, recordData: bytes) -> MessageRecord:
+		recordTime, msgid, command, prefix, message = recordData.decode("utf-8", "replace").split(" ", 4)
+		return ((segmentNumber, offset), int(recordTime), msgid, command, prefix, message)
+	
+	def _normalizePosition(self, segmentNumber: int, offset: int) -> Tuple[int, int]:
+		if segmentNumber < len(self.segments) and offset >= self.segments[segmentNumber].size:
+			return (segmentNumber + 1, 0)
+		return (segmentNumber, offset)
+	
+	def startPosition(self) -> Tuple[int, int]:
+		return (0, 0)
+	
+	def endPosition(self) -> Tuple[int, int]:
+		return (len(self.segments), 0)
+	
+	def recordsFrom(self, position: Tuple[int, int]) -> Iterator[MessageRecord]:
+		"""
+		Iterates over records in time order, starting at the given position.
+		"""
+		segmentNumber, offset = position
+		while segmentNumber < len(self.segments):
+			segmentSize = self.segments[segmentNumber].size
+			if offset < segmentSize:
+				data = self._segmentData(segmentNumber)
+				while offset < segmentSize:
+					end = data.find(b"\n", offset)
+					yield self._parseRecord(segmentNumber, offset, data[offset:end])
+					offset = end + 1
+			segmentNumber += 1
+			offset = 0
+	
+	def recordsBefore(self, position: Tuple[int, int]) -> Iterator[MessageRecord]:
+		"""
+		Iterates over records in reverse time order, starting with the record
+		just before the given position.
+		"""
+		segmentNumber, offset = position
+		if segmentNumber >= len(self.segments):
+			segmentNumber = len(self.segments) - 1
+			offset = None
+		while segmentNumber >= 0:
+			if offset is None:
+				offset = self.segments[segmentNumber].size
+			if offset > 0:
+				data = self._segmentData(segmentNumber)
+				end = offset - 1
+				while end >= 0:
+					start = data.rfind(b"\n", 0, end) + 1
+					yield self._parseRecord(segmentNumber, start, data[start:end])
+					end = start - 1
+			segmentNumber -= 1
+			offset = None
+	
+	def positionForTime(self, recordTime: int, inclusive: bool) -> Tuple[int, int]:
+		"""
+		Returns the position of the first record with a time after (or, if
+		inclusive, at or after) the given time.
+		"""
+		if inclusive:
+			segmentNumber = bisect_left(self._segmentFirstTimes, recordTime)
+		else:
+			segmentNumber = bisect_right(self._segmentFirstTimes, recordTime)
+		if segmentNumber == 0:
+			return self.startPosition()
+		segmentNumber -= 1
+		startOffset = self.segments[segmentNumber].indexedOffsetBefore(recordTime, inclusive)
+		for record in self.recordsFrom((segmentNumber, startOffset)):
+			if record[1] > recordTime or (inclusive and record[1] == recordTime):
+				return record[0]
+		return self.endPosition()
+	
+	def positionForMsgid(self, msgid: str) -> Optional[Tuple[int, int]]:
+		"""
+		Returns the position of the record with the given msgid, or None if
+		there isn't one. A msgid is made up of the record's segment and offset,
+		so finding it doesn't need a separate index.
+		"""
+		segmentID, separator, offset = msgid.partition("-")
+		try:
+			segmentID = int(segmentID, 16)
+			offset = int(offset, 16)
+		except ValueError:
+			return None
+		if segmentID not in self._segmentsByID:
+			return None
+		segment = self._segmentsByID[segmentID]
+		if offset >= segment.size:
+			return None
+		segmentNumber = bisect_left(self._segmentFirstTimes, segment.firstTime())
+		while self.segments[segmentNumber] is not segment:
+			segmentNumber += 1
+		data = self._segmentData(segmentNumber)
+		if offset > 0 and data[offset - 1] != ord("\n"):
+			return None
+		record = self._parseRecord(segmentNumber, offset, data[offset:data.find(b"\n", offset)])
+		if record[2] != msgid:
+			return None
+		return record[0]
+	
+	def positionAfter(self, position: Tuple[int, int]) -> Tuple[int, int]:
+		"""
+		Returns the position of the record following the record at the given
+		position.
+		"""
+		segmentNumber, offset = position
+		data = self._segmentData(segmentNumber)
+		return self._normalizePosition(segmentNumber, data.find(b"\n", offset) + 1)
+	
+	def endQuery(self) -> None:
+		"""
+		Releases the memory maps used to read the log. Positions aren't valid
+		after this.
+		"""
+		self._closeMaps()
+
+class MessageStore(object):
+	"""
+	Stores messages on disk in a separate MessageLog for each target, so that
+	history can be paged through without keeping it in memory. Targets are
+	compared case-insensitively.
+	"""
+	def __init__(self, directory: str, segmentSize: int, segmentDuration: int):
+		self.directory = directory
+		self.segmentSize = segmentSize
+		self.segmentDuration = segmentDuration
+		self._logs = {}
+	
+	def _targetDirectory(self, target: str) -> str:
+		return os.path.join(self.directory, quote(ircLower(target), safe=""))
+	
+	def log(self, target: str) -> MessageLog:
+		"""
+		Returns the message log for the given target, reading it from disk the
+		first time it's needed.
+		"""
+		lowerTarget = ircLower(target)
+		if lowerTarget not in self._logs:
+			self._logs[lowerTarget] = MessageLog(self._targetDirectory(target), self.segmentSize, self.segmentDuration)
+		return self._logs[lowerTarget]
+	
+	def flush(self) -> None:
+		for messageLog in self._logs.values():
+			messageLog.flush()
+	
+	def close(self) -> None:
+		for messageLog in self._logs.values():
+			messageLog.close()
+		self._logs.clear()
+	
+	def closeLogsExcept(self, activeTargets: Container[str]) -> None:
+		"""
+		Closes and forgets the loaded logs for all targets that aren't in
+		activeTargets. They're read from disk again if they're needed later.
+		"""
+		for lowerTarget in list(self._logs):
+			if lowerTarget not in activeTargets:
+				self._logs.pop(lowerTarget).close()
+	
+	def expire(self, cutoffTime: int) -> None:
+		"""
+		Removes all stored messages older than the given time. Logs that aren't
+		loaded are checked on disk by when their segments were last written.
+		Loaded logs that no longer have any messages are closed and forgotten.
+		"""
+		for lowerTarget, messageLog in list(self._logs.items()):
+			messageLog.expire(cutoffTime)
+			if not messageLog:
+				messageLog.close()
+				del self._logs[lowerTarget]
+		if not os.path.isdir(self.directory):
+			return
+		loadedDirectories = set(messageLog.directory for messageLog in self._logs.values())
+		for directoryName in os.listdir(self.directory):
+			directory = os.path.join(self.directory, directoryName)
+			if directory in loadedDirectories or not os.path.isdir(directory):
+				continue
+			fileNames = sorted(os.listdir(directory))
+			for fileName in fileNames:
+				if not fileName.endswith(".log"):
+					continue
+				logPath = os.path.join(directory, fileName)
+				if os.path.getmtime(logPath) * 1000 >= cutoffTime:
+					break
+				os.remove(logPath)
+				indexPath = "{}.idx".format(logPath[:-4])
+				if os.path.exists(indexPath):
+					os.remove(indexPath)
+			if not os.listdir(directory):
+				os.rmdir(directory)
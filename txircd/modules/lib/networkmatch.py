@@ -0,0 +1,68 @@
+from typing import Hashable, List, Union
+
+class NetworkMatcher(object):
+	"""
+	Matches IP addresses against a collection of IPv4 and IPv6 networks.
+	Networks are kept in a table for each prefix length, so checking an
+	address takes one lookup for each prefix length in use rather than one
+	comparison for each network.
+	"""
+	def __init__(self):
+		self._networks = {}
+		self._tables = { 4: {}, 6: {} }
+		self._prefixLengths = { 4: [], 6: [] }
+	
+	def __len__(self) -> int:
+		return len(self._networks)
+	
+	def __contains__(self, key: Hashable) -> bool:
+		return key in self._networks
+	
+	def add(self, key: Hashable, network: Union["IPv4Network", "IPv6Network"]) -> None:
+		"""
+		Adds a network identified by the given key.
+		"""
+		if key in self._networks:
+			self.remove(key)
+		self._networks[key] = network
+		table = self._tables[network.version]
+		prefixLength = network.prefixlen
+		if prefixLength not in table:
+			table[prefixLength] = {}
+			self._prefixLengths[network.version] = sorted(table)
+		networkAddress = int(network.network_address)
+		if networkAddress not in table[prefixLength]:
+			table[prefixLength][networkAddress] = []
+		table[prefixLength][networkAddress].append(key)
+	
+	def remove(self, key: Hashable) -> None:
+		"""
+		Removes the network identified by the given key.
+		"""
+		network = self._networks.pop(key)
+		table = self._tables[network.version]
+		prefixLength = network.prefixlen
+		networkAddress = int(network.network_address)
+		networkKeys = table[prefixLength][networkAddress]
+		networkKeys.remove(key)
+		if networkKeys:
+			return
+		del table[prefixLength][networkAddress]
+		if not table[prefixLength]:
+			del table[prefixLength]
+			self._prefixLengths[network.version] = sorted(table)
+	
+	def matchingKeys(self, ip: Union["IPv4Address", "IPv6Address"]) -> List[Hashable]:
+		"""
+		Returns the keys of all networks that contain the given IP address,
+		from the most specific network to the least specific.
+		"""
+		table = self._tables[ip.version]
+		addressBits = ip.max_prefixlen
+		address = int(ip)
+		matchingKeys = []
+		for prefixLength in reversed(self._prefixLengths[ip.version]):
+			networkAddress = (address >> (addressBits - prefixLength)) << (addressBits - prefixLength)
+			if networkAddress in table[prefixLength]:
+				matchingKeys.extend(table[prefixLength][networkAddress])
+		return matchingKeys
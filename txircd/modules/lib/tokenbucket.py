@@ -0,0 +1,70 @@
+from time import monotonic
+
+class TokenBucket(object):
+	"""
+	A token bucket for rate limiting. The bucket holds up to capacity tokens
+	and refills at rate tokens per second. Time is measured with a monotonic
+	clock, so changes to the system clock don't affect rate limits.
+	"""
+	__slots__ = ("capacity", "rate", "_tokens", "_updated")
+	
+	def __init__(self, capacity: float, rate: float):
+		self.capacity = capacity
+		self.rate = rate
+		self._tokens = capacity
+		self._updated = monotonic()
+	
+	def setLimits(self, capacity: float, rate: float) -> None:
+		"""
+		Changes the capacity and refill rate of the bucket, keeping the tokens
+		it currently has (up to the new capacity).
+		"""
+		self._refill()
+		self.capacity = capacity
+		self.rate = rate
+		if self._tokens > capacity:
+			self._tokens = capacity
+	
+	def _refill(self) -> None:
+		currentTime = monotonic()
+		tokens = self._tokens + (currentTime - self._updated) * self.rate
+		self._tokens = tokens if tokens < self.capacity else self.capacity
+		self._updated = currentTime
+	
+	def consume(self, cost: float = 1) -> bool:
+		"""
+		Takes the given number of tokens from the bucket if it has that many.
+		Returns whether the tokens were taken.
+		"""
+		self._refill()
+		if self._tokens < cost:
+			return False
+		self._tokens -= cost
+		return True
+	
+	def forceConsume(self, cost: float = 1) -> None:
+		"""
+		Takes the given number of tokens from the bucket, leaving it in debt if
+		it doesn't have that many.
+		"""
+		self._refill()
+		self._tokens -= cost
+	
+	def tokens(self) -> float:
+		"""
+		Returns the number of tokens currently in the bucket.
+		"""
+		self._refill()
+		return self._tokens
+	
+	def timeUntilAvailable(self, cost: float = 1) -> float:
+		"""
+		Returns the number of seconds until the given number of tokens will be
+		in the bucket.
+		"""
+		self._refill()
+		if self._tokens >= cost:
+			return 0.0
+		if self.rate <= 0:
+			return float("inf")
+		return (cost - self._tokens) / self.rate
@@ -0,0 +1,163 @@
+from bisect import bisect_left, insort
+from collections import deque
+from fnmatch import fnmatchcase
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+import sys
+
+# Each entry is a tuple of (when, nick, ident, host, realhost, ip, gecos, server), where when is a Unix timestamp
+WhowasEntry = Tuple[float, str, str, str, str, str, str, str]
+
+class WhowasIndex(object):
+	"""
+	Stores WHOWAS entries in a deque for each lowercased nickname, oldest
+	first. The entries are kept in the dict given when the index is created,
+	which contains only builtin types so that it can be stored as is.
+	The index also keeps all entries in the order they were added so that the
+	oldest entries can be removed when there are too many in total or when they
+	expire, and it keeps the nicknames sorted (both forward and reversed) so
+	that a wildcard search only has to check the nicknames that share the
+	search mask's literal prefix or suffix.
+	Wildcard masks use * and ?, and they must be lowercased with ircLower, so
+	they can't contain character classes.
+	"""
+	def __init__(self, entries: Dict[str, Deque[WhowasEntry]], maxPerNick: int, maxTotal: int):
+		self.entries = entries
+		self.maxPerNick = maxPerNick
+		self.maxTotal = maxTotal
+		for lowerNick, nickEntries in list(entries.items()):
+			entries[lowerNick] = deque((entry[:7] + (sys.intern(entry[7]),) for entry in nickEntries), maxlen=maxPerNick)
+			if not entries[lowerNick]:
+				del entries[lowerNick]
+		self._sortedNicks = sorted(entries)
+		self._sortedReversedNicks = sorted(lowerNick[::-1] for lowerNick in entries)
+		self._rebuildOrder()
+		self._trimTotal()
+	
+	def __len__(self) -> int:
+		return self._count
+	
+	def __contains__(self, lowerNick: str) -> bool:
+		return lowerNick in self.entries
+	
+	def _rebuildOrder(self) -> None:
+		orderedEntries = []
+		for lowerNick, nickEntries in self.entries.items():
+			for entry in nickEntries:
+				orderedEntries.append((entry[0], lowerNick, entry))
+		orderedEntries.sort(key=lambda orderedEntry: orderedEntry[0])
+		self._order = deque((lowerNick, entry) for when, lowerNick, entry in orderedEntries)
+		self._count = len(self._order)
+	
+	def setLimits(self, maxPerNick: int, maxTotal: int) -> None:
+		"""
+		Changes the maximum number of entries for each nickname and in total,
+		removing the oldest entries if there are now too many.
+		"""
+		if maxPerNick != self.maxPerNick:
+			self.maxPerNick = maxPerNick
+			for lowerNick, nickEntries in list(self.entries.items()):
+				if maxPerNick:
+					self.entries[lowerNick] = deque(nickEntries, maxlen=maxPerNick)
+				else:
+					self._removeNick(lowerNick)
+			self._rebuildOrder()
+		self.maxTotal = maxTotal
+		self._trimTotal()
+	
+	def add(self, lowerNick: str, entry: WhowasEntry) -> None:
+		"""
+		Adds an entry for a nickname. The entry's timestamp must be no earlier
+		than that of any entry already added.
+		"""
+		if not self.maxPerNick or not self.maxTotal:
+			return
+		entry = entry[:7] + (sys.intern(entry[7]),)
+		if lowerNick in self.entries:
+			nickEntries = self.entries[lowerNick]
+			if len(nickEntries) < self.maxPerNick:
+				self._count += 1
+			# If the deque is full, appending drops its oldest entry. That entry stays in the order until it
+			# reaches the front, where it's recognized as already removed and skipped.
+		else:
+			nickEntries = deque(maxlen=self.maxPerNick)
+			self.entries[lowerNick] = nickEntries
+			insort(self._sortedNicks, lowerNick)
+			insort(self._sortedReversedNicks, lowerNick[::-1])
+			self._count += 1
+		nickEntries.append(entry)
+		self._order.append((lowerNick, entry))
+		self._trimTotal()
+		if len(self._order) > 2 * self._count + 1024:
+			self._rebuildOrder()
+	
+	def _removeOldest(self) -> bool:
+		lowerNick, entry = self._order.popleft()
+		nickEntries = self.entries.get(lowerNick)
+		if not nickEntries or nickEntries[0] is not entry:
+			return False
+		nickEntries.popleft()
+		self._count -= 1
+		if not nickEntries:
+			self._removeNick(lowerNick)
+		return True
+	
+	def _removeNick(self, lowerNick: str) -> None:
+		del self.entries[lowerNick]
+		del self._sortedNicks[bisect_left(self._sortedNicks, lowerNick)]
+		reversedNick = lowerNick[::-1]
+		del self._sortedReversedNicks[bisect_left(self._sortedReversedNicks, reversedNick)]
+	
+	def _trimTotal(self) -> None:
+		while self._count > self.maxTotal:
+			self._removeOldest()
+	
+	def expire(self, expireBefore: float) -> int:
+		"""
+		Removes all entries with a timestamp before the given time. Returns the
+		number of entries removed.
+		"""
+		removedCount = 0
+		while self._order and self._order[0][1][0] < expireBefore:
+			if self._removeOldest():
+				removedCount += 1
+		return removedCount
+	
+	def nickEntries(self, lowerNick: str, count: Optional[int] = None, expireBefore: float = 0) -> List[WhowasEntry]:
+		"""
+		Returns up to count entries for the given nickname, newest first,
+		excluding entries with a timestamp before expireBefore.
+		"""
+		if lowerNick not in self.entries:
+			return []
+		foundEntries = []
+		for entry in reversed(self.entries[lowerNick]):
+			if entry[0] < expireBefore or (count is not None and len(foundEntries) >= count):
+				break
+			foundEntries.append(entry)
+		return foundEntries
+	
+	def search(self, lowerMask: str) -> Iterator[str]:
+		"""
+		Yields the nicknames that match the given mask in sorted order.
+		"""
+		wildcardPositions = [lowerMask.find(char) for char in "*?" if char in lowerMask]
+		if not wildcardPositions:
+			if lowerMask in self.entries:
+				yield lowerMask
+			return
+		prefix = lowerMask[:min(wildcardPositions)]
+		suffix = lowerMask[max(lowerMask.rfind(char) for char in "*?") + 1:]
+		if prefix and len(prefix) >= len(suffix):
+			candidates = self._affixRange(self._sortedNicks, prefix)
+		elif suffix:
+			candidates = sorted(reversedNick[::-1] for reversedNick in self._affixRange(self._sortedReversedNicks, suffix[::-1]))
+		else:
+			candidates = list(self._sortedNicks)
+		for lowerNick in candidates:
+			if fnmatchcase(lowerNick, lowerMask):
+				yield lowerNick
+	
+	def _affixRange(self, sortedNicks: List[str], prefix: str) -> List[str]:
+		startIndex = bisect_left(sortedNicks, prefix)
+		endIndex = bisect_left(sortedNicks, prefix[:-1] + chr(ord(prefix[-1]) + 1), startIndex)
+		return sortedNicks[startIndex:endIndex]
@@ -1,19 +1,87 @@
+from twisted.internet import reactor
+from txircd.modules.maskmatch import MaskMatcher
 from txircd.utils import ircLower, now, timestampStringFromTime, timestampStringFromTimeSeconds
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional
+from fnmatch import fnmatchcase
+from itertools import islice
+from typing import Any, Dict, Iterable, List, Optional
+import heapq
 
 class XLineBase(object):
 	lineType = None
 	propagateToServers = True
 	burstQueuePriority = 50
+	userSweepChunkSize = 500
+	_userSweep = None
+	_userSweepAgain = False
+	_userSweepCall = None
 	
 	def initializeLineStorage(self) -> None:
 		if "xlines" not in self.ircd.storage:
 			self.ircd.storage["xlines"] = {}
+		self.ircd.storage.trackChanges("xlines")
 		if self.lineType not in self.ircd.storage["xlines"]:
 			self.ircd.storage["xlines"][self.lineType] = []
+			self.ircd.storage.markDirty("xlines")
+		self._buildLineIndex()
 		self.expireLines()
 	
+	def _buildLineIndex(self) -> None:
+		# The storage objects can be replaced when storage is synced, so the index keeps its own references to the
+		# line data; lines are never changed once they're set, so those references stay equal to what's in storage.
+		self._linesByMask = {}
+		self._lineOrder = {}
+		self._lineCount = 0
+		self._lineExpiryHeap = []
+		self.createMaskIndex()
+		for lineData in self.ircd.storage["xlines"][self.lineType]:
+			self._indexLine(lineData)
+	
+	def _indexLine(self, lineData: Dict[str, Any]) -> None:
+		normalMask = self.normalizeMask(lineData["mask"])
+		self._lineCount += 1
+		self._linesByMask[normalMask] = lineData
+		self._lineOrder[normalMask] = self._lineCount
+		self.addMaskToIndex(normalMask)
+		if lineData["duration"]:
+			expireTime = lineData["created"] + timedelta(seconds=lineData["duration"])
+			# The line count breaks ties so that line data is never compared
+			heapq.heappush(self._lineExpiryHeap, (expireTime, self._lineCount, normalMask, lineData))
+	
+	def _unindexLine(self, normalMask: str) -> None:
+		del self._linesByMask[normalMask]
+		del self._lineOrder[normalMask]
+		self.removeMaskFromIndex(normalMask)
+	
+	def createMaskIndex(self) -> None:
+		"""
+		Sets up an empty index of line masks. Line types that index some masks
+		differently can override this along with addMaskToIndex,
+		removeMaskFromIndex, and indexedMatches.
+		"""
+		self._lineMasks = MaskMatcher()
+	
+	def addMaskToIndex(self, normalMask: str) -> None:
+		self._lineMasks.add(normalMask, normalMask)
+	
+	def removeMaskFromIndex(self, normalMask: str) -> None:
+		self._lineMasks.remove(normalMask)
+	
+	def indexedMatches(self, user: "IRCUser", data: Optional[Dict[Any, Any]]) -> Optional[List[str]]:
+		"""
+		Returns the normalized masks of indexed lines that match the user. It
+		only needs to include the earliest-set matching line. Returns None if
+		the user can't be matched against the index, in which case
+		checkUserMatch is called for each line.
+		"""
+		matchStrings = self.userMatchStrings(user, data)
+		if matchStrings is None:
+			return None
+		normalMask = self._lineMasks.firstMatch(matchStrings)
+		if normalMask is None:
+			return []
+		return [normalMask]
+	
 	def matchUser(self, user: "IRCUser", data: Dict[Any, Any] = None) -> Optional[str]:
 		if not self.lineType:
 			return None
@@ -22,32 +90,139 @@ class XLineBase(object):
 		if user.localOnly:
 			return None
 		self.expireLines()
-		for lineData in self.ircd.storage["xlines"][self.lineType]:
+		matchingMasks = self.indexedMatches(user, data)
+		if matchingMasks is not None:
+			if not matchingMasks:
+				return None
+			normalMask = min(matchingMasks, key=self._lineOrder.__getitem__)
+			lineData = self._linesByMask[normalMask]
+			if self.verifyLineMatch(user, lineData["mask"], data):
+				return lineData["reason"]
+			# The first matching line didn't apply to this user, so we need to check the rest of them in order
+		for lineData in list(self._linesByMask.values()):
 			mask = lineData["mask"]
-			if self.checkUserMatch(user, mask, data) and self.ircd.runComboActionUntilValue((("verifyxlinematch-{}".format(self.lineType), (user, mask, data)), ("verifyxlinematch", (self.lineType, user, mask, data))), users=[user]) is not False:
+			if self.checkUserMatch(user, mask, data) and self.verifyLineMatch(user, mask, data):
 				return lineData["reason"]
 		return None
 	
+	def verifyLineMatch(self, user: "IRCUser", mask: str, data: Optional[Dict[Any, Any]]) -> bool:
+		return self.ircd.runComboActionUntilValue((("verifyxlinematch-{}".format(self.lineType), (user, mask, data)), ("verifyxlinematch", (self.lineType, user, mask, data))), users=[user]) is not False
+	
+	def userMatchStrings(self, user: "IRCUser", data: Optional[Dict[Any, Any]]) -> Optional[List[str]]:
+		"""
+		Returns the strings for the user that normalized masks are matched
+		against, or None if lines of this type can't be matched that way.
+		"""
+		return None
+	
 	def checkUserMatch(self, user: "IRCUser", mask: str, data: Optional[Dict[Any, Any]]) -> bool:
+		matchStrings = self.userMatchStrings(user, data)
+		if matchStrings is None:
+			return False
+		normalMask = self.normalizeMask(mask)
+		for matchString in matchStrings:
+			if fnmatchcase(matchString, normalMask):
+				return True
+		return False
+	
+	def candidateUsers(self, normalMask: str) -> Optional[List["IRCUser"]]:
+		"""
+		Returns the users that could match the line with the given normalized
+		mask, or None if the line could match any user.
+		"""
+		return None
+	
+	def hostmaskCandidateUsers(self, normalMask: str) -> Optional[List["IRCUser"]]:
+		"""
+		Finds candidate users for line types with ident@host masks. Users can
+		only be found this way if the host part of the mask has no wildcards.
+		"""
+		if "@" not in normalMask:
+			return None
+		host = normalMask.rsplit("@", 1)[1]
+		if "*" in host or "?" in host or "[" in host:
+			return None
+		return self.ircd.userIndex.usersWithHost(host)
+	
+	def handleMatchedUser(self, user: "IRCUser", reason: str) -> None:
+		"""
+		Called by enforceLine for each user that matches a line.
+		"""
 		pass
 	
+	def enforceLine(self, mask: str) -> None:
+		"""
+		Finds the users matching a newly added line and calls
+		handleMatchedUser for each of them. If the line could match any user,
+		the users are checked in chunks so that the server isn't blocked while
+		checking large numbers of users.
+		"""
+		users = self.candidateUsers(self.normalizeMask(mask))
+		if users is None:
+			self._startUserSweep()
+		else:
+			self._enforceOnUsers(users)
+	
+	def _enforceOnUsers(self, users: Iterable["IRCUser"]) -> None:
+		matchedUsers = []
+		for user in users:
+			if self.ircd.users.get(user.uuid) is not user:
+				continue
+			reason = self.matchUser(user)
+			if reason is not None:
+				matchedUsers.append((user, reason))
+		for user, reason in matchedUsers:
+			if self.ircd.users.get(user.uuid) is user:
+				self.handleMatchedUser(user, reason)
+	
+	def _startUserSweep(self) -> None:
+		if self._userSweep is not None:
+			# Users that have already been checked need to be checked again for the new line
+			self._userSweepAgain = True
+			return
+		self._userSweep = iter(list(self.ircd.users.values()))
+		self._userSweepAgain = False
+		self._continueUserSweep()
+	
+	def _continueUserSweep(self) -> None:
+		users = list(islice(self._userSweep, self.userSweepChunkSize))
+		self._enforceOnUsers(users)
+		if len(users) == self.userSweepChunkSize:
+			self._userSweepCall = reactor.callLater(0, self._continueUserSweep)
+			return
+		self._userSweepCall = None
+		self._userSweep = None
+		if self._userSweepAgain:
+			self._startUserSweep()
+	
+	def stopUserSweep(self) -> None:
+		"""
+		Stops checking users against new lines. Line types must call this when
+		they're unloaded.
+		"""
+		if self._userSweepCall is not None:
+			self._userSweepCall.cancel()
+			self._userSweepCall = None
+		self._userSweep = None
+		self._userSweepAgain = False
+	
 	def addLine(self, mask: str, createdTime: datetime, durationSeconds: int, setter: str, reason: str, fromServer: "IRCServer" = None) -> bool:
 		if not self.lineType:
 			return False
 		self.expireLines()
 		normalMask = self.normalizeMask(mask)
-		lines = self.ircd.storage["xlines"][self.lineType]
-		for lineData in lines:
-			lineMask = self.normalizeMask(lineData["mask"])
-			if normalMask == lineMask:
-				return False
-		lines.append({
+		if normalMask in self._linesByMask:
+			return False
+		lineData = {
 			"mask": mask,
 			"created": createdTime,
 			"duration": durationSeconds,
 			"setter": setter,
 			"reason": reason
-		})
+		}
+		self.ircd.storage["xlines"][self.lineType].append(lineData)
+		self.ircd.storage.markDirty("xlines")
+		self._indexLine(lineData)
 		self.ircd.runActionStandard("addxline", self.lineType, mask, durationSeconds, setter, reason)
 		if self.propagateToServers:
 			self.ircd.broadcastToServers(fromServer, "ADDLINE", self.lineType, mask, setter, timestampStringFromTime(createdTime), str(durationSeconds), reason, prefix=self.ircd.serverID)
@@ -57,15 +232,15 @@ class XLineBase(object):
 		if not self.lineType:
 			return False
 		normalMask = self.normalizeMask(mask)
-		for index, lineData in enumerate(self.ircd.storage["xlines"][self.lineType]):
-			lineMask = self.normalizeMask(lineData["mask"])
-			if normalMask == lineMask:
-				del self.ircd.storage["xlines"][self.lineType][index]
-				self.ircd.runActionStandard("delxline", self.lineType, mask, setter)
-				if self.propagateToServers:
-					self.ircd.broadcastToServers(fromServer, "DELLINE", self.lineType, mask, setter)
-				return True
-		return False
+		if normalMask not in self._linesByMask:
+			return False
+		self.ircd.storage["xlines"][self.lineType].remove(self._linesByMask[normalMask])
+		self.ircd.storage.markDirty("xlines")
+		self._unindexLine(normalMask)
+		self.ircd.runActionStandard("delxline", self.lineType, mask, setter)
+		if self.propagateToServers:
+			self.ircd.broadcastToServers(fromServer, "DELLINE", self.lineType, mask, setter)
+		return True
 	
 	def normalizeMask(self, mask: str) -> str:
 		return ircLower(mask)
@@ -73,19 +248,21 @@ class XLineBase(object):
 	def expireLines(self) -> None:
 		if not self.lineType:
 			return
+		expiryHeap = self._lineExpiryHeap
+		if not expiryHeap:
+			return
 		currentTime = now()
-		expiredLines = []
-		lines = self.ircd.storage["xlines"][self.lineType]
-		for lineData in lines:
-			durationSeconds = lineData["duration"]
-			if not durationSeconds:
-				continue
-			duration = timedelta(seconds=lineData["duration"])
-			expireTime = lineData["created"] + duration
-			if expireTime < currentTime:
-				expiredLines.append(lineData)
-		for lineData in expiredLines:
+		lines = None
+		while expiryHeap and expiryHeap[0][0] < currentTime:
+			expireTime, _, normalMask, lineData = heapq.heappop(expiryHeap)
+			if self._linesByMask.get(normalMask) is not lineData:
+				continue # This line was already removed
+			if lines is None:
+				lines = self.ircd.storage["xlines"][self.lineType]
 			lines.remove(lineData)
+			self._unindexLine(normalMask)
+		if lines is not None:
+			self.ircd.storage.markDirty("xlines")
 	
 	def generateInfo(self) -> Dict[str, str]:
 		if not self.lineType:
@@ -22,6 +22,7 @@ class LUsersCommand(ModuleData, Command):
 	def getStorage(self) -> int:
 		if "user_count_max" not in self.ircd.storage:
 			self.ircd.storage["user_count_max"] = {}
+		self.ircd.storage.trackChanges("user_count_max")
 		return self.ircd.storage["user_count_max"]
 	
 	def updateMaxCounts(self, counts: Dict[str, int]) -> Dict[str, int]:
@@ -29,6 +30,7 @@ class LUsersCommand(ModuleData, Command):
 		for key in ("users", "local"):
 			if counts[key] > maxes.get(key, 0):
 				maxes[key] = counts[key]
+				self.ircd.storage.markDirty("user_count_max")
 		return maxes
 	
 	def countStats(self) -> Tuple[Dict[str, int], Dict[str, int]]:
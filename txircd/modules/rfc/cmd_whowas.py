@@ -2,10 +2,12 @@ from twisted.plugin import IPlugin
 from twisted.words.protocols import irc
 from txircd.config import ConfigValidationError
 from txircd.module_interface import Command, ICommand, IModuleData, ModuleData
-from txircd.utils import durationToSeconds, ipAddressToShow, ircLower, now
+from txircd.modules.whowasindex import WhowasIndex
+from txircd.utils import durationToSeconds, ipAddressToShow, ircLower
 from zope.interface import implementer
-from datetime import datetime, timedelta
+from datetime import datetime
 from typing import Any, Callable, Dict, List, Optional, Tuple
+import calendar, time
 
 irc.RPL_WHOWASIP = "379"
 
@@ -25,85 +27,92 @@ class WhowasCommand(ModuleData, Command):
 	def load(self) -> None:
 		if "whowas" not in self.ircd.storage:
 			self.ircd.storage["whowas"] = {}
+		self.ircd.storage.trackChanges("whowas")
+		allWhowas = self.ircd.storage["whowas"]
+		for lowerNick, whowasEntries in allWhowas.items():
+			if whowasEntries and isinstance(whowasEntries[0], dict):
+				# Convert entries stored before the whowas index was added
+				allWhowas[lowerNick] = [(calendar.timegm(entry["when"].utctimetuple()) + entry["when"].microsecond / 1000000, entry["nick"], entry["ident"], entry["host"], entry["realhost"], entry["ip"], entry["gecos"], entry["server"]) for entry in whowasEntries]
+		self.whowas = WhowasIndex(allWhowas, self.ircd.config.get("whowas_max_entries", 10), self.ircd.config.get("whowas_max_total_entries", 10000))
+		self.expireEntries()
+		self.ircd.storage.markDirty("whowas")
+		self.expireTimer = self.ircd.timers.callEvery(60, self.expireEntries)
+	
+	def rehash(self) -> None:
+		self.whowas.setLimits(self.ircd.config.get("whowas_max_entries", 10), self.ircd.config.get("whowas_max_total_entries", 10000))
+		self.ircd.storage.markDirty("whowas")
+	
+	def unload(self) -> Optional["Deferred"]:
+		self.expireTimer.cancel()
 
 	def verifyConfig(self, config: Dict[str, Any]) -> None:
 		if "whowas_duration" in config and not isinstance(config["whowas_duration"], str) and not isinstance(config["whowas_duration"], int):
 			raise ConfigValidationError("whowas_duration", "value must be an integer or a duration string")
 		if "whowas_max_entries" in config and (not isinstance(config["whowas_max_entries"], int) or config["whowas_max_entries"] < 0):
 			raise  ConfigValidationError("whowas_max_entries", "invalid number")
+		if "whowas_max_total_entries" in config and (not isinstance(config["whowas_max_total_entries"], int) or config["whowas_max_total_entries"] < 0):
+			raise ConfigValidationError("whowas_max_total_entries", "invalid number")
+		if "whowas_search_limit" in config and (not isinstance(config["whowas_search_limit"], int) or config["whowas_search_limit"] < 1):
+			raise ConfigValidationError("whowas_search_limit", "invalid number")
 	
-	def removeOldEntries(self, whowasEntries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-		expireDuration = durationToSeconds(self.ircd.config.get("whowas_duration", "1d"))
-		maxCount = self.ircd.config.get("whowas_max_entries", 10)
-		while whowasEntries and len(whowasEntries) > maxCount:
-			whowasEntries.pop(0)
-		expireDifference = timedelta(seconds=expireDuration)
-		expireTime = now() - expireDifference
-		while whowasEntries and whowasEntries[0]["when"] < expireTime:
-			whowasEntries.pop(0)
-		return whowasEntries
+	def expireTime(self) -> float:
+		return time.time() - durationToSeconds(self.ircd.config.get("whowas_duration", "1d"))
+	
+	def expireEntries(self) -> None:
+		if self.whowas.expire(self.expireTime()):
+			self.ircd.storage.markDirty("whowas")
 	
 	def addUserToWhowas(self, user: "IRCUser", reason: str, fromServer: "IRCServer" = None) -> None:
 		if not user.isRegistered():
 			# user never registered a nick, so no whowas entry to add
 			return
-		lowerNick = ircLower(user.nick)
-		allWhowas = self.ircd.storage["whowas"]
-		if lowerNick in allWhowas:
-			whowasEntries = allWhowas[lowerNick]
-		else:
-			whowasEntries = []
 		serverName = self.ircd.name
 		if user.uuid[:3] != self.ircd.serverID:
 			serverName = self.ircd.servers[user.uuid[:3]].name
-		whowasEntries.append({
-			"nick": user.nick,
-			"ident": user.ident,
-			"host": user.host(),
-			"realhost": user.realHost,
-			"ip": ipAddressToShow(user.ip),
-			"gecos": user.gecos,
-			"server": serverName,
-			"when": now()
-		})
-		whowasEntries = self.removeOldEntries(whowasEntries)
-		if whowasEntries:
-			allWhowas[lowerNick] = whowasEntries
-		elif lowerNick in allWhowas:
-			del allWhowas[lowerNick]
+		self.whowas.add(ircLower(user.nick), (time.time(), user.nick, user.ident, user.host(), user.realHost, ipAddressToShow(user.ip), user.gecos, serverName))
+		self.ircd.storage.markDirty("whowas")
 	
 	def parseParams(self, user: "IRCUser", params: List[str], prefix: str, tags: Dict[str, Optional[str]]) -> Optional[Dict[Any, Any]]:
 		if not params:
 			user.sendSingleError("WhowasCmd", irc.ERR_NEEDMOREPARAMS, "WHOWAS", "Not enough parameters")
 			return None
+		count = None
+		if len(params) > 1:
+			try:
+				count = int(params[1])
+			except ValueError:
+				pass
+			else:
+				if count < 1:
+					count = None # As in RFC 2812, a count that isn't positive means all entries
 		lowerParam = ircLower(params[0])
-		if lowerParam not in self.ircd.storage["whowas"]:
+		expireBefore = self.expireTime()
+		whowasEntries = []
+		if ("*" in lowerParam or "?" in lowerParam) and self.ircd.runActionUntilValue("userhasoperpermission", user, "whowas-wildcard", users=[user]):
+			searchLimit = self.ircd.config.get("whowas_search_limit", 100)
+			for lowerNick in self.whowas.search(lowerParam):
+				whowasEntries.extend(self.whowas.nickEntries(lowerNick, count, expireBefore))
+				if len(whowasEntries) >= searchLimit:
+					whowasEntries = whowasEntries[:searchLimit]
+					break
+		else:
+			whowasEntries = self.whowas.nickEntries(lowerParam, count, expireBefore)
+		if not whowasEntries:
 			user.sendSingleError("WhowasNick", irc.ERR_WASNOSUCHNICK, params[0], "There was no such nickname")
 			return None
 		return {
-			"nick": lowerParam,
+			"entries": whowasEntries,
 			"param": params[0]
 		}
 	
 	def execute(self, user: "IRCUser", data: Dict[Any, Any]) -> bool:
-		nick = data["nick"]
-		allWhowas = self.ircd.storage["whowas"]
-		whowasEntries = allWhowas[nick]
-		whowasEntries = self.removeOldEntries(whowasEntries)
-		if not whowasEntries:
-			del allWhowas[nick]
-			self.ircd.storage["whowas"] = allWhowas
-			user.sendMessage(irc.ERR_WASNOSUCHNICK, data["param"], "There was no such nickname")
-			return True
-		allWhowas[nick] = whowasEntries # Save back to the list excluding the removed entries
-		self.ircd.storage["whowas"] = allWhowas
-		for entry in whowasEntries:
-			entryNick = entry["nick"]
-			user.sendMessage(irc.RPL_WHOWASUSER, entryNick, entry["ident"], entry["host"], "*", entry["gecos"])
-			if self.ircd.runActionUntilValue("userhasoperpermission", user, "whowas-host", users=[user]):
-				user.sendMessage(irc.RPL_WHOWASIP, entryNick, "was connecting from {}@{} {}".format(entry["ident"], entry["realhost"], entry["ip"]))
-			user.sendMessage(irc.RPL_WHOISSERVER, entryNick, entry["server"], str(entry["when"]))
-		user.sendMessage(irc.RPL_ENDOFWHOWAS, nick, "End of WHOWAS")
+		showHost = self.ircd.runActionUntilValue("userhasoperpermission", user, "whowas-host", users=[user])
+		for when, entryNick, ident, host, realHost, ip, gecos, server in data["entries"]:
+			user.sendMessage(irc.RPL_WHOWASUSER, entryNick, ident, host, "*", gecos)
+			if showHost:
+				user.sendMessage(irc.RPL_WHOWASIP, entryNick, "was connecting from {}@{} {}".format(ident, realHost, ip))
+			user.sendMessage(irc.RPL_WHOISSERVER, entryNick, server, str(datetime.utcfromtimestamp(when)))
+		user.sendMessage(irc.RPL_ENDOFWHOWAS, data["param"], "End of WHOWAS")
 		return True
 
 whowasCmd = WhowasCommand()
\ No newline at end of file
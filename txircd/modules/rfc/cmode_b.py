@@ -1,10 +1,110 @@
 from twisted.plugin import IPlugin
 from twisted.words.protocols import irc
 from txircd.module_interface import IMode, IModuleData, Mode, ModuleData
+from txircd.modules.maskmatch import MaskMatcher
 from txircd.utils import ircLower, ModeType, timestampStringFromTimeSeconds
 from zope.interface import implementer
-from fnmatch import fnmatchcase
-from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+def parseBan(param: str) -> Tuple[str, str, str, bool, str]:
+	"""
+	Splits a ban list entry into its action extban, action parameter,
+	matching extban, whether the matching extban is negated, and the mask.
+	"""
+	actionExtban = ""
+	actionParam = ""
+	matchingExtban = ""
+	matchNegated = False
+	banmask = param
+	if ";" in banmask:
+		actionExtban, banmask = banmask.split(";", 1)
+		if ":" in actionExtban:
+			actionExtban, actionParam = actionExtban.split(":", 1)
+	if ":" in banmask and ("@" not in banmask or banmask.find(":") < banmask.find("@")):
+		matchingExtban, banmask = banmask.split(":", 1)
+		if matchingExtban and matchingExtban[0] == "~":
+			matchNegated = True
+			matchingExtban = matchingExtban[1:]
+	return actionExtban, actionParam, matchingExtban, matchNegated, banmask
+
+class ChannelBanMatcher(object):
+	"""
+	The compiled form of a channel's ban list. Bans are bucketed by action
+	extban. Within each bucket, hostmask bans are matched together by a
+	MaskMatcher, and bans with matching extbans are kept in order to be
+	checked individually.
+	"""
+	def __init__(self, ircd: "IRCd", banList: List[Tuple[str, str, "datetime"]]):
+		self.ircd = ircd
+		self._bans = {}
+		self._order = {}
+		self._nextOrder = 0
+		self._hostmasks = {}
+		self._extbans = {}
+		for paramData in banList:
+			self.addBan(paramData[0])
+	
+	def addBan(self, param: str) -> None:
+		banData = parseBan(param)
+		actionExtban, actionParam, matchingExtban, matchNegated, banmask = banData
+		self._bans[param] = banData
+		self._order[param] = self._nextOrder
+		self._nextOrder += 1
+		if matchingExtban:
+			if actionExtban not in self._extbans:
+				self._extbans[actionExtban] = {}
+			self._extbans[actionExtban][param] = None
+		else:
+			if actionExtban not in self._hostmasks:
+				self._hostmasks[actionExtban] = MaskMatcher()
+			self._hostmasks[actionExtban].add(param, ircLower(banmask))
+	
+	def removeBan(self, param: str) -> None:
+		if param not in self._bans:
+			return
+		actionExtban, actionParam, matchingExtban, matchNegated, banmask = self._bans.pop(param)
+		del self._order[param]
+		if matchingExtban:
+			bucket = self._extbans[actionExtban]
+			del bucket[param]
+			if not bucket:
+				del self._extbans[actionExtban]
+		else:
+			bucket = self._hostmasks[actionExtban]
+			bucket.remove(param)
+			if not bucket:
+				del self._hostmasks[actionExtban]
+	
+	def banData(self, param: str) -> Tuple[str, str, str, bool, str]:
+		return self._bans[param]
+	
+	def actionExtbans(self) -> Iterable[str]:
+		return set(self._hostmasks.keys()) | set(self._extbans.keys())
+	
+	def firstMatch(self, actionExtbans: Iterable[str], user: "IRCUser", userMasks: Tuple[str, str, str], matchHostmasks: bool = True) -> Optional[str]:
+		"""
+		Returns the earliest ban in the given action extban buckets that
+		matches the user, or None if none do.
+		"""
+		bestParam = None
+		bestOrder = None
+		for actionExtban in actionExtbans:
+			if matchHostmasks and actionExtban in self._hostmasks:
+				param = self._hostmasks[actionExtban].firstMatch(userMasks)
+				if param is not None and (bestOrder is None or self._order[param] < bestOrder):
+					bestParam = param
+					bestOrder = self._order[param]
+			if actionExtban not in self._extbans:
+				continue
+			for param in self._extbans[actionExtban]:
+				if bestOrder is not None and self._order[param] > bestOrder:
+					break
+				matchingExtban, matchNegated, banmask = self._bans[param][2:]
+				if self.ircd.runActionUntilTrue("usermatchban-{}".format(matchingExtban), user, matchNegated, banmask):
+					bestParam = param
+					bestOrder = self._order[param]
+					break
+		return bestParam
 
 @implementer(IPlugin, IModuleData, IMode)
 class BanMode(ModuleData, Mode):
@@ -29,28 +129,21 @@ class BanMode(ModuleData, Mode):
 		         ("updateuserbancache", 1, self.updateUserCaches)
 		]
 	
-	def banMatchesUser(self, user: "IRCUser", banmask: str) -> bool:
-		matchingExtban = ""
-		matchNegated = False
-		if ":" in banmask and ("@" not in banmask or banmask.find(":") < banmask.find("@")):
-			matchingExtban, banmask = banmask.split(":", 1)
-			if matchingExtban and matchingExtban[0] == "~":
-				matchNegated = True
-				matchingExtban = matchingExtban[1:]
-		if matchingExtban:
-			return self.ircd.runActionUntilTrue("usermatchban-{}".format(matchingExtban), user, matchNegated, banmask)
-		return self.matchHostmask(user, banmask)
+	def unload(self) -> None:
+		for channel in self.ircd.channels.values():
+			if "banmatcher" in channel.cache:
+				del channel.cache["banmatcher"]
+	
+	def banMatcher(self, channel: "IRCChannel") -> ChannelBanMatcher:
+		"""
+		Gets the compiled ban list for a channel with bans set.
+		"""
+		if "banmatcher" not in channel.cache:
+			channel.cache["banmatcher"] = ChannelBanMatcher(self.ircd, channel.modes["b"])
+		return channel.cache["banmatcher"]
 	
-	def matchHostmask(self, user: "IRCUser", banmask: str) -> bool:
-		banmask = ircLower(banmask)
-		userMask = ircLower(user.hostmask())
-		if fnmatchcase(userMask, banmask):
-			return True
-		userMask = ircLower(user.hostmaskWithRealHost())
-		if fnmatchcase(userMask, banmask):
-			return True
-		userMask = ircLower(user.hostmaskWithIP())
-		return fnmatchcase(userMask, banmask)
+	def userMasks(self, user: "IRCUser") -> Tuple[str, str, str]:
+		return (ircLower(user.hostmask()), ircLower(user.hostmaskWithRealHost()), ircLower(user.hostmaskWithIP()))
 	
 	def checkAction(self, actionName: str, mode: str, channel: "IRCChannel", user: "IRCUser", *params: Any, **kw: Any) -> Union[str, bool, None]:
 		if "b" not in channel.modes:
@@ -63,49 +156,25 @@ class BanMode(ModuleData, Mode):
 			if "~{}".format(mode) in channel.users[user]["bans"]:
 				return False
 			return None
-		for paramData in channel.modes["b"]:
-			param = paramData[0]
-			actionExtban = ""
-			actionParam = ""
-			if ";" not in param:
-				continue
-			actionExtban, param = param.split(";", 1)
-			if ":" in actionExtban:
-				actionExtban, actionParam = actionExtban.split(":", 1)
-			actionNegated = False
-			if actionExtban[0] == "~":
-				actionNegated = True
-				actionExtban = actionExtban[1:]
-			if actionExtban != mode:
-				continue
-			match = self.banMatchesUser(user, param)
-			if match:
-				if actionNegated:
-					return False
-				return actionParam
-		return None
+		matcher = self.banMatcher(channel)
+		matchedBan = matcher.firstMatch((mode, "~{}".format(mode)), user, self.userMasks(user))
+		if matchedBan is None:
+			return None
+		actionExtban, actionParam = matcher.banData(matchedBan)[:2]
+		if actionExtban[0] == "~":
+			return False
+		return actionParam
 	
 	def onChange(self, channel: "IRCChannel", source: str, adding: bool, param: str) -> None:
-		if ";" in param:
-			actionExtban, banmask = param.split(";", 1)
-			if ":" in actionExtban:
-				actionExtban, actionParam = actionExtban.split(":", 1)
-			else:
-				actionParam = ""
-		else:
-			actionExtban= ""
-			actionParam = ""
-			banmask = param
-		if ":" in banmask and ("@" not in banmask or banmask.index(":") < banmask.index("@")):
-			matchingExtban, banmask = banmask.split(":", 1)
-			if matchingExtban and matchingExtban[0] == "~":
-				matchNegated = True
-				matchingExtban = matchingExtban[1:]
+		if "banmatcher" in channel.cache:
+			if adding:
+				channel.cache["banmatcher"].addBan(param)
 			else:
-				matchNegated = False
-		else:
-			matchingExtban = ""
-			matchNegated = None
+				channel.cache["banmatcher"].removeBan(param)
+		actionExtban, actionParam, matchingExtban, matchNegated, banmask = parseBan(param)
+		if not matchingExtban:
+			hostmaskMatcher = MaskMatcher()
+			hostmaskMatcher.add(param, ircLower(banmask))
 		for user, cache in channel.users.items():
 			if "bans" not in cache:
 				cache["bans"] = {}
@@ -116,7 +185,7 @@ class BanMode(ModuleData, Mode):
 			if matchingExtban:
 				matchesUser = self.ircd.runActionUntilTrue("usermatchban-{}".format(matchingExtban), user, matchNegated, banmask)
 			else:
-				matchesUser = self.matchHostmask(user, banmask)
+				matchesUser = hostmaskMatcher.matches(self.userMasks(user))
 			if not matchesUser:
 				continue
 			if adding:
@@ -128,30 +197,17 @@ class BanMode(ModuleData, Mode):
 		if user in channel.users and "bans" in channel.users[user]:
 			return channel.users[user]["bans"]
 		if "b" in channel.modes:
+			matcher = self.banMatcher(channel)
+			userMasks = self.userMasks(user)
 			matchesActions = {}
-			for paramData in channel.modes["b"]:
-				param = paramData[0]
-				actionExtban = ""
-				actionParam = ""
-				matchingExtban = ""
-				matchNegated = False
-				if ";" in param:
-					actionExtban, param = param.split(";", 1)
-					if ":" in actionExtban:
-						actionExtban, actionParam = actionExtban.split(":", 1)
-				if actionExtban in matchesActions:
-					continue
-				if ":" in param and ("@" not in param or param.find(":") < param.find("@")):
-					matchingExtban, param = param.split(":", 1)
-					if matchingExtban[0] == "~":
-						matchNegated = True
-						matchingExtban = matchingExtban[1:]
-				if matchingExtban:
-					if self.ircd.runActionUntilTrue("usermatchban-{}".format(matchingExtban), user, matchNegated, param):
-						matchesActions[actionExtban] = actionParam
-				else:
-					if self.matchHostmask(user, param):
-						matchesActions[""] = ""
+			for actionExtban in matcher.actionExtbans():
+				matchedBan = matcher.firstMatch((actionExtban,), user, userMasks)
+				if matchedBan is not None and not matcher.banData(matchedBan)[2]:
+					# Hostmask bans only count for unactioned bans here, but they're still checked in order
+					matchesActions[""] = ""
+					matchedBan = matcher.firstMatch((actionExtban,), user, userMasks, False)
+				if matchedBan is not None:
+					matchesActions[actionExtban] = matcher.banData(matchedBan)[1]
 			return matchesActions
 		return {}
 
@@ -172,18 +228,14 @@ class BanMode(ModuleData, Mode):
 			return
 		if "bans" not in channel.users[user]:
 			channel.users[user]["bans"] = {}
-		for paramData in channel.modes["b"]:
-			param = paramData[0]
-			actionExtban = ""
-			actionParam = ""
-			if ";" in param:
-				actionExtban, param = param.split(";", 1)
-				if ":" in actionExtban:
-					actionExtban, actionParam = actionExtban.split(":", 1)
+		matcher = self.banMatcher(channel)
+		userMasks = self.userMasks(user)
+		for actionExtban in matcher.actionExtbans():
 			if actionExtban in channel.users[user]["bans"]:
 				continue
-			if self.banMatchesUser(user, param):
-				channel.users[user]["bans"][actionExtban] = actionParam
+			matchedBan = matcher.firstMatch((actionExtban,), user, userMasks)
+			if matchedBan is not None:
+				channel.users[user]["bans"][actionExtban] = matcher.banData(matchedBan)[1]
 	
 	def autoStatus(self, channel: "IRCChannel", user: "IRCUser", fromServer: "IRCServer" = None) -> None:
 		if "bans" not in channel.users[user]:
@@ -323,13 +375,9 @@ class BanMode(ModuleData, Mode):
 			# so we'll go straight to analyzing the ban list
 			if "b" not in channel.modes:
 				return None
-			for paramData in channel.modes["b"]:
-				param = paramData[0]
-				if ";" in param:
-					continue # Ignore entries with action extbans
-				if self.banMatchesUser(user, param):
-					user.sendMessage(irc.ERR_BANNEDFROMCHAN, channel.name, "Cannot join channel (You're banned)")
-					return False
+			if self.banMatcher(channel).firstMatch(("",), user, self.userMasks(user)) is not None:
+				user.sendMessage(irc.ERR_BANNEDFROMCHAN, channel.name, "Cannot join channel (You're banned)")
+				return False
 			return None
 		if actionType in ("commandmodify-PRIVMSG", "commandmodify-NOTICE"):
 			messagingUser, data = params
@@ -337,14 +385,10 @@ class BanMode(ModuleData, Mode):
 				return
 			if messagingUser in channel.users: # We're only applying this to users not in the channel
 				return
-			for paramData in channel.modes["b"]:
-				param = paramData[0]
-				if ";" in param:
-					continue # We don't care about action extbans here
-				if self.banMatchesUser(user, param):
-					user.sendMessage(irc.ERR_BANNEDFROMCHAN, channel.name, "Cannot send message to channel (You're banned)")
-					del data["targetchans"][channel]
-					return
+			if self.banMatcher(channel).firstMatch(("",), messagingUser, self.userMasks(messagingUser)) is not None:
+				messagingUser.sendMessage(irc.ERR_BANNEDFROMCHAN, channel.name, "Cannot send message to channel (You're banned)")
+				del data["targetchans"][channel]
+				return
 	
 	def showListParams(self, user: "IRCUser", channel: "IRCChannel") -> None:
 		if user not in channel.users or "b" not in channel.modes:
@@ -166,13 +166,29 @@ class UserOper(Command):
 				user.sendMessage(irc.ERR_NOOPERHOST, "Invalid oper credentials")
 				self.reportOper(user, "Bad password")
 				return True
+			compareDeferredFunc = "comparedeferred-{}".format(operData["hash"])
+			if compareDeferredFunc in self.ircd.functionCache:
+				compareDeferred = self.ircd.functionCache[compareDeferredFunc](password, operData["password"])
+				compareDeferred.addErrback(self.compareFailed)
+				compareDeferred.addCallback(self.completeOper, user, username, password, operData)
+				return True
 			passwordMatch = self.ircd.functionCache[compareFunc](password, operData["password"])
 		else:
 			passwordMatch = (password == operData["password"])
+		self.completeOper(passwordMatch, user, username, password, operData)
+		return True
+	
+	def compareFailed(self, failure: "Failure") -> bool:
+		self.ircd.log.warn("Checking an oper password failed: {error}", error=failure.getErrorMessage())
+		return False
+	
+	def completeOper(self, passwordMatch: bool, user: "IRCUser", username: str, password: str, operData: Dict[str, Any]) -> None:
+		if user.uuid not in self.ircd.users:
+			return
 		if not passwordMatch:
 			user.sendMessage(irc.ERR_NOOPERHOST, "Invalid oper credentials")
 			self.reportOper(user, "Bad password")
-			return True
+			return
 		if "host" in operData:
 			hosts = ircLower(operData["host"]).split(" ")
 			for operHost in hosts:
@@ -188,14 +204,14 @@ class UserOper(Command):
 			else:
 				user.sendMessage(irc.ERR_NOOPERHOST, "Invalid oper credentials")
 				self.reportOper(user, "Bad host")
-				return True
+				return
 		if self.ircd.runActionUntilFalse("opercheck", user, username, password, operData): # Allow other modules to implement additional checks
 			user.sendMessage(irc.ERR_NOOPERHOST, "Invalid oper credentials")
 			if "error" in operData:
 				self.reportOper(user, operData["error"])
 			else:
 				self.reportOper(user, "Failed additional oper checks")
-			return True
+			return
 		user.setModes([(True, "o", None)], self.ircd.serverID)
 		user.sendMessage(irc.RPL_YOUREOPER, "You are now an IRC operator")
 		self.reportOper(user, None)
@@ -218,7 +234,6 @@ class UserOper(Command):
 		if vhost:
 			user.changeHost("oper", vhost)
 		self.ircd.broadcastToServers(None, "OPER", user.uuid, *operPermissions, prefix=self.ircd.serverID)
-		return True
 
 	def reportOper(self, user: "IRCUser", reason: str) -> None:
 		if reason:
@@ -1,42 +1,53 @@
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.threads import deferToThreadPool
 from twisted.plugin import IPlugin
+from twisted.python.threadpool import ThreadPool
+from txircd.config import ConfigValidationError
 from txircd.module_interface import IModuleData, ModuleData
 from zope.interface import implementer
 from base64 import b64encode, b64decode
-try: # The PBKDF2 module is dumb and reacts differently in the presence of PyCrypto, so let's handle its presence appropriately
-	from Crypto.Hash import MD5 as md5, SHA as sha1, SHA224 as sha224, SHA256 as sha256, SHA384 as sha384, SHA512 as sha512
-except ImportError: # PyCrypto isn't actually present, so let's hashlib
-	from hashlib import md5, sha1, sha224, sha256, sha384, sha512
-from pbkdf2 import PBKDF2
+from hashlib import pbkdf2_hmac
+from hmac import compare_digest
 from random import randint
 from struct import pack
-from typing import Optional
+from typing import Any, Callable, Dict, Optional
+
+class HashPoolFullError(Exception):
+	pass
 
 @implementer(IPlugin, IModuleData)
 class HashPBKDF2(ModuleData):
 	name = "HashPBKDF2"
 	
 	def load(self) -> None:
+		# hashlib releases the GIL while it hashes, so hashing in threads runs in parallel with the reactor.
+		self.hashPool = ThreadPool(0, self.ircd.config.get("pbkdf2_threads", 2), "HashPBKDF2")
+		self.hashPool.start()
+		self.pendingJobs = 0
 		self.ircd.functionCache["hash-pbkdf2"] = self.hash
 		self.ircd.functionCache["compare-pbkdf2"] = self.compare
 		self.ircd.functionCache["validate-pbkdf2"] = self.checkValidHash
+		self.ircd.functionCache["hashdeferred-pbkdf2"] = self.hashDeferred
+		self.ircd.functionCache["comparedeferred-pbkdf2"] = self.compareDeferred
+	
+	def rehash(self) -> None:
+		self.hashPool.adjustPoolsize(0, self.ircd.config.get("pbkdf2_threads", 2))
 	
 	def unload(self) -> Optional["Deferred"]:
-		if self.ircd.functionCache["hash-pbkdf2"] == self.hash:
-			del self.ircd.functionCache["hash-pbkdf2"]
-		if self.ircd.functionCache["compare-pbkdf2"] == self.compare:
-			del self.ircd.functionCache["compare-pbkdf2"]
-		if self.ircd.functionCache["validate-pbkdf2"]:
-			del self.ircd.functionCache["validate-pbkdf2"]
+		for functionName, function in (("hash-pbkdf2", self.hash), ("compare-pbkdf2", self.compare), ("validate-pbkdf2", self.checkValidHash), ("hashdeferred-pbkdf2", self.hashDeferred), ("comparedeferred-pbkdf2", self.compareDeferred)):
+			if self.ircd.functionCache.get(functionName) == function:
+				del self.ircd.functionCache[functionName]
+		self.hashPool.stop()
+	
+	def verifyConfig(self, config: Dict[str, Any]) -> None:
+		if "pbkdf2_threads" in config and (not isinstance(config["pbkdf2_threads"], int) or config["pbkdf2_threads"] < 1):
+			raise ConfigValidationError("pbkdf2_threads", "invalid number")
+		if "pbkdf2_max_pending" in config and (not isinstance(config["pbkdf2_max_pending"], int) or config["pbkdf2_max_pending"] < 1):
+			raise ConfigValidationError("pbkdf2_max_pending", "invalid number")
 	
 	def hash(self, string: str, salt: str = None, iterations: int = 1000, algorithm: str = "sha256", dataBytes: int = 24) -> str:
-		possibleAlgorithms = {
-			"md5": md5,
-			"sha1": sha1,
-			"sha224": sha224,
-			"sha256": sha256,
-			"sha384": sha384,
-			"sha512": sha512
-		}
+		possibleAlgorithms = ("md5", "sha1", "sha224", "sha256", "sha384", "sha512")
 		
 		if algorithm not in possibleAlgorithms:
 			raise ValueError ("Unknown algorithm {}".format(algorithm))
@@ -54,7 +65,7 @@ class HashPBKDF2(ModuleData):
 			if char not in saltGoodChars:
 				raise ValueError ("Illegal character {!r} found in salt".format(char))
 		
-		hashedStr = b64encode(PBKDF2(string, salt, iterations, possibleAlgorithms[algorithm]).read(dataBytes)).decode("us-ascii")
+		hashedStr = b64encode(pbkdf2_hmac(algorithm, string, salt.encode("utf-8"), iterations, dataBytes)).decode("us-ascii")
 		return "{}:{}:{}:{}".format(algorithm, iterations, salt, hashedStr)
 	
 	def makeSalt(self) -> str:
@@ -71,7 +82,37 @@ class HashPBKDF2(ModuleData):
 			iterations = int(iterations)
 		dataBytes = len(b64decode(oldHash))
 		
-		return self.hash(string, salt, iterations, algorithm, dataBytes) == compareWith
+		return compare_digest(self.hash(string, salt, iterations, algorithm, dataBytes), compareWith)
+	
+	def hashDeferred(self, string: str, salt: str = None, iterations: int = 1000, algorithm: str = "sha256", dataBytes: int = 24) -> Deferred:
+		"""
+		Works like hash, but hashes in a worker thread. Returns a Deferred that
+		fires with the hash.
+		"""
+		if salt is None:
+			salt = self.makeSalt()
+		return self.runHashJob(self.hash, string, salt, iterations, algorithm, dataBytes)
+	
+	def compareDeferred(self, string: str, compareWith: str) -> Deferred:
+		"""
+		Works like compare, but hashes in a worker thread. Returns a Deferred
+		that fires with whether the string matches the hash.
+		"""
+		return self.runHashJob(self.compare, string, compareWith)
+	
+	def runHashJob(self, hashFunc: Callable, *args: Any) -> Deferred:
+		# Jobs beyond what the threads are hashing wait in the pool's queue. Each one holds a connection's
+		# login open, so once too many are waiting, new ones fail instead of waiting for an unbounded time.
+		if self.pendingJobs >= self.ircd.config.get("pbkdf2_max_pending", 500):
+			return fail(HashPoolFullError("Too many password hashes are pending"))
+		self.pendingJobs += 1
+		hashDeferred = deferToThreadPool(reactor, self.hashPool, hashFunc, *args)
+		hashDeferred.addBoth(self.finishHashJob)
+		return hashDeferred
+	
+	def finishHashJob(self, result: Any) -> Any:
+		self.pendingJobs -= 1
+		return result
 	
 	def checkValidHash(self, string: str) -> bool:
 		if len(string.split(":")) != 4:
@@ -0,0 +1,102 @@
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.names import client as dnsClient
+from txircd.utils import isValidHost, lenBytes
+from collections import OrderedDict
+from typing import List, Optional, Tuple, Union
+
+class HostResolver(object):
+	"""
+	Resolves the hostnames of connecting users. A hostname is only accepted
+	if its forward lookup confirms the IP address it was looked up for.
+	Results, including failed lookups, are cached by IP address for the TTL
+	of the DNS records involved, and concurrent lookups for the same IP
+	address share a single set of DNS queries.
+	"""
+	def __init__(self, ircd: "IRCd", clock: "IReactorTime" = reactor):
+		self.ircd = ircd
+		self._clock = clock
+		self._cache = OrderedDict()
+		self._pending = {}
+		self.cacheHits = 0
+		self.cacheMisses = 0
+		self.coalescedLookups = 0
+	
+	def cacheSize(self) -> int:
+		return len(self._cache)
+	
+	def resolve(self, ip: Union["IPv4Address", "IPv6Address"], timeout: int) -> Deferred:
+		"""
+		Looks up the confirmed hostname for the given IP address. Returns a
+		Deferred that fires with the hostname, or with None if the IP address
+		has no valid confirmed hostname. The Deferred never errbacks.
+		"""
+		if ip in self._cache:
+			host, expiryTime = self._cache[ip]
+			if expiryTime > self._clock.seconds():
+				self._cache.move_to_end(ip)
+				self.cacheHits += 1
+				resultDeferred = Deferred()
+				resultDeferred.callback(host)
+				return resultDeferred
+			del self._cache[ip]
+		resultDeferred = Deferred()
+		if ip in self._pending:
+			self.coalescedLookups += 1
+			self._pending[ip].append(resultDeferred)
+			return resultDeferred
+		self.cacheMisses += 1
+		self._pending[ip] = [resultDeferred]
+		lookupDeferred = dnsClient.lookupPointer(ip.reverse_pointer, ((timeout/2),))
+		lookupDeferred.addCallback(self._verifyPointer, ip, timeout)
+		lookupDeferred.addErrback(self._failLookup, ip) # Also catches errors in _verifyPointer so the lookup is always completed
+		return resultDeferred
+	
+	def _verifyPointer(self, result: Tuple[List["RRHeader"], List["RRHeader"], List["RRHeader"]], ip: Union["IPv4Address", "IPv6Address"], timeout: int) -> None:
+		resolveResults = result[0]
+		if not resolveResults:
+			self._failLookup(None, ip)
+			return
+		name = resolveResults[0].payload.name.name.decode("utf-8", "replace")
+		if lenBytes(name) > self.ircd.config.get("hostname_length", 64):
+			self._completeLookup(ip, None, resolveResults[0].ttl)
+			return
+		if not isValidHost(name):
+			self._completeLookup(ip, None, resolveResults[0].ttl)
+			return
+		if ip.version == 4:
+			lookupDeferred = dnsClient.lookupAddress(name, ((timeout/2),))
+		else:
+			lookupDeferred = dnsClient.lookupIPV6Address(name, ((timeout/2),))
+		lookupDeferred.addCallback(self._verifyAddress, ip, name, resolveResults[0].ttl)
+		lookupDeferred.addErrback(self._failLookup, ip)
+	
+	def _verifyAddress(self, result: Tuple[List["RRHeader"], List["RRHeader"], List["RRHeader"]], ip: Union["IPv4Address", "IPv6Address"], name: str, pointerTTL: int) -> None:
+		addressResults = result[0]
+		for addressData in addressResults:
+			if hasattr(addressData.payload, "address") and addressData.payload.address == ip.packed:
+				self._completeLookup(ip, name, min(pointerTTL, addressData.ttl))
+				return
+		self._completeLookup(ip, None, pointerTTL)
+	
+	def _failLookup(self, error: Optional["Failure"], ip: Union["IPv4Address", "IPv6Address"]) -> None:
+		self._completeLookup(ip, None, None)
+	
+	def _completeLookup(self, ip: Union["IPv4Address", "IPv6Address"], host: Optional[str], ttl: Optional[int]) -> None:
+		try:
+			if host is None:
+				cacheTime = self.ircd.config.get("dns_negative_cache_time", 60)
+				if ttl is not None:
+					cacheTime = min(cacheTime, ttl)
+			else:
+				cacheTime = min(ttl, self.ircd.config.get("dns_cache_max_time", 3600))
+			cacheSize = self.ircd.config.get("dns_cache_size", 10000)
+			if cacheTime > 0 and cacheSize > 0:
+				self._cache[ip] = (host, self._clock.seconds() + cacheTime)
+				self._cache.move_to_end(ip)
+				while len(self._cache) > cacheSize:
+					self._cache.popitem(last=False)
+		finally:
+			# The lookup may already have been completed if something went wrong after that
+			for resultDeferred in self._pending.pop(ip, []):
+				resultDeferred.callback(host)
@@ -1,6 +1,4 @@
-from twisted.internet import reactor
 from twisted.internet.defer import Deferred
-from twisted.internet.task import LoopingCall
 from txircd.ircbase import IRCBase
 from txircd.utils import now
 from typing import Any, Dict, List, Optional
@@ -17,12 +15,14 @@ class IRCServer(IRCBase):
 		self.bursted = None
 		self.disconnectedDeferred = Deferred()
 		self.receivedConnection = received
-		self._pinger = LoopingCall(self._ping)
-		self._registrationTimeoutTimer = reactor.callLater(self.ircd.config.get("server_registration_timeout", 10), self._timeoutRegistration)
+		self._pinger = None
+		self._registrationTimeoutTimer = self.ircd.timers.callLater(self.ircd.config.get("server_registration_timeout", 10), self._timeoutRegistration)
 		self._burstQueueCommands = []
 		self._burstQueueCommandPriorities = {}
 		self._burstQueueHandlers = {}
 		self._disconnected = False
+		self._setUpOutputBuffer(self.ircd)
+		self._setUpQueueLimits(self.ircd.config.get("server_sendq", 20971520), self.ircd.config.get("server_recvq", 16384))
 	
 	def handleCommand(self, command: str, params: List[str], prefix: str, tags: Dict[str, Optional[str]]) -> None:
 		if self._disconnected:
@@ -72,6 +72,14 @@ class IRCServer(IRCBase):
 			return
 		self.ircd.runComboActionStandard((("servercommandextra-{}".format(command), (self, data)), ("servercommandextra", (self, command, data))), users=affectedUsers, channels=affectedChannels)
 	
+	def sendQueueExceeded(self) -> None:
+		if not self._disconnected:
+			self.disconnect("SendQ exceeded")
+	
+	def recvQueueExceeded(self) -> None:
+		if not self._disconnected:
+			self.disconnect("RecvQ exceeded")
+	
 	def endBurst(self) -> None:
 		"""
 		Called at the end of bursting.
@@ -140,17 +148,18 @@ class IRCServer(IRCBase):
 			del self.ircd.servers[self.serverID]
 			del self.ircd.serverNames[self.name]
 			self.ircd.recentlyQuitServers[self.serverID] = now()
-		if self._pinger.running:
-			self._pinger.stop()
-		if self._registrationTimeoutTimer.active():
-			self._registrationTimeoutTimer.cancel()
+		if self._pinger:
+			self._pinger.cancel()
+			self._pinger = None
+		self._registrationTimeoutTimer.cancel()
 	
 	def _endConnection(self) -> None:
-		self.transport.loseConnection()
+		self.closeConnection()
 	
 	def _timeoutRegistration(self) -> None:
 		if self.serverID and self.name:
-			self._pinger.start(self.ircd.config.get("server_ping_frequency", 60))
+			self._pinger = self.ircd.timers.callEvery(self.ircd.config.get("server_ping_frequency", 60), self._ping)
+			self._ping()
 			return
 		self.ircd.log.info("Disconnecting unregistered server")
 		self.disconnect("Registration timeout")
@@ -0,0 +1,299 @@
+from collections.abc import MutableMapping
+from twisted.internet.defer import Deferred
+from twisted.internet.threads import deferToThread
+from zope.interface import Attribute, implementer, Interface
+from typing import Any, Dict, Iterator, Optional, Set
+import dbm, hashlib, pickle, shelve, sqlite3, threading, time
+
+class IStorageBackend(Interface):
+	"""
+	Stores pickled values by key for DataStorage. Backends only deal with
+	bytes; all caching and change tracking is done by DataStorage.
+	Writes may be made from a worker thread, but DataStorage never uses a
+	backend from more than one thread at a time, except that backends with
+	concurrentReads set may be read while a write is running.
+	"""
+	concurrentReads = Attribute("Whether read may be called while a write is running in another thread")
+	
+	def keys() -> Set[str]:
+		"""
+		Returns the set of all stored keys.
+		"""
+	
+	def read(key: str) -> bytes:
+		"""
+		Returns the stored value for the given key.
+		"""
+	
+	def write(changes: Dict[str, Optional[bytes]]) -> None:
+		"""
+		Stores all of the given values together, deleting keys whose value is
+		None.
+		"""
+	
+	def close() -> None:
+		"""
+		Closes the backend. It isn't used again afterward.
+		"""
+
+@implementer(IStorageBackend)
+class SQLiteStorageBackend(object):
+	"""
+	Stores values in a single SQLite table. The database uses write-ahead
+	logging, so each write only appends the changed rows to the log.
+	Reads use their own connection. With write-ahead logging, readers see the
+	last committed data and don't wait for a write in progress.
+	"""
+	concurrentReads = True
+	
+	def __init__(self, path: str):
+		self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+		self.db.execute("PRAGMA journal_mode=WAL")
+		self.db.execute("PRAGMA synchronous=NORMAL")
+		self.db.execute("CREATE TABLE IF NOT EXISTS storage (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+		self.readDB = sqlite3.connect(path, isolation_level=None)
+	
+	def keys(self) -> Set[str]:
+		return set(row[0] for row in self.readDB.execute("SELECT key FROM storage"))
+	
+	def read(self, key: str) -> bytes:
+		row = self.readDB.execute("SELECT value FROM storage WHERE key = ?", (key,)).fetchone()
+		if row is None:
+			raise KeyError(key)
+		return row[0]
+	
+	def write(self, changes: Dict[str, Optional[bytes]]) -> None:
+		with self.db:
+			self.db.execute("BEGIN")
+			for key, value in changes.items():
+				if value is None:
+					self.db.execute("DELETE FROM storage WHERE key = ?", (key,))
+				else:
+					self.db.execute("INSERT OR REPLACE INTO storage (key, value) VALUES (?, ?)", (key, value))
+	
+	def close(self) -> None:
+		self.readDB.close()
+		self.db.close()
+
+@implementer(IStorageBackend)
+class DBMStorageBackend(object):
+	"""
+	Stores values in a dbm database in the same format as the shelve module,
+	so it can use data files from before storage backends were added.
+	"""
+	concurrentReads = False
+	
+	def __init__(self, path: str):
+		self.db = dbm.open(path, "c")
+	
+	def keys(self) -> Set[str]:
+		return set(key.decode("utf-8") for key in self.db.keys())
+	
+	def read(self, key: str) -> bytes:
+		return self.db[key.encode("utf-8")]
+	
+	def write(self, changes: Dict[str, Optional[bytes]]) -> None:
+		for key, value in changes.items():
+			if value is None:
+				del self.db[key.encode("utf-8")]
+			else:
+				self.db[key.encode("utf-8")] = value
+		if hasattr(self.db, "sync"):
+			self.db.sync()
+	
+	def close(self) -> None:
+		self.db.close()
+
+storageBackends = {
+	"sqlite": SQLiteStorageBackend,
+	"dbm": DBMStorageBackend
+}
+
+class DataStorage(MutableMapping):
+	"""
+	The IRCd's persistent storage. This works like a dict of picklable values,
+	but values are only loaded from the backend when they're first used, and
+	a sync only writes the keys that have changed.
+	Setting or deleting a key marks it as changed. Values that are changed in
+	place (such as adding an item to a stored list) are found by comparing
+	them against what was last stored, which means pickling them on every
+	sync. To avoid that, a module can call trackChanges for a key and then
+	call markDirty whenever it changes that key's value in place.
+	Changed values are pickled when a sync starts. The pickled data is a
+	snapshot of the changes, so syncInThread can write it to the backend from
+	a worker thread while the values keep changing.
+	"""
+	def __init__(self, backend: IStorageBackend):
+		self._backend = backend
+		self._keys = backend.keys()
+		self._values = {}
+		self._storedDigests = {}
+		self._dirtyKeys = set()
+		self._deletedKeys = set()
+		self._trackedKeys = set()
+		self._pendingChanges = {}
+		self._writeLock = threading.Lock()
+		self.syncInProgress = False
+		self.skippedSyncCount = 0
+		self.lastSyncTime = None
+		self.lastSyncDuration = None
+		self.lastSyncSnapshotDuration = None
+		self.lastSyncKeyCount = 0
+		self.lastSyncSize = 0
+	
+	def __getitem__(self, key: str) -> Any:
+		if key in self._values:
+			return self._values[key]
+		if key not in self._keys:
+			raise KeyError(key)
+		if self._backend.concurrentReads:
+			valueData = self._backend.read(key)
+		else:
+			with self._writeLock:
+				# A sync may be writing through the backend from its thread, so reads have to wait for it to finish.
+				valueData = self._backend.read(key)
+		value = pickle.loads(valueData)
+		self._values[key] = value
+		if key not in self._trackedKeys:
+			self._storedDigests[key] = hashlib.sha1(valueData).digest()
+		return value
+	
+	def __setitem__(self, key: str, value: Any) -> None:
+		self._keys.add(key)
+		self._values[key] = value
+		self._dirtyKeys.add(key)
+		self._deletedKeys.discard(key)
+	
+	def __delitem__(self, key: str) -> None:
+		if key not in self._keys:
+			raise KeyError(key)
+		self._keys.discard(key)
+		self._values.pop(key, None)
+		self._storedDigests.pop(key, None)
+		self._dirtyKeys.discard(key)
+		self._deletedKeys.add(key)
+	
+	def __contains__(self, key: object) -> bool:
+		return key in self._keys
+	
+	def __iter__(self) -> Iterator[str]:
+		return iter(list(self._keys))
+	
+	def __len__(self) -> int:
+		return len(self._keys)
+	
+	def trackChanges(self, key: str) -> None:
+		"""
+		Declares that the caller will call markDirty whenever it changes the
+		value for the given key in place, so the value doesn't need to be
+		checked for changes on every sync.
+		"""
+		self._trackedKeys.add(key)
+		self._storedDigests.pop(key, None)
+	
+	def markDirty(self, key: str) -> None:
+		"""
+		Marks the given key's value as changed so that it's written on the
+		next sync.
+		"""
+		if key in self._keys:
+			self._dirtyKeys.add(key)
+	
+	def _changedValues(self) -> Dict[str, Optional[bytes]]:
+		changes = {}
+		for key in self._deletedKeys:
+			changes[key] = None
+		for key, value in self._values.items():
+			isDirty = key in self._dirtyKeys
+			if not isDirty and key in self._trackedKeys:
+				continue
+			valueData = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+			if key not in self._trackedKeys:
+				valueDigest = hashlib.sha1(valueData).digest()
+				if not isDirty and self._storedDigests.get(key) == valueDigest:
+					continue
+				self._storedDigests[key] = valueDigest
+			changes[key] = valueData
+		self._dirtyKeys.clear()
+		self._deletedKeys.clear()
+		return changes
+	
+	def _queueChanges(self) -> Dict[str, Optional[bytes]]:
+		changes = self._changedValues()
+		with self._writeLock:
+			# Changes that haven't been written yet are replaced by newer values for the same key.
+			self._pendingChanges.update(changes)
+		return changes
+	
+	def _writePendingChanges(self) -> None:
+		# Every write takes all of the changes queued so far while holding the lock, so an older value can
+		# never be written over a newer one, no matter which order the writes run in.
+		with self._writeLock:
+			changes = self._pendingChanges
+			self._pendingChanges = {}
+			if not changes:
+				return
+			try:
+				self._backend.write(changes)
+			except:
+				# The changes are no longer marked as changed in the values, so they have to stay queued to be
+				# written by the next sync. Changes queued since then are newer, so they're kept.
+				changes.update(self._pendingChanges)
+				self._pendingChanges = changes
+				raise
+	
+	def sync(self) -> None:
+		"""
+		Writes all changed values to the backend.
+		"""
+		self._queueChanges()
+		self._writePendingChanges()
+	
+	def syncInThread(self) -> Optional[Deferred]:
+		"""
+		Writes all changed values to the backend from a worker thread. Only the
+		pickling of changed values happens in the calling thread. Returns a
+		Deferred that fires when the write finishes, or None if the previous
+		sync hasn't finished yet; in that case, the changes are included in
+		the next sync.
+		"""
+		if self.syncInProgress:
+			self.skippedSyncCount += 1
+			return None
+		self.syncInProgress = True
+		startTime = time.perf_counter()
+		try:
+			changes = self._queueChanges()
+		except:
+			self.syncInProgress = False
+			raise
+		snapshotDuration = time.perf_counter() - startTime
+		syncDeferred = deferToThread(self._writePendingChanges)
+		syncDeferred.addBoth(self._finishThreadSync, startTime, snapshotDuration, changes)
+		return syncDeferred
+	
+	def _finishThreadSync(self, result: Any, startTime: float, snapshotDuration: float, changes: Dict[str, Optional[bytes]]) -> Any:
+		self.syncInProgress = False
+		self.lastSyncTime = time.time()
+		self.lastSyncDuration = time.perf_counter() - startTime
+		self.lastSyncSnapshotDuration = snapshotDuration
+		self.lastSyncKeyCount = len(changes)
+		self.lastSyncSize = sum(len(valueData) for valueData in changes.values() if valueData is not None)
+		return result
+	
+	def close(self) -> None:
+		self.sync()
+		with self._writeLock:
+			self._backend.close()
+
+def importShelveData(storage: DataStorage, shelvePath: str) -> int:
+	"""
+	Copies all data from a shelve data file into the given storage. Returns
+	the number of keys copied.
+	"""
+	with shelve.open(shelvePath, "r") as shelveData:
+		for key in shelveData.keys():
+			storage[key] = shelveData[key]
+		keyCount = len(shelveData)
+	storage.sync()
+	return keyCount
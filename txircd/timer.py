@@ -0,0 +1,160 @@
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from math import ceil, floor
+from typing import Any, Callable, Dict, List, Optional
+
+class WheelTimer(object):
+	"""
+	A timer scheduled on a TimerWheel. This provides the active and cancel
+	functions of the DelayedCall objects returned by reactor.callLater.
+	"""
+	def __init__(self, wheel: "TimerWheel", expiryTick: int, interval: Optional[int], func: Callable, args: List[Any], kw: Dict[str, Any]):
+		self._wheel = wheel
+		self._expiryTick = expiryTick
+		self._interval = interval
+		self._func = func
+		self._args = args
+		self._kw = kw
+		self._slot = None
+	
+	def active(self) -> bool:
+		"""
+		Returns whether the timer is still scheduled to run.
+		"""
+		return self._slot is not None
+	
+	def cancel(self) -> None:
+		"""
+		Cancels the timer. Unlike DelayedCall.cancel, it's safe to cancel a
+		timer that has already run or been cancelled.
+		"""
+		if self._slot is None:
+			return
+		self._wheel._removeTimer(self)
+
+class TimerWheel(object):
+	"""
+	A hierarchical timer wheel for scheduling large numbers of timers that
+	don't need to be more precise than the tick length. Scheduling and
+	cancelling a timer take constant time regardless of the number of
+	scheduled timers, and the wheel only needs a single reactor timer while
+	anything is scheduled.
+	Timers never run early, but may run up to one tick late.
+	"""
+	slotBits = 6
+	levelCount = 4
+	
+	def __init__(self, log: "Logger", tickLength: float = 1.0, clock: "IReactorTime" = reactor):
+		self.log = log
+		self.tickLength = tickLength
+		self._clock = clock
+		self._slotCount = 1 << self.slotBits
+		self._slotMask = self._slotCount - 1
+		self._levels = [[{} for _ in range(self._slotCount)] for _ in range(self.levelCount)]
+		self._overflow = {}
+		self._currentTick = 0
+		self._timerCount = 0
+		self._ticker = LoopingCall(self._tick)
+		self._ticker.clock = clock
+	
+	def __len__(self) -> int:
+		return self._timerCount
+	
+	def callLater(self, delay: float, func: Callable, *args: Any, **kw: Any) -> WheelTimer:
+		"""
+		Schedules the function to be called with the given arguments after
+		the given number of seconds. Returns the timer.
+		"""
+		return self._addTimer(self._tickForDelay(delay), None, func, args, kw)
+	
+	def callEvery(self, interval: float, func: Callable, *args: Any, **kw: Any) -> WheelTimer:
+		"""
+		Schedules the function to be called with the given arguments every
+		interval seconds, starting one interval from now. The timer keeps
+		running until it's cancelled. Returns the timer.
+		"""
+		intervalTicks = max(1, int(ceil(interval / self.tickLength)))
+		return self._addTimer(self._tickForDelay(interval), intervalTicks, func, args, kw)
+	
+	def _clockTick(self) -> int:
+		return int(floor(self._clock.seconds() / self.tickLength))
+	
+	def _tickForDelay(self, delay: float) -> int:
+		if not self._timerCount:
+			# Nothing is scheduled, so the wheel has been idle and needs to be brought up to the current time
+			self._currentTick = self._clockTick()
+		expiryTick = int(ceil((self._clock.seconds() + delay) / self.tickLength))
+		return max(expiryTick, self._currentTick + 1)
+	
+	def _addTimer(self, expiryTick: int, interval: Optional[int], func: Callable, args: List[Any], kw: Dict[str, Any]) -> WheelTimer:
+		timer = WheelTimer(self, expiryTick, interval, func, args, kw)
+		self._insertTimer(timer)
+		self._timerCount += 1
+		if not self._ticker.running:
+			self._ticker.start(self.tickLength, False)
+		return timer
+	
+	def _insertTimer(self, timer: WheelTimer) -> None:
+		expiryTick = timer._expiryTick
+		ticksLeft = expiryTick - self._currentTick
+		for level in range(self.levelCount):
+			if ticksLeft < (1 << (self.slotBits * (level + 1))):
+				slot = self._levels[level][(expiryTick >> (self.slotBits * level)) & self._slotMask]
+				break
+		else:
+			slot = self._overflow
+		slot[timer] = None
+		timer._slot = slot
+	
+	def _removeTimer(self, timer: WheelTimer) -> None:
+		del timer._slot[timer]
+		timer._slot = None
+		self._timerCount -= 1
+		if not self._timerCount and self._ticker.running:
+			self._ticker.stop()
+	
+	def _tick(self) -> None:
+		targetTick = self._clockTick()
+		while self._currentTick < targetTick and self._timerCount:
+			self._advance()
+	
+	def _advance(self) -> None:
+		self._currentTick += 1
+		tick = self._currentTick
+		# When a lower level wraps around, move the timers from the next slot of the level above down into
+		# the levels below it
+		for level in range(1, self.levelCount):
+			if tick & ((1 << (self.slotBits * level)) - 1):
+				break
+			self._cascade(self._levels[level], (tick >> (self.slotBits * level)) & self._slotMask)
+		else:
+			if not (tick & ((1 << (self.slotBits * self.levelCount)) - 1)):
+				overflow = self._overflow
+				self._overflow = {}
+				for timer in overflow:
+					self._insertTimer(timer)
+
+		slotTimers = self._levels[0][tick & self._slotMask]
+		while slotTimers:
+			timer = next(iter(slotTimers))
+			del slotTimers[timer]
+			timer._slot = None
+			if timer._interval is None:
+				self._timerCount -= 1
+			else:
+				timer._expiryTick = max(timer._expiryTick + timer._interval, tick + 1)
+				self._insertTimer(timer)
+			try:
+				timer._func(*timer._args, **timer._kw)
+			except Exception:
+				self.log.failure("An error occurred while running a timer.")
+		if not self._timerCount and self._ticker.running:
+			self._ticker.stop()
+	
+	def _cascade(self, levelSlots: List[Dict[WheelTimer, None]], slotIndex: int) -> None:
+		slot = levelSlots[slotIndex]
+		if not slot:
+			return
+		levelSlots[slotIndex] = {}
+		for timer in slot:
+			self._insertTimer(timer)
@@ -1,12 +1,9 @@
-from twisted.internet import reactor
 from twisted.internet.defer import Deferred
 from twisted.internet.interfaces import ISSLTransport
-from twisted.internet.task import LoopingCall
-from twisted.names import client as dnsClient
 from twisted.words.protocols import irc
 from txircd import version
 from txircd.ircbase import IRCBase
-from txircd.utils import CaseInsensitiveDictionary, ipAddressToShow, isValidHost, isValidMetadataKey, lenBytes, ModeType, now, splitMessage
+from txircd.utils import CaseInsensitiveDictionary, ipAddressToShow, isValidMetadataKey, lenBytes, ModeType, now, splitMessage
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 irc.ERR_ALREADYREGISTERED = "462"
@@ -41,43 +38,24 @@ class IRCUser(IRCBase):
 		self._errorBatchName = None
 		self._errorBatch = []
 		self.ircd.users[self.uuid] = self
+		self.ircd.userIndex.updateUser(self)
 		self.localOnly = False
 		self.secureConnection = False
-		self._pinger = LoopingCall(self._ping)
-		self._registrationTimeoutTimer = reactor.callLater(registrationTimeout, self._timeoutRegistration)
+		self._setUpOutputBuffer(self.ircd)
+		self._setUpQueueLimits(self.ircd.config.get("user_sendq", 1048576), self.ircd.config.get("user_recvq", 16384))
+		self._pinger = None
+		self._deferredCommands = None
+		self._deferredCommandsTimer = None
+		self._registrationTimeoutTimer = self.ircd.timers.callLater(registrationTimeout, self._timeoutRegistration)
 		self._startDNSResolving(registrationTimeout)
 	
 	def _startDNSResolving(self, timeout: int) -> None:
-		resolveDeferred = dnsClient.lookupPointer(self.ip.reverse_pointer, ((timeout/2),))
-		resolveDeferred.addCallbacks(callback=self._verifyDNSResolution, callbackArgs=(timeout,), errback=self._cancelDNSResolution)
+		self.ircd.hostResolver.resolve(self.ip, timeout).addCallback(self._completeDNSResolution)
 	
-	def _verifyDNSResolution(self, result: Tuple[List["RRHeader"], List["RRHeader"], List["RRHeader"]], timeout: int) -> None:
-		resolveResults = result[0]
-		if not resolveResults:
-			self._cancelDNSResolution()
-			return
-		name = resolveResults[0].payload.name.name.decode("utf-8", "replace")
-		if lenBytes(name) > self.ircd.config.get("hostname_length", 64):
-			self._cancelDNSResolution()
-			return
-		if not isValidHost(name):
-			self._cancelDNSResolution()
-			return
-		if self.ip.version == 4:
-			resolveDeferred = dnsClient.lookupAddress(name, ((timeout/2),))
-		else:
-			resolveDeferred = dnsClient.lookupIPV6Address(name, ((timeout/2),))
-		resolveDeferred.addCallbacks(callback=self._completeDNSResolution, errback=self._cancelDNSResolution, callbackArgs=(name,))
-	
-	def _completeDNSResolution(self, result: Tuple[List["RRHeader"], List["RRHeader"], List["RRHeader"]], name: str) -> None:
-		addressResults = result[0]
-		for addressData in addressResults:
-			if hasattr(addressData.payload, "address") and addressData.payload.address == self.ip.packed:
-				self.realHost = name
-				break
-		self.register("dns")
-	
-	def _cancelDNSResolution(self, error: "Failure" = None) -> None:
+	def _completeDNSResolution(self, host: Optional[str]) -> None:
+		if host is not None:
+			self.realHost = host
+			self.ircd.userIndex.updateUser(self)
 		self.register("dns")
 	
 	def connectionMade(self) -> None:
@@ -86,6 +64,7 @@ class IRCUser(IRCBase):
 		# when the connection is closed.
 		# The "connection" register hold is used basically solely for the purposes of this to prevent potential
 		# race conditions with registration.
+		IRCBase.connectionMade(self)
 		if ISSLTransport.providedBy(self.transport):
 			self.secureConnection = True
 		self._callConnectAction()
@@ -93,7 +72,7 @@ class IRCUser(IRCBase):
 	def _callConnectAction(self) -> None:
 		self.ircd.log.debug("User {user.uuid} connected from {ip}", user=self, ip=ipAddressToShow(self.ip))
 		if self.ircd.runActionUntilFalse("userconnect", self, users=[self]):
-			self.transport.loseConnection()
+			self.closeConnection()
 			return
 		self.register("connection")
 	
@@ -106,9 +85,17 @@ class IRCUser(IRCBase):
 			if self.uuid in self.ircd.users:
 				self.disconnect("Error occurred")
 	
-	def sendLine(self, line: str) -> None:
+	def _sendLineData(self, line: str, data: bytes) -> None:
 		self.ircd.runActionStandard("usersenddata", self, line, users=[self])
-		IRCBase.sendLine(self, line)
+		IRCBase._sendLineData(self, line, data)
+	
+	def sendQueueExceeded(self) -> None:
+		if self.uuid in self.ircd.users:
+			self.disconnect("SendQ exceeded")
+	
+	def recvQueueExceeded(self) -> None:
+		if self.uuid in self.ircd.users:
+			self.disconnect("RecvQ exceeded")
 	
 	def sendMessage(self, command: str, *args: str, **kw: Any) -> None:
 		"""
@@ -124,6 +111,58 @@ class IRCUser(IRCBase):
 		    you might want some messages to always have the last parameter
 		    prefixed with a colon. To do that, pass this as True.
 		"""
+		args, to = self._prepareMessage(command, args, kw)
+		IRCBase.sendMessage(self, command, *args, **kw)
+		self.ircd.runActionStandard("sentmessage", self, command, args, kw)
+	
+	def sendMessageWithLineCache(self, lineCache: Dict[Tuple[Any, ...], Tuple[str, bytes]], command: str, *args: str, **kw: Any) -> None:
+		"""
+		Sends the given message to this user in the same way as sendMessage.
+		When sending the same message to many users, pass the same lineCache
+		dict for each user; the line is only formatted and encoded once for
+		each distinct set of tags and destination, and the encoded line is
+		reused for other users.
+		"""
+		args, to = self._prepareMessage(command, args, kw)
+		cacheKey = (to, tuple(kw["tags"].items()) if "tags" in kw else None)
+		if cacheKey in lineCache:
+			line, data = lineCache[cacheKey]
+		else:
+			line = self._formatMessage(command, *args, **kw)
+			data = self._encodeLine(line)
+			lineCache[cacheKey] = (line, data)
+		self._sendLineData(line, data)
+		self.ircd.runActionStandard("sentmessage", self, command, args, kw)
+	
+	def sendMessageWithMessageCache(self, messageCache: Dict[Optional[str], Tuple[str, bytes]], command: str, *args: str, **kw: Any) -> None:
+		"""
+		Sends the given message to this user in the same way as sendMessage.
+		This works like sendMessageWithLineCache, but the message is cached
+		without its tags, and each user's tags are added to it when it's sent
+		to them. Use this instead when the tags are likely to be different for
+		every user (such as when the message is in a batch), since then the
+		whole line couldn't be reused.
+		"""
+		args, to = self._prepareMessage(command, args, kw)
+		if to in messageCache:
+			messageLine, messageData = messageCache[to]
+		else:
+			messageKw = kw
+			if "tags" in kw:
+				messageKw = kw.copy()
+				del messageKw["tags"]
+			messageLine = self._formatMessage(command, *args, **messageKw)
+			messageData = self._encodeLine(messageLine)
+			messageCache[to] = (messageLine, messageData)
+		tagString = self._buildTagString(kw["tags"]) if "tags" in kw else None
+		if tagString:
+			tagPrefix = "@{} ".format(tagString)
+			self._sendLineData(tagPrefix + messageLine, tagPrefix.encode("utf-8") + messageData)
+		else:
+			self._sendLineData(messageLine, messageData)
+		self.ircd.runActionStandard("sentmessage", self, command, args, kw)
+	
+	def _prepareMessage(self, command: str, args: Tuple[str, ...], kw: Dict[str, Any]) -> Tuple[List[str], str]:
 		if "prefix" not in kw:
 			kw["prefix"] = self.ircd.name
 		if kw["prefix"] is None:
@@ -136,12 +175,16 @@ class IRCUser(IRCBase):
 			args = [to] + list(args)
 		tags = kw["tags"] if "tags" in kw else {}
 		self.ircd.runActionStandard("outgoingmessagetags", self, command, to, tags)
-		IRCBase.sendMessage(self, command, *args, **kw)
-		self.ircd.runActionStandard("sentmessage", self, command, args, kw)
+		return args, to
 	
 	def handleCommand(self, command: str, params: List[str], prefix: str, tags: Dict[str, Optional[str]]) -> None:
 		if self.uuid not in self.ircd.users:
 			return # we have been disconnected - ignore all further commands
+		if self._deferredCommands is not None and command not in ("PING", "PONG"):
+			# Commands have to be handled in order, so anything received while a command is deferred waits behind it.
+			# PING and PONG don't depend on anything else, so they're handled right away to keep the connection alive.
+			self._deferredCommands.append((command, params, prefix, tags))
+			return
 		if command in self.ircd.userCommands:
 			handlers = self.ircd.userCommands[command]
 			if not handlers:
@@ -172,6 +215,13 @@ class IRCUser(IRCBase):
 					self._dispatchErrorBatch()
 				return
 			self._clearErrorBatch()
+			deferTime = self.ircd.runComboActionUntilValue((("commanddefer-{}".format(command), (self, data)), ("commanddefer", (self, command, data))), users=affectedUsers, channels=affectedChannels)
+			if deferTime:
+				if self._deferredCommands is None:
+					self._deferCommand(deferTime, command, params, prefix, tags)
+				else: # A PING or PONG received while other commands are deferred is handled with them instead
+					self._deferredCommands.append((command, params, prefix, tags))
+				return
 			if self.ircd.runComboActionUntilValue((("commandpermission-{}".format(command), (self, data)), ("commandpermission", (self, command, data))), users=affectedUsers, channels=affectedChannels) is False:
 				return
 			self.ircd.runComboActionStandard((("commandmodify-{}".format(command), (self, data)), ("commandmodify", (self, command, data))), users=affectedUsers, channels=affectedChannels) # This allows us to do processing without the "stop on empty" feature of runActionProcessing
@@ -187,6 +237,27 @@ class IRCUser(IRCBase):
 			if not self.ircd.runActionFlagTrue("commandunknown", self, command, params, {}):
 				self.sendMessage(irc.ERR_UNKNOWNCOMMAND, command, "Unknown command")
 	
+	def _deferCommand(self, delay: float, command: str, params: List[str], prefix: str, tags: Dict[str, Optional[str]]) -> None:
+		"""
+		Holds a command to be handled again after the given number of seconds.
+		We stop reading from the connection in the meantime.
+		"""
+		self._deferredCommands = [(command, params, prefix, tags)]
+		self.holdInput()
+		self._deferredCommandsTimer = self.ircd.timers.callLater(delay, self._handleDeferredCommands)
+	
+	def _handleDeferredCommands(self) -> None:
+		deferredCommands = self._deferredCommands
+		self._deferredCommands = None
+		self._deferredCommandsTimer = None
+		while deferredCommands:
+			command, params, prefix, tags = deferredCommands.pop(0)
+			self.handleCommand(command, params, prefix, tags)
+			if self._deferredCommands is not None: # The command was deferred again
+				self._deferredCommands.extend(deferredCommands)
+				return
+		self.releaseInput()
+	
 	def createMessageBatch(self, batchName: str, batchType: str, batchParameters: List[Any] = None) -> None:
 		"""
 		Start a new message batch with the given batch name, type, and list of parameters.
@@ -200,7 +271,17 @@ class IRCUser(IRCBase):
 		"""
 		if batchName not in self._messageBatches:
 			return
-		self._messageBatches[batchName]["messages"].append((command, args, kw))
+		self._messageBatches[batchName]["messages"].append((command, args, kw, None))
+	
+	def sendMessageInBatchWithMessageCache(self, batchName: str, messageCache: Dict[Optional[str], Tuple[str, bytes]], command: str, *args: str, **kw: Any) -> None:
+		"""
+		Adds a message to the batch with the given name. When the batch is
+		sent, the message is sent with the given message cache in the same way
+		as sendMessageWithMessageCache.
+		"""
+		if batchName not in self._messageBatches:
+			return
+		self._messageBatches[batchName]["messages"].append((command, args, kw, messageCache))
 	
 	def sendBatch(self, batchName: str) -> None:
 		"""
@@ -212,7 +293,10 @@ class IRCUser(IRCBase):
 		batchParameters = self._messageBatches[batchName]["parameters"]
 		self.ircd.runActionStandard("startbatchsend", self, batchName, batchType, batchParameters)
 		for messageData in self._messageBatches[batchName]["messages"]:
-			self.sendMessage(messageData[0], *messageData[1], **messageData[2])
+			if messageData[3] is None:
+				self.sendMessage(messageData[0], *messageData[1], **messageData[2])
+			else:
+				self.sendMessageWithMessageCache(messageData[3], messageData[0], *messageData[1], **messageData[2])
 		self.ircd.runActionStandard("endbatchsend", self, batchName, batchType, batchParameters)
 		del self._messageBatches[batchName]
 	
@@ -278,15 +362,19 @@ class IRCUser(IRCBase):
 		# the user from completing registration.
 		self.addRegisterHold("QUIT")
 		if self._pinger:
-			if self._pinger.running:
-				self._pinger.stop()
+			self._pinger.cancel()
 			self._pinger = None
 		if self._registrationTimeoutTimer:
-			if self._registrationTimeoutTimer.active():
-				self._registrationTimeoutTimer.cancel()
+			self._registrationTimeoutTimer.cancel()
 			self._registrationTimeoutTimer = None
+		if self._deferredCommandsTimer:
+			self._deferredCommandsTimer.cancel()
+			self._deferredCommandsTimer = None
+		self._deferredCommands = None
 		self.ircd.recentlyQuitUsers[self.uuid] = now()
 		del self.ircd.users[self.uuid]
+		self.ircd.userIndex.removeUser(self)
+		self.ircd.userRemovalCount += 1
 		if self.isRegistered():
 			del self.ircd.userNicks[self.nick]
 		userSendList = [self]
@@ -298,11 +386,11 @@ class IRCUser(IRCBase):
 		userSendList.remove(self)
 		self.ircd.runActionProcessing("quitmessage", userSendList, self, reason, None, users=[self] + userSendList)
 		self.ircd.runActionStandard("quit", self, reason, fromServer, users=[self], allowDisconnected=True)
-		self.transport.loseConnection()
+		self.closeConnection()
 	
 	def _timeoutRegistration(self) -> None:
 		if self.isRegistered():
-			self._pinger.start(self.ircd.config.get("user_ping_frequency", 60), False)
+			self._pinger = self.ircd.timers.callEvery(self.ircd.config.get("user_ping_frequency", 60), self._ping)
 			return
 		self.disconnect("Registration timeout")
 	
@@ -332,7 +420,7 @@ class IRCUser(IRCBase):
 				return
 			self._registerHolds.add("registercheck") # The user shouldn't be considered registered until we complete these final checks
 			if self.ircd.runActionUntilFalse("register", self, users=[self]):
-				self.transport.loseConnection()
+				self.closeConnection()
 				return
 			self._registerHolds.remove("registercheck")
 			self.ircd.userNicks[self.nick] = self
@@ -443,6 +531,7 @@ class IRCUser(IRCBase):
 		if hostType in self._hostStack:
 			self._hostStack.remove(hostType)
 		self._hostStack.append(hostType)
+		self.ircd.userIndex.updateUser(self)
 		if self.isRegistered():
 			self.ircd.runComboActionStandard((("changehost", (self, hostType, oldHost, fromServer)), ("updatehost", (self, hostType, oldHost, newHost, fromServer))), users=[self])
 	
@@ -466,6 +555,7 @@ class IRCUser(IRCBase):
 		if hostType in self._hostsByType:
 			oldHostOfType = self._hostsByType[hostType]
 		self._hostsByType[hostType] = newHost
+		self.ircd.userIndex.updateUser(self)
 		changedUserHost = (oldHost != self.host())
 		changedHostOfType = (oldHostOfType != newHost)
 		if self.isRegistered():
@@ -484,6 +574,7 @@ class IRCUser(IRCBase):
 		if hostType in self._hostStack:
 			self._hostStack.remove(hostType)
 		del self._hostsByType[hostType]
+		self.ircd.userIndex.updateUser(self)
 		currentHost = self.host()
 		if currentHost != oldHost:
 			self.ircd.runComboActionStandard((("changehost", (self, hostType, oldHost, fromServer)), ("updatehost", (self, hostType, oldHost, None, fromServer))), users=[self])
@@ -518,6 +609,7 @@ class IRCUser(IRCBase):
 			return
 		oldIP = self.ip
 		self.ip = ip
+		self.ircd.userIndex.updateUser(self)
 		self.ircd.runActionStandard("changeipaddress", self, oldIP, users=[self])
 	
 	def metadataKeyExists(self, key: str) -> bool:
@@ -876,6 +968,12 @@ class RemoteUser(IRCUser):
 	def sendMessage(self, command: str, *params: str, **kw: Any) -> None:
 		pass # Messages can't be sent directly to remote users.
 	
+	def sendMessageWithLineCache(self, lineCache: Dict[Tuple[Any, ...], Tuple[str, bytes]], command: str, *params: str, **kw: Any) -> None:
+		pass
+	
+	def sendMessageWithMessageCache(self, messageCache: Dict[Optional[str], Tuple[str, bytes]], command: str, *params: str, **kw: Any) -> None:
+		pass
+	
 	def register(self, holdName: str, fromRemote: bool = False) -> None:
 		"""
 		Handles registration of a remote user.
@@ -909,6 +1007,8 @@ class RemoteUser(IRCUser):
 			del self.ircd.userNicks[self.nick]
 		self.ircd.recentlyQuitUsers[self.uuid] = now()
 		del self.ircd.users[self.uuid]
+		self.ircd.userIndex.removeUser(self)
+		self.ircd.userRemovalCount += 1
 		userSendList = []
 		while self.channels:
 			channel = self.channels[0]
@@ -1014,11 +1114,27 @@ class LocalUser(IRCUser):
 		"""
 		self._sendMsgFunc(self, command, *args, **kw)
 	
+	def sendMessageWithLineCache(self, lineCache: Dict[Tuple[Any, ...], Tuple[str, bytes]], command: str, *args: str, **kw: Any) -> None:
+		"""
+		Sends a message to this user. Messages to local users aren't sent
+		over the wire, so the line cache isn't used.
+		"""
+		self.sendMessage(command, *args, **kw)
+	
+	def sendMessageWithMessageCache(self, messageCache: Dict[Optional[str], Tuple[str, bytes]], command: str, *args: str, **kw: Any) -> None:
+		"""
+		Sends a message to this user. Messages to local users aren't sent
+		over the wire, so the message cache isn't used.
+		"""
+		self.sendMessage(command, *args, **kw)
+	
 	def disconnect(self, reason: str) -> None:
 		"""
 		Cleans up and removes the user.
 		"""
 		del self.ircd.users[self.uuid]
+		self.ircd.userIndex.removeUser(self)
+		self.ircd.userRemovalCount += 1
 		del self.ircd.userNicks[self.nick]
 		userSendList = [self]
 		for channel in self.channels:
@@ -0,0 +1,69 @@
+from txircd.utils import ipAddressToShow, ircLower
+from typing import Dict, List, Union
+
+class UserIndex(object):
+	"""
+	Indexes connected users by IP address and by host, so that users with a
+	particular IP address or host can be found without checking every user.
+	A user's hosts are their current host, their real host, and the display
+	form of their IP address, all lowercased.
+	"""
+	def __init__(self):
+		self._usersByIP = {}
+		self._usersByHost = {}
+		self._userKeys = {}
+	
+	def updateUser(self, user: "IRCUser") -> None:
+		"""
+		Adds the user to the index, or updates the user's entries after their
+		IP address or hosts have changed.
+		"""
+		ip = user.ip
+		hosts = set((ircLower(user.host()), ircLower(user.realHost), ircLower(ipAddressToShow(ip))))
+		if user.uuid in self._userKeys:
+			oldIP, oldHosts = self._userKeys[user.uuid]
+			if oldIP == ip and oldHosts == hosts:
+				return
+			self.removeUser(user)
+		self._userKeys[user.uuid] = (ip, hosts)
+		if ip not in self._usersByIP:
+			self._usersByIP[ip] = {}
+		self._usersByIP[ip][user.uuid] = user
+		for host in hosts:
+			if host not in self._usersByHost:
+				self._usersByHost[host] = {}
+			self._usersByHost[host][user.uuid] = user
+	
+	def removeUser(self, user: "IRCUser") -> None:
+		"""
+		Removes the user from the index.
+		"""
+		if user.uuid not in self._userKeys:
+			return
+		ip, hosts = self._userKeys.pop(user.uuid)
+		self._removeFromGroup(self._usersByIP, ip, user.uuid)
+		for host in hosts:
+			self._removeFromGroup(self._usersByHost, host, user.uuid)
+	
+	def _removeFromGroup(self, groups: Dict[Union[str, "IPv4Address", "IPv6Address"], Dict[str, "IRCUser"]], key: Union[str, "IPv4Address", "IPv6Address"], uuid: str) -> None:
+		group = groups[key]
+		del group[uuid]
+		if not group:
+			del groups[key]
+	
+	def usersWithIP(self, ip: Union["IPv4Address", "IPv6Address"]) -> List["IRCUser"]:
+		"""
+		Returns the users connected from the given IP address.
+		"""
+		if ip not in self._usersByIP:
+			return []
+		return list(self._usersByIP[ip].values())
+	
+	def usersWithHost(self, host: str) -> List["IRCUser"]:
+		"""
+		Returns the users whose current host, real host, or IP address matches
+		the given host. The host must already be lowercased.
+		"""
+		if host not in self._usersByHost:
+			return []
+		return list(self._usersByHost[host].values())